@@ -0,0 +1,226 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Barriers, based on the apache zookeeper recipes.
+
+Waiting participants watch a single node rather than polling the barrier's
+children, so the requests to enter or leave a barrier are linear in the
+number of participants.
+
+http://zookeeper.apache.org/doc/r3.3.0/recipes.html#sc_recipes_eventHandles
+"""
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+__all__ = ["Barrier", "DoubleBarrier", "BarrierError"]
+
+
+class BarrierError(Exception):
+    """
+    Raised on misuse of a barrier.
+    """
+
+
+def _trap_exists(failure):
+    failure.trap(zookeeper.NodeExistsException)
+
+
+def _trap_no_node(failure):
+    failure.trap(zookeeper.NoNodeException)
+
+
+class Barrier(object):
+    """
+    A barrier, holding waiters while its node exists.
+    """
+
+    def __init__(self, client, path):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the barrier node.
+        """
+        self._client = client
+        self._path = path
+
+    @property
+    def path(self):
+        return self._path
+
+    def set(self):
+        """Raise the barrier, if it isn't already."""
+        d = self._client.create(self._path)
+        d.addErrback(_trap_exists)
+        return d
+
+    def remove(self):
+        """Remove the barrier, releasing its waiters."""
+        d = self._client.delete(self._path)
+        d.addErrback(_trap_no_node)
+        return d
+
+    @inlineCallbacks
+    def wait(self):
+        """
+        Wait till the barrier is removed. Returns a deferred which fires
+        once the barrier's node doesn't exist.
+        """
+        while True:
+            exists_d, watch_d = self._client.exists_and_watch(self._path)
+            exists = yield exists_d
+            if not exists:
+                return
+            event = yield watch_d
+            if event.type == zookeeper.DELETED_EVENT:
+                return
+
+
+class DoubleBarrier(object):
+    """
+    A double barrier, synchronizing the start and the end of a computation
+    among a number of participants.
+
+    Participants entering the barrier wait on a ready node, created by the
+    participant completing the count. Participants leaving the barrier wait
+    on a single other participant's node, the lowest participant waits for
+    all the others to leave, and they wait for it.
+
+    A barrier can be reused once all its participants left.
+    """
+
+    prefix = "participant-"
+    ready_name = "ready"
+
+    def __init__(self, client, path, count):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the barrier's directory, created on
+        demand.
+        @param count: The number of participants, the same for all users
+        of the barrier.
+        """
+        if count < 1:
+            raise ValueError("A barrier requires at least one participant")
+        self._client = client
+        self._path = path
+        self._count = count
+        self._node_path = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def entered(self):
+        """Has this participant entered the barrier. Returns a boolean"""
+        return self._node_path is not None
+
+    @property
+    def _ready_path(self):
+        return "/".join((self._path, self.ready_name))
+
+    def _participants(self, children):
+        return sorted(
+            [name for name in children if name.startswith(self.prefix)],
+            key=lambda name: name[-10:])
+
+    @inlineCallbacks
+    def enter(self):
+        """
+        Enter the barrier. Returns a deferred which fires once all the
+        participants entered.
+        """
+        if self._node_path is not None:
+            raise BarrierError("Already entered the barrier %s" % self.path)
+
+        yield self._client.create(self._path).addErrback(_trap_exists)
+        self._node_path = yield self._client.create(
+            "/".join((self._path, self.prefix)),
+            flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+
+        while True:
+            # The watch is set before listing, so the ready node's creation
+            # can't be missed.
+            exists_d, watch_d = self._client.exists_and_watch(
+                self._ready_path)
+            exists = yield exists_d
+            if exists:
+                break
+
+            children = yield self._client.get_children(self._path)
+            if len(self._participants(children)) >= self._count:
+                yield self._client.create(
+                    self._ready_path).addErrback(_trap_exists)
+                break
+
+            event = yield watch_d
+            if event.type == zookeeper.CREATED_EVENT:
+                break
+        returnValue(self)
+
+    @inlineCallbacks
+    def leave(self):
+        """
+        Leave the barrier. Returns a deferred which fires once all the
+        participants left.
+        """
+        if self._node_path is None:
+            raise BarrierError("Not entered the barrier %s" % self.path)
+
+        node_path, self._node_path = self._node_path, None
+        name = node_path[node_path.rfind("/") + 1:]
+        deleted = False
+
+        while True:
+            children = yield self._client.get_children(self._path)
+            participants = self._participants(children)
+            if not participants:
+                break
+
+            if participants == [name]:
+                # The last to leave removes the ready node, for the
+                # barrier's reuse.
+                yield self._client.delete(
+                    self._ready_path).addErrback(_trap_no_node)
+                yield self._client.delete(node_path)
+                break
+
+            if participants[0] == name:
+                # The lowest participant waits for the others to leave.
+                target = participants[-1]
+            else:
+                if not deleted:
+                    yield self._client.delete(node_path)
+                    deleted = True
+                target = participants[0]
+
+            exists_d, watch_d = self._client.exists_and_watch(
+                "/".join((self._path, target)))
+            exists = yield exists_d
+            if exists:
+                yield watch_d
@@ -0,0 +1,378 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Storage of values larger than the zookeeper node size limit.
+
+A value larger than the chunk size is split into chunks stored as children
+of its node. The chunks are written first, and the value is committed by
+setting a small manifest as the node's content. Readers retrieve the
+manifest and reassemble the value from its chunks. Values that fit in a
+single chunk are stored inline as the node's content.
+
+Ephemeral nodes can't have children, so only values that fit in a single
+chunk can be stored on ephemeral nodes.
+"""
+
+import uuid
+
+import zookeeper
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, Deferred, DeferredList,
+    DeferredSemaphore)
+from twisted.python.failure import Failure
+
+from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
+
+__all__ = ["ChunkedStore", "ChunkedValueError"]
+
+# Default chunk size, leaves headroom below the 1M jute.maxbuffer default.
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# Default number of chunk operations outstanding at once.
+DEFAULT_WINDOW = 8
+
+MANIFEST_MAGIC = "\x00txzk-chunked:"
+
+
+class ChunkedValueError(zookeeper.ZooKeeperException):
+    """
+    Raised if a chunked value is missing chunks, or can't be stored.
+    """
+
+
+def parse_manifest(content):
+    """
+    Parse a node's content as a manifest, returns a tuple of the value's
+    generation, chunk count and size, or None if the content is inline.
+    """
+    if not content or not content.startswith(MANIFEST_MAGIC):
+        return None
+    generation, count, size = content[len(MANIFEST_MAGIC):].split(" ")
+    return generation, int(count), int(size)
+
+
+def format_manifest(generation, count, size):
+    return "%s%s %d %d" % (MANIFEST_MAGIC, generation, count, size)
+
+
+class ChunkedStore(object):
+    """
+    Stores and retrieves node values of arbitrary size via a client.
+
+    Chunk operations are pipelined, with at most `window` outstanding at
+    once, which bounds the memory used by chunk copies to the window
+    rather than the value size.
+    """
+
+    prefix = "chunk-"
+
+    def __init__(self, client, chunk_size=DEFAULT_CHUNK_SIZE,
+                 window=DEFAULT_WINDOW):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param chunk_size: The maximum size of the content of a node.
+        @param window: The maximum number of chunk operations outstanding.
+        """
+        self._client = client
+        self._chunk_size = chunk_size
+        self._window = window
+
+    @property
+    def client(self):
+        return self._client
+
+    def _is_inline(self, data):
+        return (len(data) <= self._chunk_size and
+                not data.startswith(MANIFEST_MAGIC))
+
+    def _chunk_path(self, path, generation, index):
+        return "%s/%s%s-%010d" % (path, self.prefix, generation, index)
+
+    def _write_chunks(self, path, data, acls):
+        """
+        Write the chunks of a value under a new generation. Each chunk is
+        sliced from the value only when its write is issued. Returns a
+        deferred with the manifest of the value.
+        """
+        generation = uuid.uuid4().hex
+        semaphore = DeferredSemaphore(self._window)
+
+        def write_chunk(index):
+            offset = index * self._chunk_size
+            return self._client.create(
+                self._chunk_path(path, generation, index),
+                data[offset:offset + self._chunk_size], acls)
+
+        def on_written(results):
+            # Fail only once all the writes settled, so that a cleanup of
+            # the chunks can't race with writes still in flight.
+            for success, result in results:
+                if not success:
+                    return result
+            return format_manifest(generation, count, len(data))
+
+        count = (len(data) + self._chunk_size - 1) // self._chunk_size
+        d = DeferredList(
+            [semaphore.run(write_chunk, i) for i in range(count)],
+            consumeErrors=True)
+        d.addCallback(on_written)
+        return d
+
+    def _delete_chunks(self, path, generation=None):
+        """
+        Delete the chunks of a node, or only those of the given generation.
+        """
+        semaphore = DeferredSemaphore(self._window)
+        prefix = self.prefix
+        if generation is not None:
+            prefix = "%s%s-" % (self.prefix, generation)
+
+        def on_children(children):
+            return gatherResults([
+                semaphore.run(self._client.delete, "/".join((path, name)))
+                for name in children if name.startswith(prefix)])
+
+        d = self._client.get_children(path)
+        d.addCallback(on_children)
+        return d
+
+    @inlineCallbacks
+    def create(self, path, data="", acls=[ZOO_OPEN_ACL_UNSAFE], flags=0):
+        """
+        Create a node with the given value, returns the path of the node.
+
+        Until the value's chunks are written, the node reads as empty.
+        """
+        if self._is_inline(data):
+            path = yield self._client.create(path, data, acls, flags)
+            returnValue(path)
+
+        if flags & zookeeper.EPHEMERAL:
+            raise ChunkedValueError(
+                "Chunked values can't be stored on ephemeral nodes %s" % path)
+
+        path = yield self._client.create(path, "", acls, flags)
+        try:
+            manifest = yield self._write_chunks(path, data, acls)
+            yield self._client.set(path, manifest)
+        except:
+            # Remove the node and the chunks written, the node was created
+            # above so all its chunks are ours.
+            failure = Failure()
+            try:
+                yield self._delete_chunks(path)
+                yield self._client.delete(path)
+            except Exception:
+                pass
+            failure.raiseException()
+        returnValue(path)
+
+    @inlineCallbacks
+    def set(self, path, data="", version=-1):
+        """
+        Set the value of a node. Chunks of the previous value are removed
+        once the new value is committed. Returns the node's stat.
+        """
+        content, stat = yield self._client.get(path)
+        if version != -1 and stat["version"] != version:
+            raise zookeeper.BadVersionException("bad version %s" % path)
+
+        if self._is_inline(data):
+            new_content = data
+        else:
+            acls, _ = yield self._client.get_acl(path)
+            new_content = yield self._write_chunks(path, data, acls)
+
+        while True:
+            try:
+                new_stat = yield self._client.set(
+                    path, new_content, stat["version"])
+                break
+            except zookeeper.BadVersionException:
+                if version != -1:
+                    manifest = parse_manifest(new_content)
+                    if manifest is not None:
+                        yield self._delete_chunks(path, manifest[0])
+                    raise
+            # Another writer committed first, replace its value.
+            content, stat = yield self._client.get(path)
+
+        replaced = parse_manifest(content)
+        if replaced is not None:
+            yield self._delete_chunks(path, replaced[0])
+        returnValue(new_stat)
+
+    def get(self, path):
+        """
+        Get the value of a node, returns a deferred with a tuple of the value
+        and the node's stat.
+        """
+        chunks = []
+
+        class Collector(object):
+            write = chunks.append
+
+        def restart():
+            del chunks[:]
+
+        d = self._read(path, Collector(), restart)
+        d.addCallback(lambda stat: ("".join(chunks), stat))
+        return d
+
+    def get_stream(self, path, consumer):
+        """
+        Retrieve the value of a node, writing its chunks in order to the
+        consumer as they arrive. At most a window of chunks is buffered.
+
+        A value replaced before any chunk was written is read again, a
+        value replaced afterwards fails the retrieval with a
+        C{ChunkedValueError}, as the consumer already received a part of
+        the previous value.
+
+        @param consumer: An object with a write method, such as a file.
+        @return: A deferred with the node's stat once the value is written.
+        """
+        return self._read(path, consumer)
+
+    def _read(self, path, consumer, restart=None):
+        """
+        Read the value of a node into the consumer. If the value is
+        replaced while reading, it's read again as long as the node keeps
+        changing, after invoking `restart` if chunks were written.
+        """
+        d = self._client.get(path)
+        d.addCallback(self._on_manifest, path, consumer, restart)
+        return d
+
+    def _on_manifest(self, (content, stat), path, consumer, restart):
+        manifest = parse_manifest(content)
+        if manifest is None:
+            consumer.write(content)
+            return stat
+
+        generation, count, size = manifest
+        d = Deferred()
+        pending = {}
+        # Once done, the replies to the reads still outstanding are ignored.
+        state = {"next": 0, "issued": 0, "size": 0, "done": False}
+
+        def issue():
+            while (state["issued"] < count and
+                   state["issued"] - state["next"] < self._window):
+                index = state["issued"]
+                state["issued"] += 1
+                c_d = self._client.get(
+                    self._chunk_path(path, generation, index))
+                c_d.addCallbacks(on_chunk, on_error, callbackArgs=(index,))
+
+        def finish(result):
+            state["done"] = True
+            if isinstance(result, (Failure, Exception)):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+        def on_chunk((data, chunk_stat), index):
+            if state["done"]:
+                return
+            pending[index] = data
+            try:
+                while state["next"] in pending:
+                    data = pending.pop(state["next"])
+                    state["size"] += len(data)
+                    state["next"] += 1
+                    consumer.write(data)
+            except Exception:
+                # The consumer's error fails the retrieval.
+                return finish(Failure())
+            if state["next"] == count:
+                if state["size"] != size:
+                    return finish(ChunkedValueError(
+                        "Chunked value size mismatch %s" % path))
+                return finish(stat)
+            issue()
+
+        def on_error(failure):
+            if state["done"]:
+                return
+            if not failure.check(zookeeper.NoNodeException):
+                return finish(failure)
+            if state["next"] and restart is None:
+                return finish(ChunkedValueError(
+                    "Chunked value replaced while streaming %s" % path))
+            # The value was likely replaced while reading, read it again.
+            state["done"] = True
+            r_d = self._client.get(path)
+            r_d.addCallback(on_reread)
+            r_d.chainDeferred(d)
+
+        def on_reread((new_content, new_stat)):
+            if new_stat["mzxid"] == stat["mzxid"]:
+                raise ChunkedValueError(
+                    "Chunked value missing chunks %s" % path)
+            if state["next"]:
+                restart()
+            return self._on_manifest(
+                (new_content, new_stat), path, consumer, restart)
+
+        issue()
+        return d
+
+    @inlineCallbacks
+    def delete(self, path, version=-1):
+        """
+        Delete a node and the chunks of its value.
+
+        A chunked value is first cleared from the node with a versioned
+        update, so that a version mismatch fails the deletion before any
+        chunk is removed.
+        """
+        while True:
+            content, stat = yield self._client.get(path)
+            if version != -1 and stat["version"] != version:
+                raise zookeeper.BadVersionException("bad version %s" % path)
+
+            try:
+                yield self._delete(path, content, stat)
+                return
+            except zookeeper.BadVersionException:
+                if version != -1:
+                    raise
+            # Another writer changed the value, delete its value.
+
+    @inlineCallbacks
+    def _delete(self, path, content, stat):
+        manifest = parse_manifest(content)
+        if manifest is None:
+            yield self._client.delete(path, stat["version"])
+            return
+
+        stat = yield self._client.set(path, "", stat["version"])
+        yield self._delete_chunks(path, manifest[0])
+        try:
+            yield self._client.delete(path, stat["version"])
+        except zookeeper.NotEmptyException:
+            # Chunks left over from failed writes.
+            yield self._delete_chunks(path)
+            yield self._client.delete(path, stat["version"])
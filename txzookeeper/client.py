@@ -155,10 +155,85 @@ class ClientEvent(namedtuple("ClientEvent", 'type, connection_state, path')):
             self.type_name, self.path, self.state_name)
 
 
+class Stat(object):
+    """
+    A compact representation of a node's stat, with attribute access to
+    its fields. Dictionary style access is supported for compatibility with
+    the stat dictionaries returned by default.
+    """
+
+    __slots__ = (
+        "czxid", "mzxid", "ctime", "mtime", "version", "cversion",
+        "aversion", "ephemeralOwner", "dataLength", "numChildren", "pzxid")
+
+    def __init__(self, czxid=0, mzxid=0, ctime=0, mtime=0, version=0,
+                 cversion=0, aversion=0, ephemeralOwner=0, dataLength=0,
+                 numChildren=0, pzxid=0):
+        self.czxid = czxid
+        self.mzxid = mzxid
+        self.ctime = ctime
+        self.mtime = mtime
+        self.version = version
+        self.cversion = cversion
+        self.aversion = aversion
+        self.ephemeralOwner = ephemeralOwner
+        self.dataLength = dataLength
+        self.numChildren = numChildren
+        self.pzxid = pzxid
+
+    @classmethod
+    def from_dict(cls, stat):
+        """Create a stat from a stat dictionary, None is passed through."""
+        if stat is None:
+            return None
+        return cls(**stat)
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def __eq__(self, other):
+        if isinstance(other, Stat):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<Stat version: %s mzxid: %s numChildren: %s>" % (
+            self.version, self.mzxid, self.numChildren)
+
+
 class ZookeeperClient(object):
     """Asynchronous twisted client for zookeeper."""
 
-    def __init__(self, servers=None, session_timeout=None):
+    def __init__(self, servers=None, session_timeout=None, codec=None,
+                 compact_stat=False, metrics=None):
         """
         @param servers: A string specifying the servers and their
                         ports to connect to. Multiple servers can be
@@ -172,13 +247,27 @@ class ZookeeperClient(object):
                        hinted. The actual value is negotiated between the
                        client and server based on their respective
                        configurations.
+
+        @param codec: An optional value codec, used by default by node,
+                      queue and utility abstractions over this client. The
+                      client's own api always deals in raw strings.
+
+        @param compact_stat: Boolean, return node stats as C{Stat} instances
+                      instead of dictionaries.
+
+        @param metrics: An optional metrics hook, used by default by the
+                      recipes and utility abstractions over this client.
         """
         self._servers = servers
         self._session_timeout = session_timeout
         self._session_event_callback = None
+        self._session_listeners = []
         self._connection_error_callback = None
         self.connected = False
         self.handle = None
+        self.codec = codec
+        self.metrics = metrics
+        self._compact_stat = compact_stat
 
     def __repr__(self):
         if not self.client_id:
@@ -229,6 +318,12 @@ class ZookeeperClient(object):
             return True
         return None
 
+    def _stat(self, stat):
+        """Convert a stat dictionary if compact stats are enabled."""
+        if self._compact_stat:
+            return Stat.from_dict(stat)
+        return stat
+
     def _get(self, path, watcher):
         d = defer.Deferred()
         if self._check_connected(d):
@@ -237,7 +332,7 @@ class ZookeeperClient(object):
         def _cb_get(result_code, value, stat):
             if self._check_result(result_code, d, path=path):
                 return
-            d.callback((value, stat))
+            d.callback((value, self._stat(stat)))
 
         callback = self._zk_thread_callback(_cb_get)
         watcher = self._wrap_watcher(watcher, "get", path)
@@ -270,7 +365,7 @@ class ZookeeperClient(object):
             if self._check_result(
                 result_code, d, extra_codes=(zookeeper.NONODE,), path=path):
                 return
-            d.callback(stat)
+            d.callback(self._stat(stat))
 
         callback = self._zk_thread_callback(_cb_exists)
         watcher = self._wrap_watcher(watcher, "exists", path)
@@ -294,9 +389,8 @@ class ZookeeperClient(object):
         # which we have modeled after deferred, which only accept a
         # single return value.
         if event_type == zookeeper.SESSION_EVENT:
-            if self._session_event_callback:
-                self._session_event_callback(
-                    self, ClientEvent(event_type, conn_state, path))
+            self._notify_session_event(
+                ClientEvent(event_type, conn_state, path))
             # We do propagate to watch deferreds, in one case in
             # particular, namely if the session is expired, in which
             # case the watches are dead, and we send an appropriate
@@ -307,6 +401,14 @@ class ZookeeperClient(object):
         else:
             return watcher(event_type, conn_state, path)
 
+    def _notify_session_event(self, event):
+        """Dispatch a session event to the listeners, then the callback.
+        """
+        for listener in list(self._session_listeners):
+            listener(self, event)
+        if self._session_event_callback:
+            self._session_event_callback(self, event)
+
     def _zk_thread_callback(self, func, *f_args, **f_kw):
         """
         The client library invokes callbacks in a separate thread, we wrap
@@ -495,9 +597,7 @@ class ZookeeperClient(object):
 
             # Send session events to the callback, in addition to any
             # duplicate session events that will be sent for extant watches.
-            if self._session_event_callback:
-                self._session_event_callback(
-                    self, ClientEvent(type, state, path))
+            self._notify_session_event(ClientEvent(type, state, path))
 
             return
         # Connected successfully, or If we're expired on an initial
@@ -660,7 +760,7 @@ class ZookeeperClient(object):
         def _cb_get_acl(result_code, acls, stat):
             if self._check_result(result_code, d, path=path):
                 return
-            d.callback((acls, stat))
+            d.callback((acls, self._stat(stat)))
 
         callback = self._zk_thread_callback(_cb_get_acl)
         result = zookeeper.aget_acl(self.handle, path, callback)
@@ -728,7 +828,7 @@ class ZookeeperClient(object):
     def _cb_set(self, d, path, data, result_code, node_stat):
         if self._check_result(result_code, d, path=path):
             return
-        d.callback(node_stat)
+        d.callback(self._stat(node_stat))
 
     def set_connection_watcher(self, watcher):
         """
@@ -764,6 +864,26 @@ class ZookeeperClient(object):
             raise TypeError("Invalid callback %r" % callback)
         self._session_event_callback = callback
 
+    def add_session_listener(self, listener):
+        """Add a listener receiving session events.
+
+        Unlike the session callback, of which there's a single one, any
+        number of listeners may be added, allowing the abstractions over a
+        client to track its connection without taking over the session
+        callback. Listeners are invoked before the session callback, in
+        the order they were added, with the client and the session event.
+        As session events are broadcast to all extant watches, a listener
+        may receive the same event several times.
+        """
+        if not callable(listener):
+            raise TypeError("Invalid listener %r" % listener)
+        self._session_listeners.append(listener)
+
+    def remove_session_listener(self, listener):
+        """Remove a session event listener."""
+        if listener in self._session_listeners:
+            self._session_listeners.remove(listener)
+
     def set_connection_error_callback(self, callback):
         """Set a callback to receive connection error exceptions.
 
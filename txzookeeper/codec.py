@@ -0,0 +1,357 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Value codecs for node content and queue items.
+
+Encoded content is framed by a magic prefix, followed by a header byte
+identifying its format, so any codec can decode content written by any
+other. Content without the prefix and a known header, such as that
+written without a codec, is returned unchanged.
+
+A codec may be attached to a client (as its `codec` attribute), or passed
+to a C{ZNode}, C{Queue} or C{retry_change}, which default to the client's
+codec.
+
+Decoded node values can be memoized in a C{DecodeCache}, keyed on the
+node's path and modification transaction id (mzxid), so components
+reading the same unchanged node share a single decoded value. A cache may
+be shared by several codecs, and can freeze the values it holds so that
+sharing them is safe.
+"""
+
+from collections import OrderedDict
+import json
+import zlib
+
+from twisted.internet.defer import fail
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import lz4
+except ImportError:  # pragma: no cover
+    lz4 = None
+
+__all__ = ["RawCodec", "JSONCodec", "MsgpackCodec", "ZlibCodec", "LZ4Codec",
+           "CodecError", "DecodeCache", "FrozenDict", "MAGIC", "decode",
+           "freeze", "get_codec", "get_value"]
+
+# The prefix of encoded content, long enough that content written without
+# a codec isn't mistaken for encoded content.
+MAGIC = "\x00txzk:"
+
+# Header byte to decoding function.
+_decoders = {}
+
+
+class CodecError(Exception):
+    """
+    Raised if content can't be encoded or decoded.
+    """
+
+
+def decode(data):
+    """
+    Decode content of any known format, content without the magic prefix
+    and a known header is returned unchanged.
+    """
+    if not data or not data.startswith(MAGIC):
+        return data
+    decoder = _decoders.get(data[len(MAGIC):len(MAGIC) + 1])
+    if decoder is None:
+        return data
+    try:
+        return decoder(data[len(MAGIC) + 1:])
+    except CodecError:
+        raise
+    except Exception, e:
+        raise CodecError("Invalid content %r" % e)
+
+
+def get_codec(client):
+    """Return the codec attached to a client, if any."""
+    return getattr(client, "codec", None)
+
+
+def get_value(client, path, codec=None):
+    """
+    Get the decoded value of a node, memoized by the codec's cache. Returns
+    a deferred with a tuple of the value and the node's stat.
+
+    @param codec: The codec to decode with, defaults to the client's codec.
+    """
+    if codec is None:
+        codec = get_codec(client)
+    if codec is None:
+        return fail(CodecError("No codec for %s" % path))
+
+    d = client.get(path)
+    d.addCallback(
+        lambda (data, stat): (codec.decode_node(path, data, stat), stat))
+    return d
+
+
+class FrozenDict(dict):
+    """
+    An immutable dictionary, the result of freezing a dictionary.
+    """
+
+    def _immutable(self, *args, **kw):
+        raise TypeError("Frozen dictionaries are immutable")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = _immutable
+    setdefault = update = _immutable
+
+    def __hash__(self):
+        return hash(frozenset(self.iteritems()))
+
+
+def freeze(value):
+    """
+    Return an immutable copy of a decoded value, dictionaries are frozen,
+    lists become tuples and sets frozensets.
+    """
+    if isinstance(value, dict):
+        return FrozenDict(
+            (k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze(v) for v in value])
+    if isinstance(value, set):
+        return frozenset([freeze(v) for v in value])
+    return value
+
+
+class DecodeCache(object):
+    """
+    A bounded cache of decoded node values, keyed on the node's path and
+    modification transaction id, and evicted least recently used first.
+
+    Values are shared by all readers of the cache, unless `freeze` is set
+    readers must not modify them. Values whose encoded content is larger
+    than the cache's byte bound aren't cached.
+    """
+
+    def __init__(self, max_size=1024, max_bytes=16 * 1024 * 1024,
+                 freeze=False):
+        """
+        @param max_size: The maximum number of values retained.
+        @param max_bytes: The maximum total size of the encoded content of
+        the retained values.
+        @param freeze: Boolean, freeze values before caching them.
+        """
+        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._freeze = freeze
+        self._values = OrderedDict()
+        self._bytes = 0
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    def clear(self):
+        self._values.clear()
+        self._bytes = 0
+
+    def decode(self, path, data, stat, decoder=decode):
+        """
+        Return the decoded value of a node's content, decoding it only if
+        it isn't cached for the node's current modification.
+        """
+        key = (path, stat["mzxid"], decoder)
+        try:
+            value, size = self._values.pop(key)
+        except KeyError:
+            self.misses += 1
+            value = decoder(data)
+            if self._freeze:
+                value = freeze(value)
+            size = len(data)
+            if size > self._max_bytes:
+                return value
+            self._bytes += size
+            self._evict()
+        else:
+            self.hits += 1
+        self._values[key] = (value, size)
+        return value
+
+    def _evict(self):
+        while self._values and (
+            len(self._values) >= self._max_size or
+            self._bytes > self._max_bytes):
+            value, evicted_size = self._values.popitem(last=False)[1]
+            self._bytes -= evicted_size
+
+
+class Codec(object):
+    """
+    Base class for codecs. If a cache is given, decoded node content is
+    memoized by the node's path and modification transaction id (mzxid),
+    so repeated reads of an unchanged node aren't decoded again.
+    """
+
+    header = None
+
+    def __init__(self, cache=None, cache_size=0):
+        """
+        @param cache: An optional C{DecodeCache}, which may be shared.
+        @param cache_size: The maximum number of decoded node values
+        retained by a cache of the codec's own, if no cache is given.
+        """
+        if cache is None and cache_size:
+            cache = DecodeCache(max_size=cache_size)
+        self._cache = cache
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def encode(self, value):
+        """
+        Encode a value to a string, prefixed with the magic prefix and the
+        format header.
+        """
+        try:
+            return MAGIC + self.header + self._encode(value)
+        except Exception, e:
+            raise CodecError("Can't encode %r: %s" % (value, e))
+
+    def decode(self, data):
+        """Decode content of any known format."""
+        return decode(data)
+
+    def decode_node(self, path, data, stat):
+        """
+        Decode the content of a node, using the cached value if the node
+        hasn't been modified since it was last decoded.
+        """
+        if self._cache is None or stat is None:
+            return self.decode(data)
+        return self._cache.decode(path, data, stat)
+
+    def _encode(self, value):
+        raise NotImplementedError()
+
+    @classmethod
+    def register(cls, decoder):
+        _decoders[cls.header] = decoder
+
+
+class RawCodec(Codec):
+    """Strings stored as is."""
+
+    header = "\x00"
+
+    def _encode(self, value):
+        if not isinstance(value, str):
+            raise TypeError("raw values must be strings")
+        return value
+
+
+class JSONCodec(Codec):
+    """Compact JSON encoding."""
+
+    header = "\x01"
+
+    def _encode(self, value):
+        return json.dumps(value, separators=(",", ":"))
+
+
+class MsgpackCodec(Codec):
+    """Compact binary encoding, requires the msgpack library."""
+
+    header = "\x02"
+
+    def __init__(self, cache=None, cache_size=0):
+        if msgpack is None:
+            raise CodecError("msgpack is not available")
+        super(MsgpackCodec, self).__init__(cache, cache_size)
+
+    def _encode(self, value):
+        return msgpack.packb(value)
+
+
+class ZlibCodec(Codec):
+    """
+    Compresses the encoding of another codec. Encodings smaller than the
+    minimum size are left uncompressed.
+    """
+
+    header = "\x10"
+
+    def __init__(self, codec=None, level=6, min_size=64, cache=None,
+                 cache_size=0):
+        """
+        @param codec: The codec whose encoding is compressed, JSON by
+        default.
+        @param level: The compression level.
+        @param min_size: The minimum size of an encoding to compress.
+        """
+        super(ZlibCodec, self).__init__(cache, cache_size)
+        if codec is None:
+            codec = JSONCodec()
+        self._codec = codec
+        self._level = level
+        self._min_size = min_size
+
+    def encode(self, value):
+        data = self._codec.encode(value)
+        if len(data) < self._min_size:
+            return data
+        return MAGIC + self.header + self._compress(data)
+
+    def _compress(self, data):
+        return zlib.compress(data, self._level)
+
+
+class LZ4Codec(ZlibCodec):
+    """
+    Compresses the encoding of another codec with lz4, requires the lz4
+    library.
+    """
+
+    header = "\x11"
+
+    def __init__(self, codec=None, min_size=64, cache=None, cache_size=0):
+        if lz4 is None:
+            raise CodecError("lz4 is not available")
+        super(LZ4Codec, self).__init__(
+            codec, min_size=min_size, cache=cache, cache_size=cache_size)
+
+    def _compress(self, data):
+        return lz4.compress(data)
+
+
+RawCodec.register(lambda data: data)
+JSONCodec.register(json.loads)
+ZlibCodec.register(lambda data: decode(zlib.decompress(data)))
+
+if msgpack is not None:  # pragma: no cover
+    MsgpackCodec.register(msgpack.unpackb)
+
+if lz4 is not None:  # pragma: no cover
+    LZ4Codec.register(lambda data: decode(lz4.decompress(data)))
@@ -0,0 +1,222 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+A distributed counter, sharded over several nodes.
+
+Increments of a single counter node conflict with each other, and under
+write contention most of them have to be retried. Spreading the count
+over shard nodes, which are incremented independently, divides the
+contention by the number of shards. The counter's value is the sum of
+its shards.
+"""
+
+import logging
+import random
+
+import zookeeper
+
+from twisted.internet.defer import gatherResults, succeed
+
+from txzookeeper.codec import JSONCodec, get_codec
+from txzookeeper.utils import ChangeBatcher
+
+__all__ = ["DistributedCounter"]
+
+log = logging.getLogger("txzk.counter")
+
+
+class DistributedCounter(object):
+    """
+    A counter whose count is sharded over child nodes of its path.
+
+    Each increment is applied to a single shard, with a versioned update.
+    The shard is chosen at random, or with `affinity` always the same
+    one for a counter instance, so that concurrent clients mostly update
+    different shards. Concurrent local increments of a shard are
+    coalesced into a single update.
+    """
+
+    prefix = "shard-"
+
+    def __init__(self, client, path, shards=8, affinity=False, codec=None):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the counter node, created on demand.
+        @param shards: The number of shards, must be the same for all
+        users of the counter.
+        @param affinity: Boolean, increment a single shard chosen at
+        random for this instance.
+        @param codec: The codec of the shards' counts, defaults to the
+        client's codec, or JSON without one. Any codec reads the counts
+        written by any other.
+        """
+        if shards < 1:
+            raise ValueError("A counter requires at least one shard")
+        self._client = client
+        self._path = path
+        self._shards = shards
+        self._shard = None
+        if affinity:
+            self._shard = random.randrange(shards)
+        if codec is None:
+            codec = get_codec(client) or JSONCodec()
+        self._codec = codec
+        self._batcher = ChangeBatcher(client, codec=codec)
+        self._created = False
+        self._watching = False
+        self._generation = 0
+        self._cached = {}
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def shards(self):
+        return self._shards
+
+    @property
+    def cached_value(self):
+        """
+        The counter's value as known by its watches, or None if the
+        counter isn't being watched.
+        """
+        if not self._watching:
+            return None
+        return sum(self._cached.values())
+
+    def _shard_path(self, index):
+        return "%s/%s%04d" % (self._path, self.prefix, index)
+
+    def _create(self):
+        if self._created:
+            return succeed(None)
+
+        def on_created(result):
+            self._created = True
+
+        def on_exists(failure):
+            failure.trap(zookeeper.NodeExistsException)
+            self._created = True
+
+        d = self._client.create(self._path)
+        d.addCallbacks(on_created, on_exists)
+        return d
+
+    def increment(self, amount=1):
+        """
+        Add an amount, which may be negative, to the counter. Returns a
+        deferred that fires once the increment is applied.
+        """
+        index = self._shard
+        if index is None:
+            index = random.randrange(self._shards)
+
+        def add(count, stat):
+            return (count or 0) + amount
+
+        d = self._create()
+        d.addCallback(
+            lambda result: self._batcher.change(self._shard_path(index), add))
+        return d
+
+    def decrement(self, amount=1):
+        """Subtract an amount from the counter."""
+        return self.increment(-amount)
+
+    def _get_shard(self, index):
+        path = self._shard_path(index)
+
+        def on_shard((data, stat)):
+            return self._codec.decode_node(path, data, stat) or 0
+
+        d = self._client.get(path)
+        d.addCallbacks(on_shard, self._on_no_shard)
+        return d
+
+    def _on_no_shard(self, failure):
+        failure.trap(zookeeper.NoNodeException)
+        return 0
+
+    def get_value(self):
+        """
+        Get the counter's value, the shards are retrieved with pipelined
+        requests. Returns a deferred with the value.
+        """
+        d = gatherResults(
+            [self._get_shard(i) for i in range(self._shards)])
+        d.addCallback(sum)
+        return d
+
+    def watch(self):
+        """
+        Maintain the counter's value in `cached_value`, kept current by
+        watches on the shards. Returns a deferred with the value.
+        """
+        if self._watching:
+            return succeed(self.cached_value)
+        self._watching = True
+        generation = self._generation
+        d = gatherResults(
+            [self._watch_shard(i, generation) for i in range(self._shards)])
+        d.addCallback(lambda results: self.cached_value)
+        return d
+
+    def stop_watching(self):
+        """Stop maintaining the cached value."""
+        self._watching = False
+        # The watches set so far are ignored once they fire, watching
+        # again sets new ones.
+        self._generation += 1
+        self._cached.clear()
+
+    def _watch_shard(self, index, generation):
+        if generation != self._generation:
+            return
+
+        # An exists watch also fires on modification, and unlike a get
+        # watch it's set on a shard which doesn't exist yet.
+        exists_d, watch_d = self._client.exists_and_watch(
+            self._shard_path(index))
+        watch_d.addCallbacks(
+            lambda event: self._watch_shard(index, generation),
+            self._on_watch_error, errbackArgs=(generation,))
+
+        def on_exists(stat):
+            if stat is None:
+                return 0
+            return self._get_shard(index)
+
+        def on_value(count):
+            if generation == self._generation:
+                self._cached[index] = count
+
+        exists_d.addCallback(on_exists)
+        exists_d.addCallback(on_value)
+        return exists_d
+
+    def _on_watch_error(self, failure, generation):
+        if generation == self._generation:
+            log.warning("Counter %s watch failed, %s",
+                        self._path, failure.value)
+            self.stop_watching()
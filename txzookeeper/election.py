@@ -0,0 +1,392 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Leader election, based on the apache zookeeper recipe.
+
+Each participant creates an ephemeral sequence candidate node holding its
+identifier, the candidate with the lowest sequence number is the leader.
+Each follower watches the candidate immediately before its own, so the
+leader's departure notifies only its successor, which confirms its
+election with a single listing of the candidates. The other followers
+aren't notified of a new leader, `get_leader` retrieves it.
+
+http://zookeeper.apache.org/doc/r3.3.0/recipes.html#sc_leaderElection
+"""
+
+import logging
+
+import zookeeper
+
+from twisted.internet.defer import fail, maybeDeferred, succeed
+
+__all__ = ["LeaderElection", "ElectionError"]
+
+log = logging.getLogger("txzk.election")
+
+
+class ElectionError(Exception):
+    """
+    Raised on misuse of an election.
+    """
+
+
+class LeaderElection(object):
+    """
+    A participant in a leader election.
+
+    The `on_elected` and `on_demoted` callbacks are invoked with the
+    election when this participant gains and loses leadership. The
+    identifier of the leader is cached in `leader`, as of the last time
+    this participant checked its standing, which is on its predecessor's
+    departure. Only the leader's successor watches the leader's
+    candidate, the current leader is retrieved with `get_leader`.
+
+    Leadership can't be asserted without a connection, the leader is
+    demoted as soon as its client is disconnected, and reelected on
+    reconnecting if its session survived. Leadership is lost with the
+    participant's session. With a C{SessionClient}, the participant
+    stands again as a candidate once a new session is established.
+    """
+
+    prefix = "candidate-"
+
+    def __init__(self, client, path, identifier, on_elected=None,
+                 on_demoted=None):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the election node, created on demand.
+        @param identifier: A string identifying this participant, stored
+        in its candidate node.
+        @param on_elected: A callable invoked with the election when this
+        participant becomes the leader.
+        @param on_demoted: A callable invoked with the election when this
+        participant stops being the leader.
+        """
+        self._client = client
+        self._path = path
+        self._identifier = identifier
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._joined = False
+        self._candidate_path = None
+        self._is_leader = False
+        self._leader = None
+        self._leader_name = None
+        self._watching = set()
+        self._session_d = None
+        self._suspended = False
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def identifier(self):
+        return self._identifier
+
+    @property
+    def candidate_path(self):
+        """The path of this participant's candidate node, if any."""
+        return self._candidate_path
+
+    @property
+    def is_leader(self):
+        """Is this participant the leader. Returns a boolean"""
+        return self._is_leader
+
+    @property
+    def leader(self):
+        """
+        The identifier of the leader, as of this participant's last view
+        of the election, or None if unknown. The leader's successor keeps
+        it current, other followers may lag behind `get_leader`.
+        """
+        return self._leader
+
+    def join(self):
+        """
+        Stand as a candidate in the election. Returns a deferred which
+        fires once the candidate is registered and its standing checked.
+        """
+        if self._joined:
+            return fail(ElectionError(
+                "Already joined the election %s" % self.path))
+        self._joined = True
+        self._client.add_session_listener(self._on_session_event)
+        self._subscribe_session()
+
+        def on_error(failure):
+            self._joined = False
+            self._session_d = None
+            self._client.remove_session_listener(self._on_session_event)
+            return failure
+
+        d = self._create_parent()
+        d.addCallback(lambda result: self._create_candidate())
+        d.addCallbacks(lambda result: self, on_error)
+        return d
+
+    def leave(self):
+        """
+        Withdraw from the election, surrendering leadership if held.
+        """
+        if not self._joined:
+            return fail(ElectionError(
+                "Not joined the election %s" % self.path))
+        self._joined = False
+        self._session_d = None
+        self._suspended = False
+        self._client.remove_session_listener(self._on_session_event)
+        candidate = self._candidate_path
+        self._reset()
+        self._demote()
+        if candidate is None:
+            return succeed(None)
+
+        d = self._client.delete(candidate)
+        d.addErrback(lambda failure: failure.trap(zookeeper.NoNodeException))
+        return d
+
+    def get_leader(self):
+        """
+        Retrieve the identifier of the current leader from zookeeper.
+        Returns a deferred with the identifier, or None if there's no
+        leader.
+        """
+        d = self._client.get_children(self.path)
+
+        def on_children(children):
+            children = self._sort(children)
+            if not children:
+                return None
+            d = self._client.get("/".join((self.path, children[0])))
+            d.addCallbacks(lambda (data, stat): data, self._on_no_leader)
+            return d
+
+        d.addCallback(on_children)
+        return d
+
+    def _on_no_leader(self, failure):
+        # The leader left while retrieving it, retry.
+        failure.trap(zookeeper.NoNodeException)
+        return self.get_leader()
+
+    def _sort(self, children):
+        return sorted(
+            [name for name in children if name.startswith(self.prefix)],
+            key=lambda name: name[-10:])
+
+    def _subscribe_session(self):
+        subscribe = getattr(self._client, "subscribe_new_session", None)
+        if subscribe is None:
+            return
+        d = self._session_d = subscribe()
+        d.addCallback(self._on_new_session, d)
+
+    def _on_session_event(self, client, event):
+        state = event.connection_state
+        if state == zookeeper.CONNECTED_STATE:
+            # Session events are repeated for each watch, check once.
+            if self._suspended:
+                self._suspended = False
+                if self._candidate_path is not None:
+                    self._check(self._candidate_path)
+            return
+        # Without a connection, another participant may be elected once
+        # our session expires, step down till we know better.
+        self._suspended = state == zookeeper.CONNECTING_STATE
+        if self._is_leader:
+            self._leader = None
+            self._leader_name = None
+        self._demote()
+
+    def _on_new_session(self, result, session_d):
+        if self._session_d is not session_d:
+            return
+        # Our candidate expired with the previous session, any election
+        # we won is over.
+        self._reset()
+        self._demote()
+        self._subscribe_session()
+        d = self._create_candidate()
+        d.addErrback(self._on_error, None)
+
+    def _create_parent(self):
+        d = self._client.create(self.path)
+        d.addErrback(
+            lambda failure: failure.trap(zookeeper.NodeExistsException))
+        return d
+
+    def _create_candidate(self):
+        d = self._client.create(
+            "/".join((self.path, self.prefix)), self._identifier,
+            flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+        d.addCallback(self._on_candidate_create)
+        return d
+
+    def _on_candidate_create(self, path):
+        if not self._joined:
+            # The election was left while creating the candidate.
+            return self._client.delete(path)
+        self._candidate_path = path
+        return self._check(path)
+
+    def _check(self, candidate):
+        if self._candidate_path != candidate:
+            return
+        d = self._client.get_children(self.path)
+        d.addCallback(self._check_candidates, candidate)
+        d.addErrback(self._on_error, candidate)
+        return d
+
+    def _check_candidates(self, children, candidate):
+        if self._candidate_path != candidate:
+            return
+        children = self._sort(children)
+        name = candidate[candidate.rfind("/") + 1:]
+        if name not in children:
+            # Our candidate is gone with our session, or was removed.
+            self._reset()
+            self._demote()
+            return
+        index = children.index(name)
+
+        if index == 0:
+            self._leader = self._identifier
+            self._leader_name = name
+            # Watch our own candidate, to learn of its removal.
+            self._watch(candidate, name)
+            self._elect()
+            return
+
+        self._demote()
+        leader = children[0]
+        if leader != self._leader_name:
+            self._leader_name = leader
+            self._leader = None
+        if index == 1:
+            if leader not in self._watching:
+                return self._watch_leader(candidate, leader)
+            return
+        # Only our predecessor is watched, so the leader's departure
+        # notifies only its successor.
+        self._watch(candidate, children[index - 1])
+        if self._leader is None:
+            return self._fetch_leader(candidate, leader)
+
+    def _watch(self, candidate, name):
+        if name in self._watching:
+            return
+        self._watching.add(name)
+        exists_d, watch_d = self._client.exists_and_watch(
+            "/".join((self.path, name)))
+
+        def on_exists(stat):
+            if stat is None:
+                return self._on_change(None, candidate, name)
+            watch_d.addCallbacks(
+                self._on_change, self._on_error,
+                callbackArgs=(candidate, name), errbackArgs=(candidate,))
+
+        exists_d.addCallbacks(on_exists, self._on_error,
+                              errbackArgs=(candidate,))
+
+    def _watch_leader(self, candidate, name):
+        # The leader's data is retrieved with its watch, which also serves
+        # as the predecessor watch of the leader's successor.
+        self._watching.add(name)
+        get_d, watch_d = self._client.get_and_watch(
+            "/".join((self.path, name)))
+
+        def on_get((data, stat)):
+            if self._candidate_path == candidate and self._leader_name == name:
+                self._leader = data
+            watch_d.addCallbacks(
+                self._on_change, self._on_error,
+                callbackArgs=(candidate, name), errbackArgs=(candidate,))
+
+        def on_no_node(failure):
+            failure.trap(zookeeper.NoNodeException)
+            return self._on_change(None, candidate, name)
+
+        get_d.addCallbacks(on_get, on_no_node)
+        get_d.addErrback(self._on_error, candidate)
+        return get_d
+
+    def _fetch_leader(self, candidate, name):
+        d = self._client.get("/".join((self.path, name)))
+
+        def on_get((data, stat)):
+            if self._candidate_path == candidate and self._leader_name == name:
+                self._leader = data
+
+        def on_no_node(failure):
+            # Left already, our predecessor's departure leads to the next
+            # check.
+            failure.trap(zookeeper.NoNodeException)
+
+        d.addCallbacks(on_get, on_no_node)
+        d.addErrback(self._on_error, candidate)
+        return d
+
+    def _on_change(self, event, candidate, name):
+        if self._candidate_path != candidate:
+            return
+        self._watching.discard(name)
+        if name == self._leader_name:
+            self._leader_name = None
+            self._leader = None
+        return self._check(candidate)
+
+    def _on_error(self, failure, candidate):
+        if candidate is not None and self._candidate_path != candidate:
+            return
+        log.warning("Election %s failed, %s", self.path, failure.value)
+        self._reset()
+        self._demote()
+
+    def _reset(self):
+        self._candidate_path = None
+        self._leader = None
+        self._leader_name = None
+        self._watching.clear()
+
+    def _elect(self):
+        if self._is_leader:
+            return
+        self._is_leader = True
+        self._notify(self._on_elected)
+
+    def _demote(self):
+        if not self._is_leader:
+            return
+        self._is_leader = False
+        self._notify(self._on_demoted)
+
+    def _notify(self, callback):
+        if callback is None:
+            return
+        d = maybeDeferred(callback, self)
+        d.addErrback(lambda failure: log.error(
+            "Election %s callback failed\n%s",
+            self.path, failure.getTraceback()))
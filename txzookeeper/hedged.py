@@ -0,0 +1,265 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Hedged reads across a pool of sessions.
+
+A read that hasn't completed on the primary session within a latency
+percentile of recent reads is issued again on another session, connected
+to a different server, and the first reply is used. This bounds the tail
+latency added by a slow or paused server.
+
+Replies from the other sessions may lag behind the primary session's
+writes, as with any read served by a different server.
+"""
+
+from collections import deque
+
+from twisted.internet.defer import Deferred, gatherResults
+from twisted.python.failure import Failure
+
+from txzookeeper.metrics import get_metrics
+from txzookeeper.retry import RetryBudget, is_retryable
+
+__all__ = ["HedgedClient"]
+
+
+class HedgedRead(object):
+    """
+    A read issued on a primary session, and possibly hedged on a second.
+    """
+
+    def __init__(self, pool, op, args):
+        self._pool = pool
+        self._op = op
+        self._args = args
+        self._pending = 0
+        self._hedge_call = None
+        self.deferred = Deferred()
+
+    def start(self, delay):
+        pool = self._pool
+        started = pool._clock.seconds()
+
+        def record_latency(result):
+            pool._record_latency(pool._clock.seconds() - started)
+            return result
+
+        d = self._issue(pool.primary)
+        d.addBoth(record_latency)
+        d.addBoth(self._on_reply, False)
+        if not self.deferred.called:
+            self._hedge_call = pool._clock.callLater(delay, self._hedge)
+        return self.deferred
+
+    def _issue(self, client):
+        self._pending += 1
+        return getattr(client, self._op)(*self._args)
+
+    def _hedge(self):
+        self._hedge_call = None
+        pool = self._pool
+        client = pool._next_hedge_client()
+        if client is None:
+            return
+        if not pool.budget.withdraw():
+            pool._increment("hedge.capped", op=self._op)
+            return
+        pool._increment("hedge.issued", op=self._op)
+        self._issue(client).addBoth(self._on_reply, True)
+
+    def _on_reply(self, result, hedged):
+        self._pending -= 1
+        if self.deferred.called:
+            return
+        # A connection error isn't a reply, wait for the other read.
+        if (isinstance(result, Failure) and is_retryable(result.value) and
+            self._pending):
+            return
+        if self._hedge_call is not None:
+            self._hedge_call.cancel()
+            self._hedge_call = None
+        if hedged:
+            self._pool._increment("hedge.won", op=self._op)
+        self.deferred.callback(result)
+
+
+class HedgedClient(object):
+    """
+    A client over a pool of sessions, which hedges reads.
+
+    Reads (get, exists, get_children, get_acl) are issued on the primary
+    session, the first of the pool. If one doesn't complete within the
+    given percentile of recent read latencies, it's issued again on
+    another connected session, chosen round robin. Writes and watches
+    use the primary session.
+
+    Hedges are capped to a ratio of reads by a token bucket. The metrics
+    hook counts hedges issued, won and refused by the cap, as
+    `hedge.issued`, `hedge.won` and `hedge.capped` per operation, and
+    observe primary read latencies as `hedge.read_latency`.
+    """
+
+    def __init__(self, clients, percentile=0.95, min_delay=0.005,
+                 max_delay=1.0, initial_delay=0.05, max_hedge_ratio=0.05,
+                 window=1000, metrics=None, clock=None):
+        """
+        @param clients: A list of C{ZookeeperClient} instances, each
+        connected to a different server, the first is the primary.
+        @param percentile: The read latency percentile after which a read
+        is hedged.
+        @param min_delay: The minimum delay before hedging, in seconds.
+        @param max_delay: The maximum delay before hedging, in seconds.
+        @param initial_delay: The delay before hedging until enough
+        latencies are sampled.
+        @param max_hedge_ratio: The maximum ratio of hedged reads.
+        @param window: The number of recent latencies sampled.
+        @param metrics: The metrics hook, defaults to the primary's.
+        @param clock: An IReactorTime provider, defaults to the reactor.
+        """
+        if not clients:
+            raise ValueError("At least one client is required")
+        if clock is None:
+            from twisted.internet import reactor as clock
+        if metrics is None:
+            metrics = get_metrics(clients[0])
+        self._clients = list(clients)
+        self._percentile = percentile
+        self._min_delay = min_delay
+        self._max_delay = max_delay
+        self._delay = initial_delay
+        self._samples = deque(maxlen=window)
+        self._sampled = 0
+        self._next = 0
+        self._clock = clock
+        self.metrics = metrics
+        self.budget = RetryBudget(
+            ratio=max_hedge_ratio, min_per_second=0, max_tokens=10)
+
+    @property
+    def clients(self):
+        return list(self._clients)
+
+    @property
+    def primary(self):
+        return self._clients[0]
+
+    @property
+    def hedge_delay(self):
+        """The current delay before a read is hedged, in seconds."""
+        return self._delay
+
+    def _increment(self, name, **tags):
+        if self.metrics is not None:
+            self.metrics.increment(name, **tags)
+
+    def _record_latency(self, latency):
+        if self.metrics is not None:
+            self.metrics.observe("hedge.read_latency", latency)
+        self._samples.append(latency)
+        self._sampled += 1
+        # Sorting the window per read would be wasteful, the threshold
+        # is recomputed periodically.
+        if self._sampled % 50 or len(self._samples) < 20:
+            return
+        samples = sorted(self._samples)
+        delay = samples[int(self._percentile * (len(samples) - 1))]
+        self._delay = min(max(delay, self._min_delay), self._max_delay)
+
+    def _next_hedge_client(self):
+        others = self._clients[1:]
+        for i in range(len(others)):
+            client = others[(self._next + i) % len(others)]
+            if client.connected:
+                self._next = (self._next + i + 1) % len(others)
+                return client
+
+    def _read(self, op, *args):
+        self.budget.deposit()
+        return HedgedRead(self, op, args).start(self._delay)
+
+    def connect(self, timeout=10):
+        """Connect all the sessions of the pool."""
+        d = gatherResults(
+            [client.connect(timeout=timeout) for client in self._clients])
+        d.addCallback(lambda clients: self)
+        return d
+
+    def close(self):
+        return gatherResults([client.close() for client in self._clients
+                              if client.connected])
+
+    def add_auth(self, scheme, identity):
+        return gatherResults([client.add_auth(scheme, identity)
+                              for client in self._clients])
+
+    # Hedged reads
+
+    def get(self, path):
+        return self._read("get", path)
+
+    def exists(self, path):
+        return self._read("exists", path)
+
+    def get_children(self, path):
+        return self._read("get_children", path)
+
+    def get_acl(self, path):
+        return self._read("get_acl", path)
+
+    # Primary session operations
+
+    def create(self, *args, **kw):
+        return self.primary.create(*args, **kw)
+
+    def delete(self, *args, **kw):
+        return self.primary.delete(*args, **kw)
+
+    def set(self, *args, **kw):
+        return self.primary.set(*args, **kw)
+
+    def set_acl(self, *args, **kw):
+        return self.primary.set_acl(*args, **kw)
+
+    def sync(self, *args, **kw):
+        return self.primary.sync(*args, **kw)
+
+    def exists_and_watch(self, *args, **kw):
+        return self.primary.exists_and_watch(*args, **kw)
+
+    def get_and_watch(self, *args, **kw):
+        return self.primary.get_and_watch(*args, **kw)
+
+    def get_children_and_watch(self, *args, **kw):
+        return self.primary.get_children_and_watch(*args, **kw)
+
+    @property
+    def connected(self):
+        return self.primary.connected
+
+    @property
+    def session_timeout(self):
+        return self.primary.session_timeout
+
+    @property
+    def codec(self):
+        return getattr(self.primary, "codec", None)
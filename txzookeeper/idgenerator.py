@@ -0,0 +1,205 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Unique id generation, with blocks of ids reserved from a counter node.
+
+A sequence node per id costs a write per id. Instead, a generator
+reserves a block of ids with a single versioned update of a counter
+node, holding the next unreserved id, and hands out the block's ids
+locally.
+"""
+
+import logging
+
+import zookeeper
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
+
+from txzookeeper.metrics import get_metrics
+from txzookeeper.retry import Backoff, sleep
+
+__all__ = ["IdGenerator"]
+
+log = logging.getLogger("txzk.idgenerator")
+
+
+class IdGenerator(object):
+    """
+    A generator of ids unique among all the generators of a counter node.
+
+    Ids are non-negative integers, increasing for a generator, but not
+    ordered across generators. The ids of a block left unused, when the
+    generator is discarded, are skipped.
+
+    The next block is reserved in the background once the ids left in
+    the current block fall to the `prefetch` ratio of a block, so that
+    ids are usually handed out without waiting on zookeeper. The metrics
+    hook counts reserved blocks and version conflicts as
+    `idgenerator.blocks` and `idgenerator.conflicts`, per path.
+    """
+
+    def __init__(self, client, path, block_size=1000, prefetch=0.2,
+                 backoff=None, metrics=None):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the counter node, created on demand, its
+        parent must exist.
+        @param block_size: The number of ids reserved at once.
+        @param prefetch: The ratio of a block left, at which the next block
+        is reserved.
+        @param backoff: The Backoff policy for delaying retries on version
+        conflicts.
+        @param metrics: The metrics hook, defaults to the client's.
+        """
+        if block_size < 1:
+            raise ValueError("The block size must be at least one")
+        if backoff is None:
+            backoff = Backoff(base=0.01, max_delay=1)
+        if metrics is None:
+            metrics = get_metrics(client)
+        self._client = client
+        self._path = path
+        self._block_size = block_size
+        self._threshold = int(block_size * prefetch)
+        self._backoff = backoff
+        self._metrics = metrics
+        self._next = self._end = 0
+        self._next_block = None
+        self._reserving = False
+        self._waiters = []
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def block_size(self):
+        return self._block_size
+
+    @property
+    def remaining(self):
+        """The number of ids reserved and not handed out yet."""
+        remaining = self._end - self._next
+        if self._next_block is not None:
+            remaining += self._next_block[1] - self._next_block[0]
+        return remaining
+
+    def next_id(self):
+        """
+        Return a deferred with a new id.
+        """
+        if not self._waiters:
+            id = self._take()
+            if id is not None:
+                self._prefetch()
+                return succeed(id)
+        d = Deferred()
+        self._waiters.append(d)
+        self._reserve_block()
+        return d
+
+    def _take(self):
+        if self._next >= self._end:
+            if self._next_block is None:
+                return None
+            (self._next, self._end), self._next_block = self._next_block, None
+        id = self._next
+        self._next += 1
+        return id
+
+    def _prefetch(self):
+        if self.remaining <= self._threshold:
+            self._reserve_block()
+
+    def _reserve_block(self):
+        if self._reserving or self._next_block is not None:
+            return
+        self._reserving = True
+        d = self._reserve()
+        d.addCallbacks(self._on_block, self._on_reserve_error)
+
+    def _on_block(self, start):
+        self._reserving = False
+        self._next_block = (start, start + self._block_size)
+        while self._waiters:
+            id = self._take()
+            if id is None:
+                # Waiters exhausted the block.
+                self._reserve_block()
+                return
+            self._waiters.pop(0).callback(id)
+        self._prefetch()
+
+    def _on_reserve_error(self, failure):
+        self._reserving = False
+        waiters, self._waiters = self._waiters, []
+        if not waiters:
+            log.warning("Id block reservation %s failed, %s",
+                        self._path, failure.value)
+        for d in waiters:
+            d.errback(failure)
+
+    def _increment(self, name):
+        if self._metrics is not None:
+            self._metrics.increment(name, path=self._path)
+
+    @inlineCallbacks
+    def _reserve(self):
+        """
+        Reserve a block, advancing the counter with a versioned update.
+        Returns a deferred with the block's first id.
+        """
+        attempt = 0
+        delay = None
+        while True:
+            try:
+                content, stat = yield self._client.get(self._path)
+            except zookeeper.NoNodeException:
+                start, stat = 0, None
+            else:
+                start = int(content or 0)
+
+            end = str(start + self._block_size)
+            try:
+                if stat is None:
+                    yield self._client.create(self._path, end)
+                else:
+                    yield self._client.set(
+                        self._path, end, version=stat["version"])
+            except (zookeeper.NodeExistsException,
+                    zookeeper.BadVersionException):
+                pass
+            except zookeeper.NoNodeException:
+                # The counter node was deleted since it was read, unless
+                # it was being created, its parent is missing.
+                if stat is None:
+                    raise
+            else:
+                self._increment("idgenerator.blocks")
+                returnValue(start)
+
+            self._increment("idgenerator.conflicts")
+            delay = self._backoff.get_delay(attempt, delay)
+            attempt += 1
+            yield sleep(delay)
@@ -20,8 +20,12 @@
 #  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time
+
 import zookeeper
-from twisted.internet.defer import fail
+from twisted.internet.defer import fail, Deferred
+
+from txzookeeper.metrics import get_metrics
 
 
 class LockError(Exception):
@@ -30,20 +34,74 @@ class LockError(Exception):
     """
 
 
+class LockTimeout(LockError):
+    """
+    The lock couldn't be acquired within the allotted time.
+    """
+
+
+class LockStats(object):
+    """
+    Wait time statistics of a lock's acquisitions, times in seconds.
+    """
+
+    __slots__ = ("acquisitions", "timeouts", "cancellations", "last_wait",
+                 "total_wait", "max_wait")
+
+    def __init__(self):
+        self.acquisitions = self.timeouts = self.cancellations = 0
+        self.last_wait = self.total_wait = self.max_wait = 0.0
+
+    @property
+    def mean_wait(self):
+        if not self.acquisitions:
+            return 0.0
+        return self.total_wait / self.acquisitions
+
+    def record_wait(self, wait):
+        self.acquisitions += 1
+        self.last_wait = wait
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+
 class Lock(object):
     """
     A distributed exclusive lock, based on the apache zookeeper recipe.
 
+    The metrics hook observes the wait for each acquisition and how long
+    the lock was held, as `lock.wait` and `lock.hold`, and the queue
+    position of waiting candidates as `lock.position`. Acquisitions which
+    had to wait, timeouts and cancellations are counted as
+    `lock.contended`, `lock.timeouts` and `lock.cancellations`. All are
+    tagged by the lock's path.
+
     http://hadoop.apache.org/zookeeper/docs/r3.3.0/recipes.html
     """
 
     prefix = "lock-"
 
-    def __init__(self, path, client):
+    def __init__(self, path, client, metrics=None):
+        """
+        @param path: The path of the lock's directory.
+        @param client: A connected C{ZookeeperClient} instance.
+        @param metrics: The metrics hook, defaults to the client's.
+        """
+        if metrics is None:
+            metrics = get_metrics(client)
         self._path = path
         self._client = client
+        self._metrics = metrics
         self._candidate_path = None
         self._acquired = False
+        self._acquiring = None
+        self._blocking = True
+        self._timeout_call = None
+        self._wait_start = None
+        self._acquired_at = None
+        self._contended = False
+        self._position = None
+        self._stats = LockStats()
 
     @property
     def path(self):
@@ -55,8 +113,39 @@ class Lock(object):
         """Has the lock been acquired. Returns a boolean"""
         return self._acquired
 
-    def acquire(self):
-        """Acquire the lock."""
+    @property
+    def stats(self):
+        """The wait time statistics of the lock's acquisitions."""
+        return self._stats
+
+    @property
+    def position(self):
+        """
+        The number of candidates queued ahead of ours as of its last check,
+        zero once the lock is held, or None without a candidate.
+        """
+        return self._position
+
+    def _increment(self, name):
+        if self._metrics is not None:
+            self._metrics.increment(name, path=self.path)
+
+    def _observe(self, name, value):
+        if self._metrics is not None:
+            self._metrics.observe(name, value, path=self.path)
+
+    def acquire(self, timeout=None, blocking=True):
+        """Acquire the lock.
+
+        An abandoned attempt, on timeout, when not blocking or if the
+        returned deferred is cancelled, removes its candidate node.
+
+        @param timeout: The maximum time to wait for the lock, in seconds,
+        after which the attempt fails with a C{LockTimeout}.
+
+        @param blocking: Boolean, if false the attempt fails with a
+        C{LockTimeout} unless the lock is available immediately.
+        """
 
         if self._acquired:
             error = LockError("Already holding the lock %s" % (self.path))
@@ -67,69 +156,161 @@ class Lock(object):
             return fail(error)
 
         self._candidate_path = ""
+        self._blocking = blocking
+        self._contended = False
+        self._wait_start = time.time()
+        attempt = self._acquiring = Deferred(self._on_cancel)
+        if timeout is not None:
+            from twisted.internet import reactor
+            self._timeout_call = reactor.callLater(
+                timeout, self._on_timeout, attempt)
 
         # Create our candidate node in the lock directory.
         d = self._client.create(
             "/".join((self.path, self.prefix)),
             flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
 
-        d.addCallback(self._on_candidate_create)
-        d.addErrback(self._on_no_queue_error)
-        return d
+        d.addCallback(self._on_candidate_create, attempt)
+        d.addCallbacks(self._on_acquired, self._on_acquire_error,
+                       callbackArgs=(attempt,), errbackArgs=(attempt,))
+        return attempt
 
-    def _on_candidate_create(self, path):
+    def _on_candidate_create(self, path, attempt):
+        if self._acquiring is not attempt:
+            # The attempt was abandoned while creating the candidate.
+            self._delete_candidate(path)
+            return
         self._candidate_path = path
-        return self._acquire()
+        return self._acquire(attempt)
+
+    def _on_acquired(self, result, attempt):
+        if self._acquiring is not attempt:
+            return
+        self._cancel_timeout()
+        self._acquiring = None
+        self._acquired_at = time.time()
+        wait = self._acquired_at - self._wait_start
+        self._stats.record_wait(wait)
+        self._observe("lock.wait", wait)
+        if self._contended:
+            self._increment("lock.contended")
+        attempt.callback(self)
+
+    def _on_acquire_error(self, failure, attempt):
+        if self._acquiring is not attempt:
+            return
+        self._abandon()
+        attempt.errback(failure)
+
+    def _on_timeout(self, attempt):
+        self._timeout_call = None
+        if self._acquiring is not attempt:
+            return
+        self._stats.timeouts += 1
+        self._increment("lock.timeouts")
+        self._abandon()
+        attempt.errback(
+            LockTimeout("Timed out acquiring the lock %s" % self.path))
 
-    def _on_no_queue_error(self, failure):
+    def _on_cancel(self, attempt):
+        if self._acquiring is not attempt:
+            return
+        self._stats.cancellations += 1
+        self._increment("lock.cancellations")
+        self._abandon()
+
+    def _cancel_timeout(self):
+        if self._timeout_call is not None:
+            self._timeout_call.cancel()
+            self._timeout_call = None
+
+    def _abandon(self):
+        """
+        Abandon an acquisition attempt, removing its candidate node.
+        """
+        self._cancel_timeout()
+        self._acquiring = None
+        candidate = self._candidate_path
         self._candidate_path = None
-        return failure
+        self._acquired = False
+        self._position = None
+        if candidate:
+            self._delete_candidate(candidate)
+
+    def _delete_candidate(self, path):
+        d = self._client.delete(path)
+        d.addErrback(lambda failure: None)
+        return d
 
-    def _acquire(self, *args):
+    def _acquire(self, attempt):
+        if self._acquiring is not attempt:
+            # The attempt was abandoned while waiting, a watch set by an
+            # abandoned attempt may fire during a later one.
+            return
         d = self._client.get_children(self.path)
-        d.addCallback(self._check_candidate_nodes)
-        d.addErrback(self._on_no_queue_error)
+        d.addCallback(self._check_candidate_nodes, attempt)
         return d
 
-    def _check_candidate_nodes(self, children):
+    def _check_candidate_nodes(self, children, attempt):
         """
         Check if our lock attempt candidate path is the best candidate
         among the list of children names. If it is then we hold the lock
         if its not then watch the nearest candidate till it is.
         """
+        if self._acquiring is not attempt:
+            return
         candidate_name = self._candidate_path[
             self._candidate_path.rfind('/') + 1:]
 
-        # Check to see if our node is the first candidate in the list.
-        children.sort()
+        # Order the candidates by their sequence number.
+        children.sort(key=lambda name: name[-10:])
         assert candidate_name in children
         index = children.index(candidate_name)
+        previous = self._get_predecessor(children, index)
 
-        if index == 0:
-            # If our candidate is first, then we already have the lock.
+        self._position = index
+        if previous is None:
+            self._position = 0
+            # If no candidate blocks ours, then we already have the lock.
             self._acquired = True
             return self
 
-        # If someone else holds the lock, then wait until holder immediately
-        # before us releases the lock or dies.
-        previous_path = "/".join((self.path, children[index - 1]))
+        # If someone else holds the lock, then wait until the blocking
+        # holder immediately before us releases the lock or dies.
+        previous_path = "/".join((self.path, previous))
         exists_deferred, watch_deferred = self._client.exists_and_watch(
             previous_path)
         exists_deferred.addCallback(
             self._check_previous_owner_existence,
-            watch_deferred)
+            watch_deferred, attempt)
         return exists_deferred
 
+    def _get_predecessor(self, children, index):
+        """
+        Return the name of the candidate before ours that blocks our
+        acquisition, or None if there is none.
+        """
+        if index == 0:
+            return None
+        return children[index - 1]
+
     def _check_previous_owner_existence(self, previous_owner_exists,
-                                        watch_deferred):
+                                        watch_deferred, attempt):
+        if self._acquiring is not attempt:
+            return
         if not previous_owner_exists:
             # Hah! It's actually already dead!  That was quick.  Note
             # how we never use the watch deferred in this case.
-            return self._acquire()
+            return self._acquire(attempt)
+        elif not self._blocking:
+            self._increment("lock.contended")
+            raise LockTimeout("Lock %s is held" % self.path)
         else:
             # Nope, there's someone ahead of us in the queue indeed. Let's
             # wait for the watch to detect it went away.
-            watch_deferred.addCallback(self._acquire)
+            self._contended = True
+            self._observe("lock.position", self._position)
+            watch_deferred.addCallback(lambda event: self._acquire(attempt))
             return watch_deferred
 
     def release(self):
@@ -142,9 +323,73 @@ class Lock(object):
         d = self._client.delete(self._candidate_path)
 
         def on_delete_success(value):
+            self._observe("lock.hold", time.time() - self._acquired_at)
             self._candidate_path = None
             self._acquired = False
+            self._position = None
             return True
 
         d.addCallback(on_delete_success)
         return d
+
+
+class ReadLock(Lock):
+    """
+    The shared side of a read/write lock, held concurrently by readers.
+    """
+
+    prefix = "read-"
+
+    def _get_predecessor(self, children, index):
+        # Readers are only blocked by the closest preceding writer.
+        for name in reversed(children[:index]):
+            if name.startswith(WriteLock.prefix):
+                return name
+
+
+class WriteLock(Lock):
+    """
+    The exclusive side of a read/write lock.
+    """
+
+    prefix = "write-"
+
+    def _get_predecessor(self, children, index):
+        # Writers are blocked by the closest preceding reader or writer.
+        for name in reversed(children[:index]):
+            if name.startswith((ReadLock.prefix, WriteLock.prefix)):
+                return name
+
+
+class ReadWriteLock(object):
+    """
+    A distributed read/write lock, based on the apache zookeeper shared
+    lock recipe.
+
+    Readers hold the lock concurrently, writers exclusively. Each waiter
+    watches only the single candidate that blocks it, the closest
+    preceding writer for a reader, and the closest preceding candidate
+    for a writer.
+
+    http://zookeeper.apache.org/doc/r3.3.0/recipes.html#Shared+Locks
+    """
+
+    def __init__(self, path, client, metrics=None):
+        self._path = path
+        self._read_lock = ReadLock(path, client, metrics)
+        self._write_lock = WriteLock(path, client, metrics)
+
+    @property
+    def path(self):
+        """Return the path to the lock."""
+        return self._path
+
+    @property
+    def read_lock(self):
+        """The shared lock for readers."""
+        return self._read_lock
+
+    @property
+    def write_lock(self):
+        """The exclusive lock for writers."""
+        return self._write_lock
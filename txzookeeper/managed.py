@@ -144,10 +144,12 @@ class SessionClient(ZookeeperClient):
     """
 
     def __init__(
-        self, servers=None, session_timeout=None, connect_timeout=4000):
+        self, servers=None, session_timeout=None, connect_timeout=4000,
+        codec=None, compact_stat=False, metrics=None):
         """
         """
-        super(SessionClient, self).__init__(servers, session_timeout)
+        super(SessionClient, self).__init__(
+            servers, session_timeout, codec, compact_stat, metrics)
         self._connect_timeout = connect_timeout
         self._watches = WatchManager()
         self._ephemerals = {}
@@ -291,9 +293,8 @@ class SessionClient(ZookeeperClient):
             d.addErrback(self._cb_restablish_errback)
             return d
         if event_type == zookeeper.SESSION_EVENT:
-            if self._session_event_callback:
-                self._session_event_callback(
-                    self, ClientEvent(event_type, conn_state, path))
+            self._notify_session_event(
+                ClientEvent(event_type, conn_state, path))
         else:
             return watcher(event_type, conn_state, path)
 
@@ -349,7 +350,7 @@ class SessionClient(ZookeeperClient):
         if path in self._ephemerals:
             self._ephemerals[path]['data'] = data
 
-        d.callback(node_stat)
+        d.callback(self._stat(node_stat))
 
 
 class _ManagedClient(RetryClient):
@@ -358,6 +359,10 @@ class _ManagedClient(RetryClient):
         return self.client.subscribe_new_session()
 
 
-def ManagedClient(servers=None, session_timeout=None, connect_timeout=10000):
-    client = SessionClient(servers, session_timeout, connect_timeout)
-    return _ManagedClient(client)
+def ManagedClient(servers=None, session_timeout=None, connect_timeout=10000,
+                  codec=None, compact_stat=False, backoff=None, budget=None,
+                  metrics=None):
+    client = SessionClient(
+        servers, session_timeout, connect_timeout, codec, compact_stat,
+        metrics)
+    return _ManagedClient(client, backoff, budget, metrics)
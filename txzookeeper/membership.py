@@ -0,0 +1,233 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Group membership, as a registry of ephemeral member nodes.
+
+Members register an ephemeral node named for the member under the
+group's path, holding the member's data. Observers maintain a view of the
+membership from a watch on the group's children. On each change only the
+data of new members is retrieved, with pipelined requests.
+"""
+
+import logging
+
+import zookeeper
+
+from twisted.internet.defer import fail, gatherResults, succeed
+
+__all__ = ["GroupMembership"]
+
+log = logging.getLogger("txzk.membership")
+
+# Marks a member which left before its data was retrieved.
+_GONE = object()
+
+
+class GroupMembership(object):
+    """
+    A group of members, and a view of its membership.
+
+    The view, a mapping of member names to their data, is maintained by
+    `watch`. It's replaced rather than modified on each change, so the
+    `members` mapping is a consistent snapshot, which must not be
+    modified. Subscribers are invoked with `JOINED` or `LEFT`, a member's
+    name and its data for each change of the view, a subscriber's error
+    is logged without affecting the others.
+
+    A member's data is retrieved once when it joins, changes to the data
+    of a current member aren't reflected in the view.
+    """
+
+    JOINED = "joined"
+    LEFT = "left"
+
+    def __init__(self, client, path):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the group node, created on demand.
+        """
+        self._client = client
+        self._path = path
+        self._members = {}
+        self._watching = False
+        self._refreshing = False
+        self._stale = False
+        self._generation = 0
+        self._subscribers = []
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def members(self):
+        """
+        A snapshot of the membership, mapping member names to their data.
+        Empty unless the group is being watched.
+        """
+        return self._members
+
+    def subscribe(self, callback):
+        """Subscribe to membership changes, the callback is invoked with
+        the change, the member's name and its data.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _member_path(self, name):
+        return "/".join((self._path, name))
+
+    def _create_parent(self):
+        d = self._client.create(self._path)
+        d.addErrback(
+            lambda failure: failure.trap(zookeeper.NodeExistsException))
+        return d
+
+    def join(self, name, data=""):
+        """
+        Register a member of the group, as an ephemeral node of this
+        client's session. Returns a deferred with the member's path.
+        """
+        if "/" in name:
+            return fail(ValueError("Invalid member name %r" % name))
+        d = self._create_parent()
+        d.addCallback(lambda result: self._client.create(
+            self._member_path(name), data, flags=zookeeper.EPHEMERAL))
+        return d
+
+    def leave(self, name):
+        """Remove a member registered by this client."""
+        return self._client.delete(self._member_path(name))
+
+    def watch(self):
+        """
+        Maintain the view of the membership. Returns a deferred with the
+        membership once it's retrieved.
+        """
+        if self._watching:
+            return succeed(self._members)
+        self._watching = True
+        # Watches set before the view was last stopped are ignored.
+        self._generation += 1
+        self._refreshing = self._stale = False
+        generation = self._generation
+
+        def on_error(failure):
+            if generation == self._generation:
+                self._watching = False
+            return failure
+
+        d = self._create_parent()
+        d.addCallback(lambda result: self._refresh(generation))
+        d.addCallbacks(lambda result: self._members, on_error)
+        return d
+
+    def stop_watching(self):
+        """Stop maintaining the view, which is cleared."""
+        self._watching = False
+        self._generation += 1
+        self._members = {}
+
+    def _refresh(self, generation):
+        if generation != self._generation:
+            return succeed(None)
+        if self._refreshing:
+            # Listed again once the current refresh completes.
+            self._stale = True
+            return succeed(None)
+        self._refreshing = True
+
+        d, watch_d = self._client.get_children_and_watch(self._path)
+        watch_d.addCallbacks(
+            self._on_change, self._on_watch_error,
+            callbackArgs=(generation,), errbackArgs=(generation,))
+        d.addCallback(self._on_children, generation)
+        d.addBoth(self._on_refreshed, generation)
+        return d
+
+    def _on_refreshed(self, result, generation):
+        if generation != self._generation:
+            return result
+        self._refreshing = False
+        if self._stale:
+            self._stale = False
+            d = self._refresh(generation)
+            d.addCallback(lambda ignored: result)
+            return d
+        return result
+
+    def _on_change(self, event, generation):
+        d = self._refresh(generation)
+        d.addErrback(self._on_watch_error, generation)
+        return d
+
+    def _on_watch_error(self, failure, generation):
+        if generation == self._generation:
+            log.warning("Group %s watch failed, %s",
+                        self._path, failure.value)
+            self.stop_watching()
+
+    def _get_member(self, name):
+        d = self._client.get(self._member_path(name))
+        d.addCallbacks(lambda (data, stat): data, self._on_member_gone)
+        return d
+
+    def _on_member_gone(self, failure):
+        failure.trap(zookeeper.NoNodeException)
+        return _GONE
+
+    def _on_children(self, children, generation):
+        if generation != self._generation:
+            return
+        current = self._members
+        names = set(children)
+        joined = [name for name in children if name not in current]
+        left = [name for name in current if name not in names]
+        d = gatherResults([self._get_member(name) for name in joined])
+        d.addCallback(self._update, joined, left, generation)
+        return d
+
+    def _update(self, results, joined, left, generation):
+        if generation != self._generation:
+            return
+        members = dict(self._members)
+        changes = []
+        for name in left:
+            changes.append((self.LEFT, name, members.pop(name)))
+        for name, data in zip(joined, results):
+            # A member gone already is removed from the next listing.
+            if data is _GONE:
+                continue
+            members[name] = data
+            changes.append((self.JOINED, name, data))
+        self._members = members
+
+        for change in changes:
+            for callback in list(self._subscribers):
+                try:
+                    callback(*change)
+                except Exception:
+                    log.exception("Group %s subscriber %r failed on %s %s",
+                                  self._path, callback, change[0], change[1])
@@ -0,0 +1,110 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Operational metrics.
+
+Components report counters and observed values (such as latencies) to a
+metrics hook, any object with C{increment} and C{observe} methods taking
+a metric name, a value and keyword tags. The hook can forward to an
+external metrics system, or be an in memory C{Metrics} instance.
+
+A hook is usually given to a client (as its `metrics` argument), and
+used by default by the components over the client.
+"""
+
+import bisect
+
+__all__ = ["Metrics", "Histogram", "get_metrics"]
+
+
+def get_metrics(client):
+    """Return the metrics hook attached to a client, if any."""
+    return getattr(client, "metrics", None)
+
+
+def _key(name, tags):
+    return (name, tuple(sorted(tags.iteritems())))
+
+
+class Histogram(object):
+    """
+    A summary of observed values, with counts per bucket.
+    """
+
+    # Upper bounds of the buckets, in seconds for timings.
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+
+    @property
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+
+class Metrics(object):
+    """
+    An in memory metrics hook. Counters and histograms are kept per
+    metric name and set of tags.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, value=1, **tags):
+        key = _key(name, tags)
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **tags):
+        key = _key(name, tags)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def counter(self, name, **tags):
+        """Return the value of a counter."""
+        return self._counters.get(_key(name, tags), 0)
+
+    def histogram(self, name, **tags):
+        """Return a histogram, or None if no values were observed."""
+        return self._histograms.get(_key(name, tags))
+
+    def clear(self):
+        self._counters.clear()
+        self._histograms.clear()
@@ -20,10 +20,16 @@
 #  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from collections import namedtuple
+from collections import namedtuple, deque
+from weakref import WeakKeyDictionary, WeakValueDictionary
+import logging
+import time
+
 from zookeeper import NoNodeException, BadVersionException
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.python.failure import Failure
 from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
+from txzookeeper.codec import get_codec
 
 
 class NodeEvent(namedtuple("NodeEvent", 'type, connection_state, node')):
@@ -61,6 +67,12 @@ class NodeEvent(namedtuple("NodeEvent", 'type, connection_state, node')):
         return  "<NodeEvent %s at %r>" % (self.type_name, self.path)
 
 
+log = logging.getLogger("txzk.node")
+
+# Interned nodes, per context.
+_registry = WeakKeyDictionary()
+
+
 class ZNode(object):
     """
     A minimal object abstraction over a zookeeper node, utilizes no caching
@@ -68,14 +80,38 @@ class ZNode(object):
     version. It will attempt to utilize the last read version when modifying
     the node. On a bad version exception this values are cleared and the
     except reraised (errback chain continue.)
+
+    If a codec is given, or attached to the context, node data is encoded
+    and decoded with it.
+
+    Nodes retrieved as children of another node are interned per context,
+    so a path is represented by a single node instance (and its last read
+    version) for as long as it's referenced.
     """
 
-    def __init__(self, path, context):
+    __slots__ = ("_path", "_context", "_codec", "_node_stat", "__weakref__")
+
+    def __init__(self, path, context, codec=None):
         self._path = path
-        self._name = path.split("/")[-1]
         self._context = context
+        self._codec = codec
         self._node_stat = None
 
+    @classmethod
+    def intern(cls, path, context, codec=None):
+        """
+        Return the node for the path in the context, reusing an extant
+        instance if any.
+        """
+        nodes = _registry.get(context)
+        if nodes is None:
+            nodes = _registry[context] = WeakValueDictionary()
+        key = (cls, path, codec)
+        node = nodes.get(key)
+        if node is None:
+            node = nodes[key] = cls(path, context, codec)
+        return node
+
     @property
     def path(self):
         """
@@ -88,7 +124,22 @@ class ZNode(object):
         """
         The name of the node in its container.
         """
-        return self._name
+        return self._path[self._path.rfind("/") + 1:]
+
+    @property
+    def stat(self):
+        """
+        The node's stat as of its last retrieval, or None if unknown. The
+        stat is a C{Stat} instance if the client returns compact stats.
+        """
+        return self._node_stat
+
+    @property
+    def codec(self):
+        """
+        The codec for the node's data, if any.
+        """
+        return self._codec or get_codec(self._context)
 
     def _get_version(self):
         if not self._node_stat:
@@ -108,6 +159,9 @@ class ZNode(object):
         """
         if acl is None:
             acl = [ZOO_OPEN_ACL_UNSAFE]
+        codec = self.codec
+        if codec is not None:
+            data = codec.encode(data)
         d = self._context.create(self.path, data, acl, flags)
         return d
 
@@ -149,6 +203,9 @@ class ZNode(object):
     def _on_get_node_success(self, data):
         (node_data, node_stat) = data
         self._node_stat = node_stat
+        codec = self.codec
+        if codec is not None:
+            return codec.decode_node(self.path, node_data, node_stat)
         return node_data
 
     def get_data(self):
@@ -184,6 +241,9 @@ class ZNode(object):
             self._node_stat = None
             return self
 
+        codec = self.codec
+        if codec is not None:
+            data = codec.encode(data)
         version = self._get_version()
         d = self._context.set(self.path, data, version)
         d.addErrback(self._on_error_bad_version)
@@ -214,12 +274,11 @@ class ZNode(object):
         return d
 
     def _on_get_children_filter_results(self, children, prefix):
-        if prefix:
-            children = [
-                name for name in children if name.startswith(prefix)]
+        intern = self.__class__.intern
+        path, context, codec = self._path, self._context, self._codec
         return [
-            self.__class__("/".join((self.path, name)), self._context)
-            for name in children]
+            intern("/".join((path, name)), context, codec)
+            for name in children if not prefix or name.startswith(prefix)]
 
     def get_children(self, prefix=None):
         """
@@ -248,5 +307,298 @@ class ZNode(object):
         d.addCallback(self._on_get_children_filter_results, prefix)
         return d, children_changed
 
+    def walk(self, max_depth=None, concurrency=10, include_data=True):
+        """
+        Walk the subtree rooted at this node. Returns a C{TreeWalker},
+        whose next method returns a deferred with the next (path, data,
+        stat) tuple of the subtree, or None once the walk is complete.
+
+        Parents are returned before their children. Node data is returned
+        as stored, without decoding.
+
+        @param max_depth: The maximum depth of nodes returned relative to
+        this node, None for the whole subtree.
+        @param concurrency: The maximum number of outstanding requests.
+        @param include_data: If False, the data of each node is None, and
+        only its stat is retrieved.
+        """
+        return TreeWalker(
+            self._context, self._path, max_depth, concurrency, include_data)
+
     def __cmp__(self, other):
         return cmp(self.path, other.path)
+
+
+class TreeWalker(object):
+    """
+    A streaming traversal of a subtree.
+
+    Sibling nodes are retrieved concurrently, up to the concurrency limit,
+    and results are returned as they arrive. Retrieval is paused while
+    a bounded number of results are waiting to be consumed, and the walk
+    proceeds depth first, so memory use is bounded on large trees.
+
+    Nodes deleted during the walk are skipped. Any other error fails the
+    walk.
+    """
+
+    def __init__(self, client, path, max_depth=None, concurrency=10,
+                 include_data=True, buffer_size=None):
+        self._client = client
+        self._max_depth = max_depth
+        self._concurrency = concurrency
+        self._include_data = include_data
+        self._buffer_size = buffer_size or concurrency * 4
+        self._pending = [(path, 0)]
+        self._active = 0
+        self._results = deque()
+        self._waiters = deque()
+        self._failure = None
+
+    @property
+    def complete(self):
+        """Have all the nodes of the walk been retrieved and consumed."""
+        return not (self._pending or self._active or self._results)
+
+    def next(self):
+        """
+        Returns a deferred with the next (path, data, stat) tuple of the
+        walk, or None if the walk is complete.
+        """
+        if self._results:
+            result = self._results.popleft()
+            self._fill()
+            return succeed(result)
+        if self._failure is not None:
+            return fail(self._failure)
+        if self.complete:
+            return succeed(None)
+        d = Deferred()
+        self._waiters.append(d)
+        self._fill()
+        return d
+
+    def _fill(self):
+        while (self._pending and self._failure is None and
+               self._active < self._concurrency and
+               self._active + len(self._results) < self._buffer_size):
+            path, depth = self._pending.pop()
+            self._active += 1
+            if self._include_data:
+                d = self._client.get(path)
+            else:
+                d = self._client.exists(path)
+                d.addCallback(lambda stat: (None, stat))
+            d.addCallback(self._on_node, path, depth)
+            d.addErrback(self._on_error)
+
+    def _on_node(self, (data, stat), path, depth):
+        if stat is None:
+            return self._on_done()
+
+        expand = stat["numChildren"] and (
+            self._max_depth is None or depth < self._max_depth)
+        self._emit((path, data, stat))
+        if not expand:
+            return self._on_done()
+
+        d = self._client.get_children(path)
+        d.addCallback(self._on_children, path, depth)
+        return d
+
+    def _on_children(self, children, path, depth):
+        prefix = path.rstrip("/")
+        # Pushed in reverse so siblings are visited in order.
+        for name in sorted(children, reverse=True):
+            self._pending.append(("%s/%s" % (prefix, name), depth + 1))
+        self._on_done()
+
+    def _on_error(self, failure):
+        if failure.check(NoNodeException):
+            return self._on_done()
+        self._active -= 1
+        if self._failure is None:
+            self._failure = failure
+        waiters = self._waiters
+        self._waiters = deque()
+        for waiter in waiters:
+            waiter.errback(failure)
+
+    def _on_done(self):
+        self._active -= 1
+        self._fill()
+        if self.complete:
+            waiters = self._waiters
+            self._waiters = deque()
+            for waiter in waiters:
+                waiter.callback(None)
+
+    def _emit(self, result):
+        if self._waiters:
+            self._waiters.popleft().callback(result)
+        else:
+            self._results.append(result)
+
+
+class CachedZNode(ZNode):
+    """
+    A node that keeps its last read data and stat in memory, and refreshes
+    them whenever the node changes, via an automatically re-armed watch.
+
+    Reads are served from memory, the last known data is returned while a
+    refresh is in flight (stale while revalidate). An optional staleness
+    bound limits how long data that may be outdated is served, reads past
+    the bound wait for the refresh.
+    """
+
+    __slots__ = ("_data", "_loaded", "_max_staleness", "_stale_since",
+                 "_watching", "_watch_lost", "_fetching", "_refetch",
+                 "_waiters")
+
+    def __init__(self, path, context, codec=None, max_staleness=None):
+        """
+        @param max_staleness: The number of seconds the last known data may
+        be served after it may have become outdated, None to always serve
+        the last known data.
+        """
+        super(CachedZNode, self).__init__(path, context, codec)
+        self._data = None
+        self._loaded = False
+        self._max_staleness = max_staleness
+        self._stale_since = None
+        self._watching = False
+        self._watch_lost = False
+        self._fetching = False
+        self._refetch = False
+        self._waiters = []
+
+    @property
+    def data(self):
+        """
+        The last known data of the node, None if the node doesn't exist or
+        hasn't been loaded.
+        """
+        return self._data
+
+    @property
+    def loaded(self):
+        """Has the node's data been loaded."""
+        return self._loaded
+
+    @property
+    def stale(self):
+        """
+        Boolean, whether the last known data may be outdated, because the
+        node changed or its watch was lost, and a refresh hasn't completed.
+        """
+        return not self._loaded or self._stale_since is not None
+
+    def start(self):
+        """
+        Load the node's data and keep it current. Returns a deferred that
+        fires with the data once loaded.
+        """
+        self._watching = True
+        return self._refresh(Deferred())
+
+    def stop(self):
+        """
+        Stop refreshing the node's data on changes, until its next read.
+        """
+        self._watching = False
+
+    def get_data(self):
+        """
+        Retrieve the node's data, from memory if it's fresh or within the
+        staleness bound. Data that may be outdated, as the node changed
+        while stopped or its watch was lost with the client's session, is
+        refreshed in the background and the watch set again.
+        """
+        if self._loaded and (
+            self._stale_since is None or self._max_staleness is None or
+            time.time() - self._stale_since <= self._max_staleness):
+            if self._stale_since is not None and not self._fetching:
+                self._watching = True
+                self._refresh()
+            return succeed(self._data)
+        self._watching = True
+        return self._refresh(Deferred())
+
+    def _refresh(self, waiter=None):
+        if waiter is not None:
+            self._waiters.append(waiter)
+        if self._fetching:
+            self._refetch = True
+        else:
+            self._fetching = True
+            self._fetch()
+        return waiter
+
+    def _fetch(self):
+        # The client's watches are used directly, the node's watches don't
+        # report their errors.
+        d, w = self._context.get_and_watch(self.path)
+        w.addCallbacks(self._on_changed, self._on_watch_error)
+        d.addCallback(self._on_get_node_success)
+        d.addErrback(self._on_get_node_error)
+        d.addCallbacks(self._on_fetched, self._on_fetch_error)
+
+    def _on_fetched(self, data):
+        self._data = data
+        self._loaded = True
+        self._stale_since = None
+        self._watch_lost = False
+        self._on_fetch_complete(data)
+
+    def _on_fetch_error(self, failure):
+        if not failure.check(NoNodeException):
+            self._mark_stale()
+            return self._on_fetch_complete(failure)
+
+        # Watch for the node's creation.
+        self._data = None
+        self._loaded = True
+        self._stale_since = None
+        d, w = self._context.exists_and_watch(self.path)
+        w.addCallbacks(self._on_changed, self._on_watch_error)
+        d.addCallback(self._on_exists_success)
+        d.addCallback(self._on_exists)
+        d.addErrback(self._on_fetch_complete)
+
+    def _on_exists(self, exists):
+        self._watch_lost = False
+        if exists:
+            # Created since our read, the watch will fire on its next change.
+            self._refetch = True
+        self._on_fetch_complete(None)
+
+    def _on_fetch_complete(self, result):
+        self._fetching = False
+        if self._refetch:
+            self._refetch = False
+            self._refresh()
+            return
+
+        waiters = self._waiters
+        self._waiters = []
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+
+    def _mark_stale(self):
+        if self._stale_since is None:
+            self._stale_since = time.time()
+
+    def _on_changed(self, event):
+        self._mark_stale()
+        if self._watching:
+            self._refresh()
+
+    def _on_watch_error(self, failure):
+        # The watch is lost, the data may become outdated without notice,
+        # till the next read sets it again.
+        log.debug("Watch lost on %s: %s", self.path, failure.value)
+        self._watch_lost = True
+        self._mark_stale()
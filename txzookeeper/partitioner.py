@@ -0,0 +1,446 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Partitioning of work among the members of a group.
+
+Partitions are assigned to members by consistent hashing, each member
+is placed at several points of a hash ring and a partition belongs to the
+member following its own hash on the ring. A member joining or leaving
+moves only the partitions adjacent to its points, about a share of them.
+
+Each member computes the assignment from its view of the membership.
+Ownership of a partition is held by an ephemeral node, so a partition
+moves only once its previous owner released it.
+
+Ownership can't be asserted without a connection. A member releases its
+partitions as soon as its client is disconnected, as the other members
+take them over once its session expires, and rejoins the group once
+connected again, or once a C{SessionClient} established a new session.
+"""
+
+from hashlib import md5
+import bisect
+import logging
+
+import zookeeper
+
+from twisted.internet.defer import (
+    fail, gatherResults, maybeDeferred, succeed)
+
+from txzookeeper.client import NotConnectedException
+from txzookeeper.membership import GroupMembership
+
+__all__ = ["Partitioner", "assign_partitions"]
+
+log = logging.getLogger("txzk.partitioner")
+
+
+def _hash(key):
+    return int(md5(key).hexdigest()[:16], 16)
+
+
+def assign_partitions(members, partitions, replicas=64):
+    """
+    Assign partitions to members by consistent hashing. Returns a
+    dictionary of partition numbers to member names, empty without
+    members.
+
+    @param members: The names of the members.
+    @param partitions: The number of partitions.
+    @param replicas: The number of points of each member on the ring.
+    """
+    ring = sorted(
+        (_hash("%s-%d" % (member, i)), member)
+        for member in members for i in range(replicas))
+    if not ring:
+        return {}
+    hashes = [point for point, member in ring]
+    assignment = {}
+    for partition in range(partitions):
+        index = bisect.bisect(hashes, _hash(str(partition))) % len(ring)
+        assignment[partition] = ring[index][1]
+    return assignment
+
+
+class Partitioner(object):
+    """
+    A member of a group sharing a number of partitions.
+
+    Members are registered under the `members` node of the partitioner's
+    path, and partitions are owned through ephemeral nodes under its
+    `owners` node. The `on_acquired` and `on_released` callbacks are
+    invoked with the partition number as this member gains and gives up
+    a partition. A partition is released once its `on_released` callback
+    completes, which may return a deferred. On losing its connection, a
+    member's partitions are released without waiting on the callbacks.
+    """
+
+    def __init__(self, client, path, partitions, identifier=None,
+                 on_acquired=None, on_released=None, replicas=64):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the partitioner, created on demand.
+        @param partitions: The number of partitions, the same for all
+        members.
+        @param identifier: The name of this member, unique in the group,
+        defaults to the client's session id, which requires a connected
+        client.
+        @param on_acquired: A callable invoked with a partition this member
+        acquired.
+        @param on_released: A callable invoked with a partition this member
+        must give up.
+        @param replicas: The number of points of each member on the ring,
+        the same for all members.
+        """
+        if partitions < 1:
+            raise ValueError("At least one partition is required")
+        if identifier is None:
+            client_id = client.client_id
+            if client_id is None:
+                raise NotConnectedException(
+                    "A connected client is required for the default "
+                    "identifier")
+            identifier = "%x" % client_id[0]
+        self._client = client
+        self._path = path
+        self._partitions = partitions
+        self._identifier = identifier
+        self._on_acquired = on_acquired
+        self._on_released = on_released
+        self._replicas = replicas
+        self._group = GroupMembership(client, "%s/members" % path)
+        self._active = False
+        self._rebalance_call = None
+        self._assigned = set()
+        self._owned = set()
+        self._acquiring = set()
+        self._releasing = {}
+        # Partitions released while disconnected, whose owner nodes may
+        # still be held by our session.
+        self._orphaned = set()
+        self._suspended = False
+        self._session_d = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def identifier(self):
+        return self._identifier
+
+    @property
+    def assigned(self):
+        """The partitions assigned to this member by its current view."""
+        return frozenset(self._assigned)
+
+    @property
+    def owned(self):
+        """The partitions this member owns."""
+        return frozenset(self._owned)
+
+    def _owner_path(self, partition):
+        return "%s/owners/%d" % (self._path, partition)
+
+    def _create(self, path):
+        d = self._client.create(path)
+        d.addErrback(
+            lambda failure: failure.trap(zookeeper.NodeExistsException))
+        return d
+
+    def join(self):
+        """
+        Join the group, and start acquiring the partitions assigned to
+        this member. Returns a deferred which fires once the membership is
+        retrieved.
+        """
+        if self._active:
+            return fail(ValueError("Already joined %s" % self._path))
+        self._active = True
+        self._group.subscribe(self._on_change)
+        self._client.add_session_listener(self._on_session_event)
+        self._subscribe_session()
+
+        d = self._create(self._path)
+        d.addCallback(lambda result: self._create("%s/owners" % self._path))
+        d.addCallback(lambda result: self._group.join(self._identifier))
+        d.addCallback(lambda result: self._group.watch())
+        d.addCallback(lambda members: self._rebalance())
+
+        def on_error(failure):
+            self._active = False
+            self._session_d = None
+            self._group.unsubscribe(self._on_change)
+            self._client.remove_session_listener(self._on_session_event)
+            return failure
+
+        d.addCallbacks(lambda result: self, on_error)
+        return d
+
+    def leave(self):
+        """
+        Release all partitions and leave the group. Returns a deferred which
+        fires once the partitions are released.
+        """
+        if not self._active:
+            return fail(ValueError("Not joined %s" % self._path))
+        self._active = False
+        self._suspended = False
+        self._session_d = None
+        self._cancel_rebalance()
+        self._client.remove_session_listener(self._on_session_event)
+        self._group.unsubscribe(self._on_change)
+        self._group.stop_watching()
+        self._assigned = set()
+
+        releases = [
+            self._release(partition) for partition in list(self._owned)]
+        orphaned, self._orphaned = self._orphaned, set()
+        releases.extend(self._delete_own(partition) for partition in orphaned)
+        # Also wait on the releases started by a rebalance.
+        releases.extend(
+            d for d in self._releasing.values() if d not in releases)
+        d = gatherResults(releases, consumeErrors=True)
+        d.addCallback(lambda result: self._group.leave(self._identifier))
+        d.addErrback(
+            lambda failure: failure.trap(zookeeper.NoNodeException))
+        return d
+
+    def _on_change(self, change, name, data):
+        # Coalesce the changes of a membership update into one rebalance.
+        if self._rebalance_call is None:
+            from twisted.internet import reactor
+            self._rebalance_call = reactor.callLater(0, self._rebalance)
+
+    def _cancel_rebalance(self):
+        if self._rebalance_call is not None:
+            if self._rebalance_call.active():
+                self._rebalance_call.cancel()
+            self._rebalance_call = None
+
+    def _rebalance(self):
+        self._cancel_rebalance()
+        if not self._active or self._suspended:
+            return
+        assignment = assign_partitions(
+            self._group.members, self._partitions, self._replicas)
+        self._assigned = set(
+            partition for partition, member in assignment.iteritems()
+            if member == self._identifier)
+
+        for partition in self._owned - self._assigned:
+            d = self._release(partition)
+            d.addErrback(self._on_release_error, partition)
+        # A partition still being released is acquired again once its
+        # owner node is deleted.
+        for partition in (self._assigned - self._owned - self._acquiring -
+                          set(self._releasing)):
+            self._acquire(partition)
+
+    def _acquire(self, partition):
+        self._acquiring.add(partition)
+        d = self._client.create(
+            self._owner_path(partition), self._identifier,
+            flags=zookeeper.EPHEMERAL)
+        d.addCallbacks(self._on_owned, self._on_owned_elsewhere,
+                       callbackArgs=(partition,), errbackArgs=(partition,))
+        d.addErrback(self._on_error, partition)
+
+    def _on_owned(self, path, partition):
+        self._acquiring.discard(partition)
+        if partition not in self._assigned:
+            # Reassigned while acquiring.
+            return self._track_release(partition, self._delete(partition))
+        self._owned.add(partition)
+        self._notify(self._on_acquired, partition)
+
+    def _on_owned_elsewhere(self, failure, partition):
+        failure.trap(zookeeper.NodeExistsException)
+        # Wait for the previous owner to release the partition.
+        get_d, watch_d = self._client.get_and_watch(
+            self._owner_path(partition))
+
+        def on_owner((owner, stat)):
+            if owner == self._identifier and self._owns(stat):
+                # Our own node, recreated with a new session. A node of a
+                # previous session is waited on till it expires.
+                return self._on_owned(None, partition)
+            watch_d.addCallbacks(
+                self._retry_acquire, self._on_error,
+                callbackArgs=(partition,), errbackArgs=(partition,))
+
+        def on_released(failure):
+            failure.trap(zookeeper.NoNodeException)
+            return self._retry_acquire(None, partition)
+
+        get_d.addCallbacks(on_owner, on_released)
+        return get_d
+
+    def _retry_acquire(self, event, partition):
+        self._acquiring.discard(partition)
+        if partition in self._assigned and partition not in self._owned:
+            self._acquire(partition)
+
+    def _on_error(self, failure, partition):
+        self._acquiring.discard(partition)
+        log.warning("Partition %s/%d acquisition failed, %s",
+                    self._path, partition, failure.value)
+
+    def _release(self, partition):
+        self._owned.discard(partition)
+        d = succeed(None)
+        if self._on_released is not None:
+            d = maybeDeferred(self._on_released, partition)
+            d.addErrback(lambda failure: log.error(
+                "Partition %s/%d release failed\n%s",
+                self._path, partition, failure.getTraceback()))
+        d.addCallback(lambda result: self._delete(partition))
+        return self._track_release(partition, d)
+
+    def _track_release(self, partition, d):
+        self._releasing[partition] = d
+
+        def on_released(result):
+            del self._releasing[partition]
+            if (self._active and partition in self._assigned and
+                    partition not in self._owned and
+                    partition not in self._acquiring):
+                # Reassigned while releasing.
+                self._acquire(partition)
+            return result
+
+        d.addBoth(on_released)
+        return d
+
+    def _on_release_error(self, failure, partition):
+        log.warning("Partition %s/%d release failed, %s",
+                    self._path, partition, failure.value)
+
+    def _owns(self, stat):
+        client_id = self._client.client_id
+        return (client_id is not None and
+                stat["ephemeralOwner"] == client_id[0])
+
+    def _delete_own(self, partition):
+        """
+        Delete the owner node of a partition, if held by our session.
+        """
+        d = self._client.get(self._owner_path(partition))
+
+        def on_owner((owner, stat)):
+            if self._owns(stat):
+                return self._client.delete(
+                    self._owner_path(partition), stat["version"])
+
+        d.addCallback(on_owner)
+        d.addErrback(lambda failure: failure.trap(
+            zookeeper.NoNodeException, zookeeper.BadVersionException))
+        return d
+
+    def _subscribe_session(self):
+        subscribe = getattr(self._client, "subscribe_new_session", None)
+        if subscribe is None:
+            return
+        d = self._session_d = subscribe()
+        d.addCallback(self._on_new_session, d)
+
+    def _on_session_event(self, client, event):
+        if event.connection_state == zookeeper.CONNECTED_STATE:
+            # Session events are repeated for each watch, resume once.
+            if self._suspended:
+                self._resume()
+        elif not self._suspended:
+            self._suspend()
+
+    def _on_new_session(self, result, session_d):
+        if self._session_d is not session_d:
+            return
+        self._subscribe_session()
+        if not self._suspended:
+            self._suspend()
+        self._resume()
+
+    def _suspend(self):
+        """
+        Release the partitions on losing the connection, before the other
+        members take them over.
+        """
+        if not self._active:
+            return
+        self._suspended = True
+        self._cancel_rebalance()
+        self._group.stop_watching()
+        self._assigned = set()
+        self._orphaned.update(self._owned)
+        self._orphaned.update(self._releasing)
+        for partition in sorted(self._owned):
+            self._owned.discard(partition)
+            self._notify(self._on_released, partition)
+
+    def _resume(self):
+        """
+        Remove the owner nodes left by our session, rejoin the group and
+        rebalance on reconnecting.
+        """
+        if not self._active:
+            return
+        self._suspended = False
+        orphaned, self._orphaned = self._orphaned, set()
+        d = gatherResults(
+            [self._delete_own(partition) for partition in orphaned],
+            consumeErrors=True)
+
+        def rejoin(result):
+            # The member node survives with the session, or is recreated
+            # by a session client.
+            d = self._group.join(self._identifier)
+            d.addErrback(
+                lambda failure: failure.trap(zookeeper.NodeExistsException))
+            return d
+
+        def on_error(failure):
+            # Retried on the next connection.
+            log.warning("Partitioner %s rejoin failed, %s",
+                        self._path, failure.value)
+            if self._active:
+                self._suspended = True
+                self._orphaned.update(orphaned)
+
+        d.addCallback(rejoin)
+        d.addCallback(lambda result: self._group.watch())
+        d.addCallback(lambda members: self._rebalance())
+        d.addErrback(on_error)
+        return d
+
+    def _delete(self, partition):
+        d = self._client.delete(self._owner_path(partition))
+        d.addErrback(lambda failure: failure.trap(zookeeper.NoNodeException))
+        return d
+
+    def _notify(self, callback, partition):
+        if callback is None:
+            return
+        d = maybeDeferred(callback, partition)
+        d.addErrback(lambda failure: log.error(
+            "Partition %s/%d callback failed\n%s",
+            self._path, partition, failure.getTraceback()))
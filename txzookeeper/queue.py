@@ -34,12 +34,40 @@ The C{SerializedQueue} implementation provides for strict in order processing
 of items within a queue.
 """
 
+from collections import namedtuple
+
 import zookeeper
 
-from twisted.internet.defer import Deferred, fail
+from twisted.internet.defer import (
+    CancelledError, Deferred, fail, succeed, gatherResults, maybeDeferred)
+from twisted.internet.interfaces import IPushProducer
 from twisted.python.failure import Failure
+from zope.interface import implements
 from txzookeeper.lock import Lock
 from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
+from txzookeeper.codec import get_codec
+
+
+class QueueStats(namedtuple("QueueStats", "pending in_flight total")):
+    """
+    A snapshot of the item counts of a queue.
+
+    @ivar pending: The number of items available to consumers.
+    @ivar in_flight: The number of items reserved by a consumer but not yet
+    processed.
+    @ivar total: The number of items in the queue, pending and in flight.
+    """
+
+
+def get_stats_many(queues):
+    """
+    Retrieve the stats of several queues at once. The requests for all the
+    queues are issued concurrently, queues which maintain a watched local
+    count are served without a round trip.
+
+    Returns a deferred list of C{QueueStats}, in the order of the queues.
+    """
+    return gatherResults([queue.get_stats() for queue in queues])
 
 
 class Queue(object):
@@ -53,25 +81,33 @@ class Queue(object):
     zookeeper on retrieval in this implementation. This implementation more
     closely mirrors the behavior and api of the pythonstandard library Queue,
     or multiprocessing.Queue ableit with the caveat of only strings for queue
-    items.
+    items, unless a codec is used.
     """
 
     prefix = "entry-"
 
-    def __init__(self, path, client, acl=None, persistent=False):
+    def __init__(self, path, client, acl=None, persistent=False, codec=None):
         """
         @param client: A connected C{ZookeeperClient} instance.
         @param path: The path to the queue inthe zookeeper hierarchy.
         @param acl: An acl to be used for queue items.
         @param persistent: Boolean flag which denotes if items in the queue are
         persistent.
+        @param codec: A codec used to encode and decode queue items, defaults
+        to the client's codec.
         """
         self._path = path
         self._client = client
         self._persistent = persistent
+        if codec is None:
+            codec = get_codec(client)
+        self._codec = codec
         if acl is None:
             acl = [ZOO_OPEN_ACL_UNSAFE]
         self._acl = acl
+        self._stats = None
+        self._stats_watched = False
+        self._stats_generation = 0
 
     @property
     def path(self):
@@ -89,6 +125,29 @@ class Queue(object):
         at the moment, a deferred is return that will fire when an item
         is available.
         """
+        request = self._create_request()
+        self._get(request)
+        return request.deferred
+
+    def consume(self, handler, concurrency=1):
+        """
+        Continuously consume items from the queue, passing each to the
+        handler. Up to `concurrency` items are handled at once, an item is
+        acknowledged (deleted for reliable queues) when the deferred returned
+        by the handler succeeds.
+
+        Returns a started C{QueueConsumer}, which supports flow control via
+        its pause, resume and stop producer methods.
+
+        @param handler: A callable receiving a queue item, it may return
+        a deferred.
+        @param concurrency: The maximum number of items handled at once.
+        """
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        return QueueConsumer(self, handler, concurrency).start()
+
+    def _create_request(self):
 
         def on_queue_items_changed(*args):
             """Event watcher on queue node child events."""
@@ -105,16 +164,21 @@ class Queue(object):
                 self._get(request)
 
         request = GetRequest(Deferred(), on_queue_items_changed)
-        self._get(request)
-        return request.deferred
+        return request
 
     def put(self, item):
         """
         Put an item into the queue.
 
-        @param item: String data to be put on the queue.
+        @param item: String data to be put on the queue, or any value
+        supported by the queue's codec.
         """
-        if not isinstance(item, str):
+        if self._codec is not None:
+            try:
+                item = self._codec.encode(item)
+            except Exception, e:
+                return fail(e)
+        elif not isinstance(item, str):
             return fail(ValueError("queue items must be strings"))
 
         flags = zookeeper.SEQUENCE
@@ -127,17 +191,106 @@ class Queue(object):
 
     def qsize(self):
         """
-        Return the approximate size of the queue. This value is always
+        Return the approximate number of items available in the queue, items
+        in flight to a consumer are not included. This value is always
         effectively a snapshot. Returns a deferred returning an integer.
         """
-        d = self._client.exists(self._path)
+        d = self.get_stats()
+        d.addCallback(lambda stats: stats.pending)
+        return d
+
+    def get_stats(self):
+        """
+        Return the approximate item counts of the queue as a C{QueueStats}.
+        If the queue's stats are being watched, the local count is returned
+        without contacting zookeeper. Returns a deferred.
+        """
+        if self._stats is not None:
+            return succeed(self._stats)
+        return self._get_stats()
 
-        def on_success(stat):
-            return stat["numChildren"]
+    def watch_stats(self):
+        """
+        Maintain a local count of the queue's items, updated by a child watch
+        on the queue, so that subsequent C{get_stats} and C{qsize} calls are
+        served from memory. Returns a deferred that fires with the current
+        stats once the watch is established.
+        """
+        if self._stats_watched:
+            return self.get_stats()
+        self._stats_watched = True
+        return self._refresh_stats()
 
-        d.addCallback(on_success)
+    def unwatch_stats(self):
+        """
+        Stop maintaining a local count of the queue's items.
+        """
+        self._stats_watched = False
+        self._stats_generation += 1
+        self._stats = None
+
+    def _refresh_stats(self):
+        # Each refresh sets new watches, those of previous refreshes are
+        # ignored, so a single chain of refreshes is active.
+        self._stats_generation += 1
+        generation = self._stats_generation
+
+        def on_stats(stats):
+            if generation == self._stats_generation:
+                self._stats = stats
+            return stats
+
+        def on_error(failure):
+            # Without a watch in place the local count can't be trusted.
+            if generation == self._stats_generation:
+                self.unwatch_stats()
+            return failure
+
+        d = self._get_stats(generation)
+        d.addCallbacks(on_stats, on_error)
         return d
 
+    def _on_stats_changed(self, event, generation):
+        if generation == self._stats_generation:
+            self._refresh_stats()
+
+    def _on_stats_watch_error(self, failure, generation):
+        if generation == self._stats_generation:
+            self.unwatch_stats()
+
+    def _get_stats(self, generation=None):
+        """
+        Retrieve the stats of the queue, watching the nodes they're computed
+        from if a stats generation is given.
+        """
+        d = self._get_stats_children(self._path, generation)
+        d.addCallback(self._count_items)
+        return d
+
+    def _get_stats_children(self, path, generation=None):
+        if generation is None:
+            return self._client.get_children(path)
+        d, w = self._client.get_children_and_watch(path)
+        w.addCallbacks(
+            self._on_stats_changed, self._on_stats_watch_error,
+            callbackArgs=(generation,), errbackArgs=(generation,))
+        return d
+
+    def _decode(self, path, data, stat):
+        if self._codec is None:
+            return data
+        return self._codec.decode_node(path, data, stat)
+
+    def _count_items(self, children):
+        """
+        Compute the stats of the queue from the names of its children. Only
+        prefixed item nodes are counted, which excludes the lock directory of
+        a serialized queue.
+        """
+        items = len([name for name in children
+                     if name.startswith(self.prefix)])
+        return QueueStats(items, 0, items)
+
     def _get(self, request):
         request.processing_children = True
         d, w = self._client.get_children_and_watch(self._path)
@@ -150,19 +303,19 @@ class Queue(object):
         def fetch_node(name):
             path = "/".join((self._path, name))
             d = self._client.get(path)
-            d.addCallback(on_get_node_success)
+            d.addCallback(on_get_node_success, path)
             d.addErrback(on_no_node)
             return d
 
-        def on_get_node_success((data, stat)):
-            d = self._client.delete("/".join((self._path, name)))
-            d.addCallback(on_delete_node_success, data)
+        def on_get_node_success((data, stat), path):
+            d = self._client.delete(path)
+            d.addCallback(on_delete_node_success, path, data, stat)
             d.addErrback(on_no_node)
             return d
 
-        def on_delete_node_success(result_code, data):
+        def on_delete_node_success(result_code, path, data, stat):
             request.processing_children = False
-            request.callback(data)
+            request.callback(self._decode(path, data, stat))
 
         def on_no_node(failure=None):
             if failure and not failure.check(zookeeper.NoNodeException):
@@ -229,14 +382,17 @@ class QueueItem(object):
     permanently from the queue.
 
     An optional processed callback maybe passed to the constructor that will
-    be invoked after the node has been processed.
+    be invoked after the node has been processed, and an optional released
+    callback that will be invoked if the item is released unprocessed.
     """
 
-    def __init__(self, path, data, client, processed_callback=None):
+    def __init__(self, path, data, client, processed_callback=None,
+                 released_callback=None):
         self._path = path
         self._data = data
         self._client = client
         self._processed_callback = processed_callback
+        self._released_callback = released_callback
 
     @property
     def data(self):
@@ -258,6 +414,225 @@ class QueueItem(object):
             d.addCallback(self._processed_callback, self.path)
         return d
 
+    def release(self):
+        """
+        Give the item back to the queue unprocessed, making it available to
+        other consumers. Typically invoked by a queue consumer that failed
+        to process the item.
+        """
+        if self._released_callback is None:
+            return succeed(None)
+        return maybeDeferred(self._released_callback, self.path)
+
+
+# Result of a consumer's retrieval abandoned without an item.
+_ABANDONED = object()
+
+
+class QueueConsumer(object):
+    """
+    A continuous consumer of queue items, with bounded concurrency.
+
+    A single retrieval is outstanding at any time, and the last children
+    listing of the queue is shared between retrievals, so a consumer with
+    many items in flight doesn't list the queue for each item. Items are
+    retrieved while fewer than the concurrency limit are being handled.
+
+    Any error retrieving or handling an item stops the consumer, the
+    error is passed to the errback of the C{finished} deferred once the
+    items in flight have been handled. An item whose handling failed is
+    released back to the queue.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, queue, handler, concurrency=1):
+        self._queue = queue
+        self._handler = handler
+        self._concurrency = concurrency
+        self._children = []
+        self._request = None
+        self._in_flight = 0
+        self._paused = False
+        self._stopped = False
+        self._failure = None
+        self._finished = Deferred()
+
+    @property
+    def in_flight(self):
+        """The number of items currently being handled."""
+        return self._in_flight
+
+    @property
+    def finished(self):
+        """
+        A deferred that fires when the consumer has been stopped and all the
+        items in flight have been handled.
+        """
+        return self._finished
+
+    def start(self):
+        """Start consuming items from the queue."""
+        self._fill()
+        return self
+
+    def pauseProducing(self):
+        """
+        Stop retrieving new items, items in flight continue to be handled.
+        """
+        self._paused = True
+        self._abandon_request()
+
+    def resumeProducing(self):
+        """Resume retrieving items."""
+        self._paused = False
+        self._fill()
+
+    def stopProducing(self):
+        """
+        Stop consuming items. The C{finished} deferred fires after the
+        items in flight have been handled.
+        """
+        self._stopped = True
+        self._abandon_request()
+        self._check_finished()
+
+    def _abandon_request(self):
+        """
+        A retrieval waiting on a queue watch holds no item, and is abandoned
+        by completing it without one.
+        """
+        request = self._request
+        if (request is not None and not request.complete and
+            not request.processing_children):
+            request.callback(_ABANDONED)
+
+    def _fill(self):
+        if (self._request is not None or self._paused or self._stopped or
+            self._in_flight >= self._concurrency):
+            return
+        request = self._request = self._queue._create_request()
+        request.deferred.addCallbacks(self._on_item, self._on_fetch_error)
+        d = self._fetch(request)
+        d.addBoth(self._on_fetch_settled, request)
+
+    def _fetch(self, request):
+        """
+        Retrieve an item, from the remaining children of the last listing if
+        any, else from a new listing of the queue.
+        """
+        request.processing_children = True
+        if self._children:
+            # Relist the queue if the remaining children are exhausted.
+            request.refetch_children = True
+            return maybeDeferred(
+                self._queue._get_item, self._children, request)
+
+        d, w = self._queue._client.get_children_and_watch(self._queue.path)
+        w.addCallback(request.child_watcher)
+        d.addCallback(self._on_children, request)
+        return d
+
+    def _on_children(self, children, request):
+        self._children = children
+        return self._queue._get_item(children, request)
+
+    def _on_fetch_settled(self, result, request):
+        if request.complete:
+            return
+        if isinstance(result, Failure):
+            request.errback(result)
+        elif self._paused or self._stopped:
+            # The listing was exhausted, and the request is waiting on a
+            # watch.
+            request.callback(_ABANDONED)
+
+    def _on_item(self, item):
+        self._request = None
+        if item is _ABANDONED:
+            self._check_finished()
+            return
+
+        self._in_flight += 1
+        d = maybeDeferred(self._handler, item)
+        if isinstance(item, QueueItem):
+            d.addCallback(lambda result: item.delete())
+        d.addCallbacks(self._on_handled, self._on_handler_error,
+                       errbackArgs=(item,))
+        self._fill()
+
+    def _on_handled(self, result):
+        self._in_flight -= 1
+        self._fill()
+        self._check_finished()
+
+    def _on_handler_error(self, failure, item):
+        d = succeed(None)
+        if isinstance(item, QueueItem):
+            d = item.release()
+
+        def on_released(result):
+            # The handler's error prevails over any error releasing the
+            # item.
+            self._in_flight -= 1
+            self._fail(failure)
+        d.addBoth(on_released)
+
+    def _on_fetch_error(self, failure):
+        self._request = None
+        self._fail(failure)
+
+    def _fail(self, failure):
+        if self._failure is None:
+            self._failure = failure
+        self.stopProducing()
+
+    def _check_finished(self):
+        if (not self._stopped or self._request is not None or
+            self._in_flight or self._finished.called):
+            return
+        if self._failure is not None:
+            self._finished.errback(self._failure)
+        else:
+            self._finished.callback(self)
+
+
+class SerializedQueueConsumer(QueueConsumer):
+    """
+    A consumer of a serialized queue. Items are retrieved one at a time
+    under the queue's lock. A retrieval waiting on the lock is abandoned
+    by cancelling its acquisition, a retrieval holding the lock and
+    waiting on the queue releases the lock when abandoned.
+    """
+
+    _lock_d = None
+
+    def _fetch(self, request):
+        request.processing_children = True
+        d = self._lock_d = self._queue._acquire_lock()
+
+        def on_lock(lock):
+            self._lock_d = None
+            return self._queue._get(request)
+
+        def on_cancelled(failure):
+            failure.trap(CancelledError)
+            self._lock_d = None
+
+        d.addCallbacks(on_lock, on_cancelled)
+        return d
+
+    def _abandon_request(self):
+        if self._lock_d is not None:
+            self._lock_d.cancel()
+        else:
+            super(SerializedQueueConsumer, self)._abandon_request()
+
+    def _on_item(self, item):
+        if item is _ABANDONED and self._queue._lock.acquired:
+            self._queue._lock.release()
+        return super(SerializedQueueConsumer, self)._on_item(item)
+
 
 class ReliableQueue(Queue):
     """
@@ -278,6 +653,11 @@ class ReliableQueue(Queue):
     def _item_processed_callback(self, result_code, item_path):
         return self._client.delete(item_path + "-processing")
 
+    def _item_released_callback(self, item_path):
+        d = self._client.delete(item_path + "-processing")
+        d.addErrback(lambda failure: failure.trap(zookeeper.NoNodeException))
+        return d
+
     def _filter_children(self, children, suffix="-processing"):
         """
         Filter any children currently being processed, modified in place.
@@ -291,6 +671,21 @@ class ReliableQueue(Queue):
                 if item_name in children:
                     children.remove(item_name)
 
+    def _count_items(self, children, suffix="-processing"):
+        """
+        Items with a processing node are counted as in flight, the processing
+        nodes themselves aren't items.
+        """
+        names = set(children)
+        items = in_flight = 0
+        for name in names:
+            if not name.startswith(self.prefix) or name.endswith(suffix):
+                continue
+            items += 1
+            if name + suffix in names:
+                in_flight += 1
+        return QueueStats(items - in_flight, in_flight, items)
+
     def _get_item(self, children, request):
 
         def check_node(name):
@@ -332,7 +727,9 @@ class ReliableQueue(Queue):
             request.processing_children = False
             request.callback(
                 QueueItem(
-                    path, data, self._client, self._item_processed_callback))
+                    path, self._decode(path, data, stat), self._client,
+                    self._item_processed_callback,
+                    self._item_released_callback))
 
         def on_reservation_failed(failure=None):
             """If we can't get the node or reserve, continue processing
@@ -370,16 +767,51 @@ class SerializedQueue(Queue):
 
     This implementation aggregates a reliable queue, with a lock to provide
     for serialized consumer access. The lock is released only when a queue item
-    has been processed.
+    has been processed. The lock reports its wait and hold times to the metrics
+    hook, by default the client's.
     """
 
-    def __init__(self, path, client, acl=None, persistent=False):
-        super(SerializedQueue, self).__init__(path, client, acl, persistent)
-        self._lock = Lock("%s/%s" % (self.path, "_lock"), client)
+    def __init__(self, path, client, acl=None, persistent=False, codec=None,
+                 metrics=None):
+        super(SerializedQueue, self).__init__(
+            path, client, acl, persistent, codec)
+        self._lock = Lock("%s/%s" % (self.path, "_lock"), client, metrics)
 
     def _item_processed_callback(self, result_code, item_path):
         return self._lock.release()
 
+    def _item_released_callback(self, item_path):
+        if self._lock.acquired:
+            return self._lock.release()
+
+    def _get_stats(self, generation=None):
+        """
+        Retrieve the stats of the queue, and whether its lock is held, as it
+        is while an item is processed.
+        """
+        d = self._get_stats_children(self._path, generation)
+        d.addCallback(self._get_lock_stats, generation)
+        return d
+
+    def _get_lock_stats(self, children, generation):
+        if "_lock" not in children:
+            return self._count_items(children)
+        d = self._get_stats_children(self._lock.path, generation)
+        d.addErrback(lambda failure: failure.trap(zookeeper.NoNodeException))
+        d.addCallback(
+            lambda holders: self._count_items(children, bool(holders)))
+        return d
+
+    def _count_items(self, children, locked=False):
+        """
+        The first item of the queue is in flight while the queue's lock is
+        held, the lock directory isn't an item.
+        """
+        stats = super(SerializedQueue, self)._count_items(children)
+        if locked and stats.pending:
+            return QueueStats(stats.pending - 1, 1, stats.total)
+        return stats
+
     def _filter_children(self, children, suffix="-processing"):
         """
         Filter the lock from consideration as an item to be processed.
@@ -424,12 +856,25 @@ class SerializedQueue(Queue):
         at the moment, a deferred is return that will fire when an item
         is available.
         """
-        d = self._lock.acquire()
+        d = self._acquire_lock()
+        d.addCallback(self._on_lock_acquired)
+        return d
 
+    def _acquire_lock(self):
+        d = self._lock.acquire()
         d.addErrback(self._on_lock_directory_does_not_exist)
-        d.addCallback(self._on_lock_acquired)
         return d
 
+    def consume(self, handler, concurrency=1):
+        """
+        Continuously consume items from the queue in order, passing each to
+        the handler. Items are processed serially, so the concurrency must
+        be one.
+        """
+        if concurrency != 1:
+            raise ValueError("serialized queues are consumed serially")
+        return SerializedQueueConsumer(self, handler).start()
+
     def _get_item(self, children, request):
 
         def fetch_node(name):
@@ -443,7 +888,9 @@ class SerializedQueue(Queue):
             request.processing_children = False
             request.callback(
                 QueueItem(
-                    path, data, self._client, self._item_processed_callback))
+                    path, self._decode(path, data, stat), self._client,
+                    self._item_processed_callback,
+                    self._item_released_callback))
 
         def on_reservation_failed(failure=None):
             """If we can't get the node or reserve, continue processing
@@ -25,13 +25,23 @@ A retry client facade that transparently handles transient connection
 errors.
 """
 
+from collections import deque
+import random
 import time
 
 import zookeeper
 
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.python.failure import Failure
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, fail, maybeDeferred)
 
-__all__ = ["retry", "RetryClient"]
+from txzookeeper.metrics import get_metrics
+
+__all__ = ["retry", "RetryClient", "Backoff", "RetryBudget",
+           "ReconnectGate", "CircuitBreaker", "CircuitOpenException"]
+
+FULL_JITTER = "full"
+DECORRELATED_JITTER = "decorrelated"
 
 
 def is_retryable(e):
@@ -70,6 +80,287 @@ def get_delay(session_timeout, max_delay=5, session_fraction=30.0):
     return min(retry_delay, max_delay)
 
 
+class Backoff(object):
+    """Exponential backoff between retries of an operation.
+
+    Delays are randomized (jittered) so that operations which failed
+    together, such as during a leader election, don't retry in
+    synchronized waves.
+
+    With full jitter a delay is chosen uniformly between zero and the
+    exponential delay for the attempt. With decorrelated jitter it's
+    chosen between the base delay and three times the previous delay.
+    """
+
+    def __init__(self, base=0.1, max_delay=5, jitter=FULL_JITTER,
+                 random=random.random):
+        """
+        :param base: The base delay, in seconds.
+        :param max_delay: The max delay for a retry, in seconds.
+        :param jitter: FULL_JITTER, DECORRELATED_JITTER or None for
+               plain exponential delays.
+        :param random: A function returning a random float in [0, 1).
+        """
+        if jitter not in (FULL_JITTER, DECORRELATED_JITTER, None):
+            raise ValueError("Unknown jitter %r" % (jitter,))
+        self.base = base
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self._random = random
+
+    def get_delay(self, attempt, previous=None):
+        """Get the delay before retrying an operation.
+
+        :param attempt: The number of retries of the operation so far.
+        :param previous: The previous delay of the operation, if any.
+        """
+        if self.jitter == DECORRELATED_JITTER:
+            upper = max(self.base, (previous or self.base) * 3)
+            delay = self.base + self._random() * (upper - self.base)
+        else:
+            delay = self.base * 2 ** min(attempt, 32)
+            if self.jitter == FULL_JITTER:
+                delay *= self._random()
+        return min(delay, self.max_delay)
+
+
+class RetryBudget(object):
+    """A token bucket limiting retries to a fraction of operations.
+
+    Each operation deposits `ratio` tokens, and each retry withdraws a
+    token, retries are refused while the bucket is empty. Tokens are also
+    replenished at a minimum rate, so that clients with little traffic
+    can still retry.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=10, max_tokens=100,
+                 clock=time.time):
+        """
+        :param ratio: The retries allowed per operation.
+        :param min_per_second: The retries always allowed per second.
+        :param max_tokens: The capacity of the bucket, the bucket starts
+               full.
+        :param clock: A function returning the current time in seconds.
+        """
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._clock = clock
+        self._tokens = float(max_tokens)
+        self._updated = clock()
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.max_tokens,
+            self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        """Record an operation."""
+        self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Withdraw a token for a retry, returns False if none are left.
+        """
+        self._refill()
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+
+class ReconnectGate(object):
+    """Parks operations that failed while the connection is down, until
+    it's reestablished.
+
+    The gate is fed session events by its client. Once the client
+    reconnects, parked operations are released in batches at a fixed
+    interval, so the ensemble isn't hit by all of them at once. If the
+    session is lost instead, they're released to fail.
+    """
+
+    def __init__(self, batch_size=100, interval=0.01, clock=None):
+        """
+        :param batch_size: The number of operations released at once.
+        :param interval: The delay between batches, in seconds.
+        :param clock: An IReactorTime provider, defaults to the reactor.
+        """
+        self.batch_size = batch_size
+        self.interval = interval
+        self._clock = clock
+        self._waiters = deque()
+        self._drain_call = None
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def _get_clock(self):
+        if self._clock is None:
+            from twisted.internet import reactor
+            self._clock = reactor
+        return self._clock
+
+    def wait(self, timeout):
+        """Park an operation until the connection is reestablished.
+
+        Returns a deferred that fires with True when the operation should
+        be retried, or False if the session is lost or the timeout
+        expires first.
+
+        :param timeout: The maximum time to wait, in seconds.
+        """
+        d = Deferred()
+        waiter = [d, None]
+
+        def expire():
+            try:
+                self._waiters.remove(waiter)
+            except ValueError:
+                return
+            d.callback(False)
+
+        waiter[1] = self._get_clock().callLater(max(timeout, 0), expire)
+        self._waiters.append(waiter)
+        return d
+
+    def session_event(self, event):
+        """Process a session event from the client.
+        """
+        state = event.connection_state
+        if state == zookeeper.CONNECTED_STATE:
+            if self._drain_call is None:
+                self._drain()
+        elif state == zookeeper.CONNECTING_STATE:
+            self._stop_drain()
+        else:
+            # The session is gone, parked operations can't succeed.
+            self._stop_drain()
+            self._release(len(self._waiters), False)
+
+    def _stop_drain(self):
+        if self._drain_call is not None:
+            self._drain_call.cancel()
+            self._drain_call = None
+
+    def _drain(self):
+        self._drain_call = None
+        self._release(self.batch_size, True)
+        if self._waiters:
+            self._drain_call = self._get_clock().callLater(
+                self.interval, self._drain)
+
+    def _release(self, count, value):
+        # Operations released may park again, only release those waiting.
+        for i in range(min(count, len(self._waiters))):
+            d, expire_call = self._waiters.popleft()
+            expire_call.cancel()
+            d.callback(value)
+
+
+class CircuitOpenException(zookeeper.ZooKeeperException):
+    """Raised for operations refused by an open circuit breaker.
+    """
+
+
+class CircuitBreaker(object):
+    """Fails operations fast while the ensemble is unreachable.
+
+    The breaker is closed while operations succeed. After `threshold`
+    consecutive connection errors it opens, and refuses operations for
+    `reset_timeout` seconds. It's then half open, and allows a single
+    probe operation, whose success closes the breaker, while another
+    connection error opens it again. A probe which hasn't completed
+    within `reset_timeout` seconds is presumed lost, and another probe
+    is allowed.
+
+    Errors other than connection errors are responses from the ensemble,
+    and count as successes.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, reset_timeout=5, clock=time.time):
+        """
+        :param threshold: The consecutive connection errors opening the
+               breaker.
+        :param reset_timeout: The time to wait before probing, in seconds.
+        :param clock: A function returning the current time in seconds.
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened = None
+        self._probe_started = None
+        self._subscribers = []
+
+    @property
+    def state(self):
+        return self._state
+
+    def subscribe(self, callback):
+        """Subscribe to state transitions, the callback is invoked with
+        the previous and the new state.
+        """
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def allow(self):
+        """Determine if an operation may proceed.
+        """
+        if self._state == self.OPEN:
+            if self._clock() < self._opened + self.reset_timeout:
+                return False
+            self._transition(self.HALF_OPEN)
+        if self._state == self.HALF_OPEN:
+            now = self._clock()
+            if (self._probe_started is not None and
+                now < self._probe_started + self.reset_timeout):
+                return False
+            self._probe_started = now
+        return True
+
+    def record_success(self):
+        self._failures = 0
+        self._probe_started = None
+        if self._state != self.CLOSED:
+            self._transition(self.CLOSED)
+
+    def reset(self):
+        """Close the breaker, such as once the client has reconnected.
+        """
+        self.record_success()
+
+    def record_failure(self):
+        self._failures += 1
+        self._probe_started = None
+        if (self._state == self.HALF_OPEN or
+            (self._state == self.CLOSED and
+             self._failures >= self.threshold)):
+            self._opened = self._clock()
+            self._transition(self.OPEN)
+
+    def _transition(self, state):
+        previous, self._state = self._state, state
+        for callback in list(self._subscribers):
+            callback(previous, state)
+
+
+def _op_name(func):
+    return getattr(func, "__name__", "unknown")
+
+
 def check_retryable(retry_client, max_time, error):
     """Check an error and a client to see if an operation is retryable.
 
@@ -96,13 +387,12 @@ def check_retryable(retry_client, max_time, error):
     return True
 
 
-@inlineCallbacks
 def retry(client, func, *args, **kw):
     """Constructs a retry wrapper around a function that retries invocations.
 
     If the function execution results in an exception due to a transient
     connection error, the retry wrapper will reinvoke the operation after
-    a suitable delay (fractional value of the session timeout).
+    a suitable delay (an exponential backoff with jitter).
 
     :param client: A ZookeeperClient instance.
     :param func: A callable python object that interacts with
@@ -111,6 +401,38 @@ def retry(client, func, *args, **kw):
            must return a single value (either a deferred or result
            value).
     """
+    return _retry(client, func, args, kw)
+
+
+def _should_park(client, gate):
+    """Determine if a failed operation should wait for a reconnect.
+    """
+    return gate is not None and client.state == zookeeper.CONNECTING_STATE
+
+
+def _check_budget(budget, metrics, op):
+    """Verify a retry is within budget, and record it.
+    """
+    if budget is not None and not budget.withdraw():
+        if metrics is not None:
+            metrics.increment("retry.budget_exhausted", op=op)
+        return False
+    if metrics is not None:
+        metrics.increment("retry.retries", op=op)
+    return True
+
+
+@inlineCallbacks
+def _retry(client, func, args, kw, backoff=None, budget=None, metrics=None,
+           gate=None):
+    if backoff is None:
+        backoff = Backoff()
+    if budget is not None:
+        budget.deposit()
+    op = _op_name(func)
+    attempt = 0
+    delay = None
+
     while 1:
         try:
             value = yield func(*args, **kw)
@@ -120,16 +442,35 @@ def retry(client, func, *args, **kw):
             session_timeout = client.session_timeout or 0
 
             # If we keep retrying past the 1.5 * session timeout without
-            # success just die, the session expiry is fatal.
-            max_time = session_timeout * 1.5 + time.time()
+            # success just die, the session expiry is fatal. The session
+            # timeout is in milliseconds.
+            max_time = session_timeout / 1000.0 * 1.5 + time.time()
             if not check_retryable(client, max_time, e):
                 raise
 
-            # Give the connection a chance to auto-heal.
-            yield sleep(get_delay(session_timeout))
-            continue
-
-        returnValue(value)
+            # Wait for the connection to be reestablished, the gate
+            # controls the rate at which parked operations resume.
+            if _should_park(client, gate):
+                error = e
+            # Don't add to the load of a recovering ensemble beyond budget.
+            elif not _check_budget(budget, metrics, op):
+                raise
+            else:
+                # Give the connection a chance to auto-heal.
+                delay = backoff.get_delay(attempt, delay)
+                attempt += 1
+                yield sleep(delay)
+                continue
+        else:
+            returnValue(value)
+
+        if metrics is not None:
+            metrics.increment("retry.parked", op=op)
+        released = yield gate.wait(max_time - time.time())
+        if not released:
+            raise error
+        if metrics is not None:
+            metrics.increment("retry.retries", op=op)
 
 
 def retry_watch(client, func, *args, **kw):
@@ -137,7 +478,7 @@ def retry_watch(client, func, *args, **kw):
 
     If the callable execution results in an exception due to a transient
     connection error, the retry wrapper will reinvoke the operation after
-    a suitable delay (fractional value of the session timeout).
+    a suitable delay (an exponential backoff with jitter).
 
     A watch function must return back a tuple of deferreds
     (value_deferred, watch_deferred). No inline callbacks are
@@ -153,13 +494,26 @@ def retry_watch(client, func, *args, **kw):
            parameter of this function. The function must return a
            tuple of (value_deferred, watch_deferred)
     """
+    return _retry_watch(client, func, args, kw)
+
+
+def _retry_watch(client, func, args, kw, backoff=None, budget=None,
+                 metrics=None, gate=None):
+    if backoff is None:
+        backoff = Backoff()
+    if budget is not None:
+        budget.deposit()
+    op = _op_name(func)
+    state = {"attempt": 0, "delay": None}
+
     # For clients which aren't connected (session timeout == None)
     # we raise the usage errors to the callers
     session_timeout = client.session_timeout or 0
 
     # If we keep retrying past the 1.5 * session timeout without
-    # success just die, the session expiry is fatal.
-    max_time = session_timeout * 1.5 + time.time()
+    # success just die, the session expiry is fatal. The session
+    # timeout is in milliseconds.
+    max_time = session_timeout / 1000.0 * 1.5 + time.time()
     value_d, watch_d = func(*args, **kw)
 
     def retry_delay(f):
@@ -169,12 +523,33 @@ def retry_watch(client, func, *args, **kw):
         if not check_retryable(client, max_time, f.value):
             return f
 
+        if _should_park(client, gate):
+            if metrics is not None:
+                metrics.increment("retry.parked", op=op)
+            d = gate.wait(max_time - time.time())
+            d.addCallback(retry_released, f)
+            return d
+
+        if not _check_budget(budget, metrics, op):
+            return f
+
         # Give the connection a chance to auto-heal
-        d = sleep(get_delay(session_timeout))
+        state["delay"] = backoff.get_delay(state["attempt"], state["delay"])
+        state["attempt"] += 1
+        d = sleep(state["delay"])
         d.addCallback(retry_inner)
 
         return d
 
+    def retry_released(released, f):
+        """Retry a parked operation, if it was released to retry.
+        """
+        if not released:
+            return f
+        if metrics is not None:
+            metrics.increment("retry.retries", op=op)
+        return retry_inner(None)
+
     def retry_inner(value):
         """Retry operation invoker.
         """
@@ -232,54 +607,194 @@ class RetryClient(object):
 
     All the methods of the client that interact with the zookeeper tree
     are retry enabled.
+
+    Operations that fail while the client is reconnecting are parked on a
+    reconnect gate, fed by the client's session events, and resume once
+    the connection is reestablished. Other retries are delayed by an
+    exponential backoff with jitter, and may be limited by a retry budget
+    shared by all operations of the client. Retries, parked operations
+    and budget exhaustion are counted per operation by the metrics hook,
+    as `retry.retries`, `retry.parked` and `retry.budget_exhausted`.
+
+    With a circuit breaker, operations fail fast with a
+    CircuitOpenException while the ensemble is unreachable. If a read
+    cache is given, `get` and `get_and_watch` results are stored in it,
+    and served from it while the breaker is open. A result served from
+    the cache is the last one read for its path, there's no bound on its
+    staleness beyond the time since that read, which is at least as long
+    as the breaker has been open. Applications which can't tolerate it
+    shouldn't use a read cache. The watch of a `get_and_watch` served
+    from the cache never fires. Refused operations and breaker
+    transitions are counted as `circuit.rejected` and
+    `circuit.transitions`.
+
+    The gate is fed by a session listener on the wrapped client, which
+    runs ahead of the client's session callback. The session callback
+    is left to the application, and may be set on either client.
     """
 
-    def __init__(self, client):
+    def __init__(self, client, backoff=None, budget=None, metrics=None,
+                 gate=None, breaker=None, read_cache=None):
+        """
+        :param client: The ZookeeperClient to wrap.
+        :param backoff: The Backoff policy for delaying retries.
+        :param budget: An optional RetryBudget, shared by all operations.
+        :param metrics: The metrics hook, defaults to the client's.
+        :param gate: The ReconnectGate parking operations while the
+               client reconnects.
+        :param breaker: An optional CircuitBreaker.
+        :param read_cache: An optional mapping of paths to `get` results,
+               such as a dict, used while the breaker is open.
+        """
         self.client = client
+        if backoff is None:
+            backoff = Backoff()
+        if metrics is None:
+            metrics = get_metrics(client)
+        if gate is None:
+            gate = ReconnectGate()
+        self.backoff = backoff
+        self.budget = budget
+        self.metrics = metrics
+        self.gate = gate
+        self.breaker = breaker
+        self.read_cache = read_cache
+        if breaker is not None:
+            breaker.subscribe(self._cb_breaker_transition)
+        client.add_session_listener(self._cb_session_event)
+
+    def _cb_session_event(self, client, event):
+        if (self.breaker is not None and
+            event.connection_state == zookeeper.CONNECTED_STATE):
+            self.breaker.reset()
+        self.gate.session_event(event)
+
+    def _cb_breaker_transition(self, previous, state):
+        if self.metrics is not None:
+            self.metrics.increment("circuit.transitions", state=state)
+
+    def _reject(self, op):
+        if self.metrics is not None:
+            self.metrics.increment("circuit.rejected", op=op)
+        return CircuitOpenException("Circuit open, %s refused" % op)
+
+    def _record(self, result):
+        if isinstance(result, Failure) and is_retryable(result.value):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return result
+
+    def _guard(self, func):
+        """Wrap an operation, so each attempt passes the circuit breaker.
+        """
+        if self.breaker is None:
+            return func
+        op = _op_name(func)
+
+        def guarded(*args, **kw):
+            if not self.breaker.allow():
+                return fail(self._reject(op))
+            d = maybeDeferred(func, *args, **kw)
+            d.addBoth(self._record)
+            return d
+        guarded.__name__ = op
+        return guarded
+
+    def _guard_watch(self, func):
+        """Wrap a watch operation, so each attempt passes the circuit
+        breaker.
+        """
+        if self.breaker is None:
+            return func
+        op = _op_name(func)
+
+        def guarded(*args, **kw):
+            if not self.breaker.allow():
+                return fail(self._reject(op)), Deferred()
+            value_d, watch_d = func(*args, **kw)
+            value_d.addBoth(self._record)
+            return value_d, watch_d
+        guarded.__name__ = op
+        return guarded
+
+    def _retry(self, func, *args, **kw):
+        return _retry(self.client, self._guard(func), args, kw,
+                      self.backoff, self.budget, self.metrics, self.gate)
+
+    def _retry_watch(self, func, *args, **kw):
+        return _retry_watch(self.client, self._guard_watch(func), args, kw,
+                            self.backoff, self.budget, self.metrics,
+                            self.gate)
+
+    def _cache_read(self, d, args, kw):
+        """Store a read's result in the read cache, or serve it from the
+        cache if the breaker refused the read.
+        """
+        if self.read_cache is None:
+            return
+        path = args[0] if args else kw.get("path")
+        d.addCallbacks(self._cb_cache_read, self._cb_cached_read,
+                       callbackArgs=(path,), errbackArgs=(path,))
+
+    def _cb_cache_read(self, result, path):
+        self.read_cache[path] = result
+        return result
+
+    def _cb_cached_read(self, failure, path):
+        failure.trap(CircuitOpenException)
+        result = self.read_cache.get(path)
+        if result is None:
+            return failure
+        return result
 
     def add_auth(self, *args, **kw):
-        return retry(self.client, self.client.add_auth, *args, **kw)
+        return self._retry(self.client.add_auth, *args, **kw)
 
     def create(self, *args, **kw):
-        return retry(self.client, self.client.create, *args, **kw)
+        return self._retry(self.client.create, *args, **kw)
 
     def delete(self, *args, **kw):
-        return retry(self.client, self.client.delete, *args, **kw)
+        return self._retry(self.client.delete, *args, **kw)
 
     def exists(self, *args, **kw):
-        return retry(self.client, self.client.exists, *args, **kw)
+        return self._retry(self.client.exists, *args, **kw)
 
     def get(self, *args, **kw):
-        return retry(self.client, self.client.get, *args, **kw)
+        d = self._retry(self.client.get, *args, **kw)
+        self._cache_read(d, args, kw)
+        return d
 
     def get_acl(self, *args, **kw):
-        return retry(self.client, self.client.get_acl, *args, **kw)
+        return self._retry(self.client.get_acl, *args, **kw)
 
     def get_children(self, *args, **kw):
-        return retry(self.client, self.client.get_children, *args, **kw)
+        return self._retry(self.client.get_children, *args, **kw)
 
     def set_acl(self, *args, **kw):
-        return retry(self.client, self.client.set_acl, *args, **kw)
+        return self._retry(self.client.set_acl, *args, **kw)
 
     def set(self, *args, **kw):
-        return retry(self.client, self.client.set, *args, **kw)
+        return self._retry(self.client.set, *args, **kw)
 
     def sync(self, *args, **kw):
-        return retry(self.client, self.client.sync, *args, **kw)
+        return self._retry(self.client.sync, *args, **kw)
 
     # Watch retries
 
     def exists_and_watch(self, *args, **kw):
-        return retry_watch(
-            self.client, self.client.exists_and_watch, *args, **kw)
+        return self._retry_watch(
+            self.client.exists_and_watch, *args, **kw)
 
     def get_and_watch(self, *args, **kw):
-        return retry_watch(
-            self.client, self.client.get_and_watch, *args, **kw)
+        value_d, watch_d = self._retry_watch(
+            self.client.get_and_watch, *args, **kw)
+        self._cache_read(value_d, args, kw)
+        return value_d, watch_d
 
     def get_children_and_watch(self, *args, **kw):
-        return retry_watch(
-            self.client, self.client.get_children_and_watch, *args, **kw)
+        return self._retry_watch(
+            self.client.get_children_and_watch, *args, **kw)
 
     # Passthrough methods
 
@@ -292,6 +807,12 @@ class RetryClient(object):
     def set_session_callback(self, *args, **kw):
         return self.client.set_session_callback(*args, **kw)
 
+    def add_session_listener(self, *args, **kw):
+        return self.client.add_session_listener(*args, **kw)
+
+    def remove_session_listener(self, *args, **kw):
+        return self.client.remove_session_listener(*args, **kw)
+
     def set_determinstic_order(self, *args, **kw):
         return self.client.set_determinstic_order(*args, **kw)
 
@@ -309,3 +830,4 @@ class RetryClient(object):
     handle = _passproperty("handle")
     connected = _passproperty("connected")
     unrecoverable = _passproperty("unrecoverable")
+    codec = _passproperty("codec")
@@ -0,0 +1,333 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import zookeeper
+
+from twisted.internet.defer import Deferred, fail, succeed
+
+from txzookeeper.lock import LockError, LockTimeout
+
+__all__ = ["Semaphore"]
+
+
+class Semaphore(object):
+    """
+    A distributed counting semaphore, allowing up to `max_leases` holders
+    at once.
+
+    Each acquisition creates an ephemeral sequence candidate node, the
+    first `max_leases` candidates hold a lease. Acquisition is herd free,
+    each candidate watches only its immediate predecessor. As leases may
+    be released out of order, a holder notified of its predecessor's
+    departure signals the candidates following it within the leases, by
+    setting their nodes' content, which waiters watch. Several leases may
+    be freed at once, so all of them are signalled, not only the last.
+
+    The lease and waiter counts are served from memory. They're kept
+    current by a child watch on the semaphore once `watch_counts` is
+    called, and otherwise reflect this instance's last acquisition.
+    """
+
+    prefix = "lease-"
+
+    def __init__(self, client, path, max_leases):
+        """
+        @param client: A connected C{ZookeeperClient} instance.
+        @param path: The path of the semaphore's directory, which must
+        exist.
+        @param max_leases: The maximum number of concurrent holders, the
+        same for all users of the semaphore.
+        """
+        if max_leases < 1:
+            raise ValueError("A semaphore requires at least one lease")
+        self._client = client
+        self._path = path
+        self._max_leases = max_leases
+        self._candidate_path = None
+        self._acquired = False
+        self._acquiring = None
+        self._timeout_call = None
+        self._watched = None
+        self._watching_self = False
+        self._seen_version = 0
+        self._children = []
+        self._counts_watched = False
+        self._counts_generation = 0
+
+    @property
+    def path(self):
+        """Return the path to the semaphore."""
+        return self._path
+
+    @property
+    def max_leases(self):
+        return self._max_leases
+
+    @property
+    def acquired(self):
+        """Is a lease held. Returns a boolean"""
+        return self._acquired
+
+    @property
+    def lease_count(self):
+        """
+        The number of leases held, as of this instance's last view of the
+        semaphore.
+        """
+        return min(len(self._children), self._max_leases)
+
+    @property
+    def waiting_count(self):
+        """
+        The number of waiters, as of this instance's last view of the
+        semaphore.
+        """
+        return max(len(self._children) - self._max_leases, 0)
+
+    def watch_counts(self):
+        """
+        Maintain the lease and waiter counts from a child watch on the
+        semaphore. Returns a deferred which fires once the watch is
+        established.
+        """
+        if self._counts_watched:
+            return succeed(self)
+        self._counts_watched = True
+        return self._refresh_counts()
+
+    def unwatch_counts(self):
+        """Stop maintaining the lease and waiter counts."""
+        self._counts_watched = False
+        self._counts_generation += 1
+
+    def _refresh_counts(self):
+        # Each refresh sets a new watch, those of previous refreshes are
+        # ignored, so a single chain of refreshes is active.
+        self._counts_generation += 1
+        generation = self._counts_generation
+
+        d, watch_d = self._client.get_children_and_watch(self.path)
+        watch_d.addCallbacks(
+            self._on_counts_changed, self._on_counts_watch_error,
+            callbackArgs=(generation,), errbackArgs=(generation,))
+
+        def on_children(children):
+            if generation == self._counts_generation:
+                self._children = self._candidates(children)
+            return self
+
+        def on_error(failure):
+            if generation == self._counts_generation:
+                self.unwatch_counts()
+            return failure
+
+        d.addCallbacks(on_children, on_error)
+        return d
+
+    def _on_counts_changed(self, event, generation):
+        if generation == self._counts_generation:
+            d = self._refresh_counts()
+            # The counts are no longer watched on error.
+            d.addErrback(lambda failure: None)
+
+    def _on_counts_watch_error(self, failure, generation):
+        if generation == self._counts_generation:
+            self.unwatch_counts()
+
+    def _candidates(self, children):
+        return sorted(
+            [name for name in children if name.startswith(self.prefix)],
+            key=lambda name: name[-10:])
+
+    def acquire(self, timeout=None):
+        """
+        Acquire a lease.
+
+        @param timeout: The maximum time to wait for a lease, in seconds,
+        after which the attempt is abandoned with a C{LockTimeout}.
+        """
+        if self._acquired:
+            return fail(LockError("Already holding a lease %s" % self.path))
+
+        if self._acquiring is not None:
+            return fail(LockError("Already attempting to acquire a lease"))
+
+        d = self._acquiring = Deferred()
+        if timeout is not None:
+            from twisted.internet import reactor
+            self._timeout_call = reactor.callLater(timeout, self._on_timeout)
+
+        c_d = self._client.create(
+            "/".join((self.path, self.prefix)),
+            flags=zookeeper.EPHEMERAL | zookeeper.SEQUENCE)
+        c_d.addCallback(self._on_candidate_create, d)
+        c_d.addErrback(self._on_error, d)
+        return d
+
+    def _on_candidate_create(self, path, d):
+        if self._acquiring is not d:
+            # The attempt was abandoned while creating the candidate.
+            return self._delete(path)
+        self._candidate_path = path
+        self._seen_version = 0
+        return self._check(path)
+
+    def _check(self, candidate, signal=False):
+        if self._candidate_path != candidate:
+            return
+        d = self._client.get_children(self.path)
+        d.addCallback(self._check_candidates, candidate, signal)
+        d.addErrback(self._on_error, self._acquiring)
+        return d
+
+    def _check_candidates(self, children, candidate, signal):
+        if self._candidate_path != candidate:
+            return
+        children = self._candidates(children)
+        self._children = children
+
+        name = candidate[candidate.rfind("/") + 1:]
+        if name not in children:
+            # Our candidate is gone with our session.
+            self._reset()
+            return self._on_error(
+                LockError("Lease candidate lost %s" % candidate),
+                self._acquiring)
+        index = children.index(name)
+
+        if index > 0:
+            self._watch_predecessor(candidate, children[index - 1])
+
+        if index < self._max_leases:
+            if signal:
+                # Leases may have been freed, wake the candidates now
+                # within the leases, some of which may be waiting.
+                for name in children[index + 1:self._max_leases]:
+                    self._signal(name)
+            if not self._acquired:
+                self._acquired = True
+                self._cancel_timeout()
+                d, self._acquiring = self._acquiring, None
+                d.callback(self)
+        elif not self._watching_self:
+            self._watching_self = True
+            exists_d, watch_d = self._client.exists_and_watch(candidate)
+            watch_d.addCallback(self._on_signal, candidate)
+            exists_d.addCallback(self._on_self_exists, candidate)
+            exists_d.addErrback(self._on_error, self._acquiring)
+
+    def _on_self_exists(self, stat, candidate):
+        # A signal set after our listing, but before the watch was set,
+        # doesn't trigger the watch, it's detected by the node's version.
+        if self._candidate_path != candidate:
+            return
+        if stat is None or stat["version"] != self._seen_version:
+            if stat is not None:
+                self._seen_version = stat["version"]
+            return self._check(candidate)
+
+    def _watch_predecessor(self, candidate, previous):
+        if self._watched == previous:
+            return
+        self._watched = previous
+
+        exists_d, watch_d = self._client.exists_and_watch(
+            "/".join((self.path, previous)))
+
+        def on_exists(stat):
+            if stat is None:
+                return self._on_predecessor_change(None, candidate)
+            watch_d.addCallback(self._on_predecessor_change, candidate)
+
+        exists_d.addCallback(on_exists)
+        exists_d.addErrback(self._on_error, self._acquiring)
+
+    def _on_predecessor_change(self, event, candidate):
+        if self._candidate_path != candidate:
+            return
+        self._watched = None
+        return self._check(candidate, signal=True)
+
+    def _on_signal(self, event, candidate):
+        if self._candidate_path != candidate:
+            return
+        self._watching_self = False
+        return self._check(candidate)
+
+    def _signal(self, name):
+        d = self._client.set("/".join((self.path, name)), "")
+        d.addErrback(lambda failure: failure.trap(zookeeper.NoNodeException))
+        return d
+
+    def _on_error(self, failure, d):
+        if d is None or d.called or self._acquiring is not d:
+            return
+        self._abandon().addBoth(lambda result: d.errback(failure))
+
+    def _on_timeout(self):
+        self._timeout_call = None
+        d = self._acquiring
+        self._abandon().addBoth(lambda result: d.errback(
+            LockTimeout("Timed out acquiring a lease %s" % self.path)))
+
+    def _cancel_timeout(self):
+        if self._timeout_call is not None:
+            self._timeout_call.cancel()
+            self._timeout_call = None
+
+    def _abandon(self):
+        """
+        Abandon an acquisition attempt, removing the candidate if it was
+        created.
+        """
+        self._cancel_timeout()
+        self._acquiring = None
+        candidate = self._candidate_path
+        self._reset()
+        return self._delete(candidate)
+
+    def _delete(self, candidate):
+        if candidate is None:
+            return succeed(None)
+        d = self._client.delete(candidate)
+        d.addErrback(lambda failure: None)
+        return d
+
+    def _reset(self):
+        self._candidate_path = None
+        self._acquired = False
+        self._watched = None
+        self._watching_self = False
+
+    def release(self):
+        """Release the lease."""
+        if not self._acquired:
+            return fail(LockError("Not holding a lease %s" % self.path))
+
+        d = self._client.delete(self._candidate_path)
+
+        def on_delete_success(value):
+            self._reset()
+            return True
+
+        d.addCallback(on_delete_success)
+        return d
@@ -0,0 +1,268 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Export and import of subtrees, for backups and cloning environments.
+
+A snapshot is a stream of node records, in parent first order, written
+either as JSON lines or in a compact length prefixed binary format. Each
+record holds a node's path relative to the exported root, its data, its
+ACL and its ephemeral owner.
+
+Exports stream the subtree from a C{ZNode.walk} to the output, imports
+pipeline node creation. As zookeeper processes a session's requests in
+order, a child's creation can be issued before its parent's completes.
+"""
+
+from collections import namedtuple, deque
+import base64
+import json
+import struct
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+
+from txzookeeper.client import ZOO_OPEN_ACL_UNSAFE
+from txzookeeper.node import ZNode
+
+__all__ = ["export_tree", "import_tree", "read_snapshot", "SnapshotError",
+           "SnapshotRecord"]
+
+BINARY_MAGIC = "\x00TXZKSNAP\x01"
+JSON_FORMAT = "txzookeeper-snapshot"
+
+# path length, data length, ephemeral owner, acl length
+_record_header = struct.Struct(">HIqI")
+
+
+class SnapshotError(Exception):
+    """
+    Raised if a snapshot can't be read.
+    """
+
+
+class SnapshotRecord(
+    namedtuple("SnapshotRecord", "path data acls ephemeral_owner")):
+    """
+    A node in a snapshot.
+
+    @ivar path: The path of the node relative to the snapshot root, the
+    root itself has an empty path.
+    @ivar data: The node's data.
+    @ivar acls: The node's ACL, or None if it wasn't exported.
+    @ivar ephemeral_owner: The session id owning the node if ephemeral,
+    else zero.
+    """
+
+
+class JSONLinesWriter(object):
+
+    def __init__(self, output, root):
+        self._output = output
+        output.write(json.dumps(
+            {"format": JSON_FORMAT, "version": 1, "root": root}) + "\n")
+
+    def write(self, record):
+        self._output.write(json.dumps({
+            "path": record.path,
+            "data": base64.b64encode(record.data or ""),
+            "acls": record.acls,
+            "ephemeral_owner": record.ephemeral_owner}) + "\n")
+
+
+class BinaryWriter(object):
+
+    def __init__(self, output, root):
+        self._output = output
+        output.write(BINARY_MAGIC)
+        self.write(SnapshotRecord(root, "", None, 0))
+
+    def write(self, record):
+        path = record.path.encode("utf-8")
+        data = record.data or ""
+        acls = record.acls is not None and json.dumps(record.acls) or ""
+        self._output.write(_record_header.pack(
+            len(path), len(data), record.ephemeral_owner, len(acls)))
+        self._output.write(path)
+        self._output.write(data)
+        self._output.write(acls)
+
+
+def _read_exactly(input, size):
+    data = input.read(size)
+    if len(data) != size:
+        raise SnapshotError("Truncated snapshot")
+    return data
+
+
+def _read_binary(input):
+    # The first record holds the exported root.
+    first = True
+    while True:
+        header = input.read(_record_header.size)
+        if not header:
+            return
+        if len(header) != _record_header.size:
+            raise SnapshotError("Truncated snapshot")
+        path_size, data_size, owner, acls_size = _record_header.unpack(header)
+        path = _read_exactly(input, path_size).decode("utf-8")
+        data = _read_exactly(input, data_size)
+        acls = _read_exactly(input, acls_size)
+        if first:
+            first = False
+            continue
+        yield SnapshotRecord(
+            path, data, acls and json.loads(acls) or None, owner)
+
+
+def _read_json_lines(input):
+    for line in input:
+        entry = json.loads(line)
+        yield SnapshotRecord(
+            entry["path"], base64.b64decode(entry["data"]), entry["acls"],
+            entry["ephemeral_owner"])
+
+
+def read_snapshot(input):
+    """
+    Returns an iterator over the records of a snapshot, in either format.
+    """
+    magic = input.read(len(BINARY_MAGIC))
+    if magic == BINARY_MAGIC:
+        return _read_binary(input)
+
+    try:
+        header = json.loads(magic + input.readline())
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != JSON_FORMAT:
+        raise SnapshotError("Unknown snapshot format")
+    return _read_json_lines(input)
+
+
+def _relative_path(root, path):
+    if path == root:
+        return ""
+    if root == "/":
+        return path
+    return path[len(root):]
+
+
+@inlineCallbacks
+def export_tree(client, path, output, binary=False, include_acls=True,
+                concurrency=32):
+    """
+    Export the subtree rooted at path to a file like object. The zookeeper
+    system subtree is excluded.
+
+    @param client: A connected C{ZookeeperClient} instance.
+    @param path: The root of the exported subtree.
+    @param output: A file like object to write the snapshot to.
+    @param binary: Boolean, write the binary format instead of JSON lines.
+    @param include_acls: Boolean, export the ACL of each node, this
+    requires a request per node.
+    @param concurrency: The maximum number of outstanding requests.
+    @return: A deferred with the number of nodes exported.
+    """
+    writer = (binary and BinaryWriter or JSONLinesWriter)(output, path)
+    walker = ZNode(path, client).walk(concurrency=concurrency)
+    pending = deque()
+    count = 0
+
+    @inlineCallbacks
+    def write_next():
+        (node_path, data, stat), d = pending.popleft()
+        acls = yield d
+        writer.write(SnapshotRecord(
+            _relative_path(path, node_path), data,
+            acls and acls[0] or None, stat["ephemeralOwner"]))
+
+    while True:
+        entry = yield walker.next()
+        if entry is None:
+            break
+        if entry[0] == "/zookeeper" or entry[0].startswith("/zookeeper/"):
+            continue
+        if include_acls:
+            d = client.get_acl(entry[0])
+        else:
+            d = succeed(None)
+        pending.append((entry, d))
+        count += 1
+        if len(pending) >= concurrency:
+            yield write_next()
+
+    while pending:
+        yield write_next()
+    returnValue(count)
+
+
+@inlineCallbacks
+def import_tree(client, input, path, restore_ephemerals=False,
+                concurrency=32):
+    """
+    Import a snapshot under the given path. Nodes which already exist have
+    their data replaced, their ACL is left unchanged.
+
+    @param client: A connected C{ZookeeperClient} instance.
+    @param input: A file like object to read the snapshot from.
+    @param path: The path the snapshot root is imported to, its parent
+    must exist.
+    @param restore_ephemerals: Boolean, recreate ephemeral nodes as
+    ephemerals of the importing session, by default they're skipped.
+    @param concurrency: The maximum number of outstanding requests.
+    @return: A deferred with the number of nodes imported.
+    """
+    pending = deque()
+    count = 0
+    root = path.rstrip("/")
+
+    def on_exists(failure, node_path, data):
+        failure.trap(zookeeper.NodeExistsException)
+        return client.set(node_path, data)
+
+    try:
+        for record in read_snapshot(input):
+            flags = 0
+            if record.ephemeral_owner:
+                if not restore_ephemerals:
+                    continue
+                flags = zookeeper.EPHEMERAL
+            node_path = (root + record.path) or "/"
+            d = client.create(
+                node_path, record.data,
+                record.acls or [ZOO_OPEN_ACL_UNSAFE], flags)
+            d.addErrback(on_exists, node_path, record.data)
+            pending.append(d)
+            count += 1
+            if len(pending) >= concurrency:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+    except:
+        # Consume the errors of the outstanding requests.
+        for d in pending:
+            d.addErrback(lambda failure: None)
+        raise
+    returnValue(count)
@@ -0,0 +1,121 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.barrier import Barrier, DoubleBarrier, BarrierError
+from txzookeeper.retry import sleep
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class BarrierTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(BarrierTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def test_wait_unset(self):
+        """
+        Waiting on a barrier which isn't set returns immediately.
+        """
+        barrier = Barrier(self.client, "/barrier")
+        yield barrier.wait()
+
+    @inlineCallbacks
+    def test_wait_till_removed(self):
+        """
+        Waiters are held till the barrier is removed.
+        """
+        barrier = Barrier(self.client, "/barrier")
+        yield barrier.set()
+        yield barrier.set()
+        d = barrier.wait()
+        yield sleep(0.1)
+        self.assertFalse(d.called)
+        yield barrier.remove()
+        yield d
+
+    @inlineCallbacks
+    def test_double_barrier_enter(self):
+        """
+        Participants entering a double barrier are held till all of them
+        entered.
+        """
+        b1, b2, b3 = [DoubleBarrier(self.client, "/barrier", 3)
+                      for i in range(3)]
+        d1 = b1.enter()
+        d2 = b2.enter()
+        yield sleep(0.1)
+        self.assertFalse(d1.called)
+        self.assertFalse(d2.called)
+        self.assertTrue(b1.entered)
+
+        yield b3.enter()
+        yield gatherResults([d1, d2])
+
+    @inlineCallbacks
+    def test_double_barrier_leave(self):
+        """
+        Participants leaving a double barrier are held till all of them
+        left, after which the barrier can be reused.
+        """
+        b1, b2, b3 = [DoubleBarrier(self.client, "/barrier", 3)
+                      for i in range(3)]
+        yield gatherResults([b1.enter(), b2.enter(), b3.enter()])
+
+        d1 = b1.leave()
+        d3 = b3.leave()
+        yield sleep(0.1)
+        self.assertFalse(d1.called)
+        self.assertFalse(d3.called)
+        self.assertFalse(b1.entered)
+
+        yield b2.leave()
+        yield gatherResults([d1, d3])
+        children = yield self.client.get_children("/barrier")
+        self.assertEqual(children, [])
+
+        # A new round waits again.
+        d1 = b1.enter()
+        yield sleep(0.1)
+        self.assertFalse(d1.called)
+        yield gatherResults([b2.enter(), b3.enter()])
+        yield d1
+
+    @inlineCallbacks
+    def test_double_barrier_errors(self):
+        """
+        Entering twice, or leaving without entering, is an error.
+        """
+        self.assertRaises(ValueError, DoubleBarrier, self.client, "/b", 0)
+        barrier = DoubleBarrier(self.client, "/barrier", 1)
+        yield self.failUnlessFailure(barrier.leave(), BarrierError)
+        yield barrier.enter()
+        yield self.failUnlessFailure(barrier.enter(), BarrierError)
+        yield barrier.leave()
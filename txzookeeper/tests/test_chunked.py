@@ -0,0 +1,233 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, fail
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.chunked import ChunkedStore, ChunkedValueError
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class ChunkedStoreTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(ChunkedStoreTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        self.store = ChunkedStore(self.client, chunk_size=10, window=2)
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def test_inline_value(self):
+        """
+        A value that fits in a chunk is stored as the node's content.
+        """
+        yield self.store.create("/small", "abc")
+        content, stat = yield self.client.get("/small")
+        self.assertEqual(content, "abc")
+        children = yield self.client.get_children("/small")
+        self.assertEqual(children, [])
+
+        value, stat = yield self.store.get("/small")
+        self.assertEqual(value, "abc")
+
+    @inlineCallbacks
+    def test_chunked_value(self):
+        """
+        A value larger than the chunk size is split into child chunks, and
+        reassembled on retrieval.
+        """
+        data = "".join([str(i) for i in range(50)])
+        yield self.store.create("/large", data)
+        children = yield self.client.get_children("/large")
+        self.assertEqual(len(children), 9)
+
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, data)
+
+    @inlineCallbacks
+    def test_get_stream(self):
+        """
+        Chunks are written in order to a consumer.
+        """
+        data = "abcdefghij" * 5 + "xyz"
+        yield self.store.create("/large", data)
+        written = []
+
+        class Consumer(object):
+            write = written.append
+
+        yield self.store.get_stream("/large", Consumer())
+        self.assertEqual(len(written), 6)
+        self.assertEqual("".join(written), data)
+
+    @inlineCallbacks
+    def test_set_replaces_chunks(self):
+        """
+        Setting a value removes the chunks of the previous value.
+        """
+        yield self.store.create("/large", "a" * 35)
+        yield self.store.set("/large", "b" * 25)
+        children = yield self.client.get_children("/large")
+        self.assertEqual(len(children), 3)
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, "b" * 25)
+
+        yield self.store.set("/large", "c")
+        children = yield self.client.get_children("/large")
+        self.assertEqual(children, [])
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, "c")
+
+    @inlineCallbacks
+    def test_set_bad_version(self):
+        """
+        A set with a stale version fails without leaving chunks behind.
+        """
+        yield self.store.create("/large", "a" * 35)
+        yield self.failUnlessFailure(
+            self.store.set("/large", "b" * 25, version=3),
+            zookeeper.BadVersionException)
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, "a" * 35)
+
+    @inlineCallbacks
+    def test_ephemeral_chunked_value(self):
+        """
+        Chunked values can't be stored on ephemeral nodes.
+        """
+        yield self.failUnlessFailure(
+            self.store.create(
+                "/large", "a" * 35, flags=zookeeper.EPHEMERAL),
+            ChunkedValueError)
+
+    @inlineCallbacks
+    def test_delete(self):
+        """
+        Deleting a node removes its chunks.
+        """
+        yield self.store.create("/large", "a" * 35)
+        yield self.store.delete("/large")
+        exists = yield self.client.exists("/large")
+        self.assertEqual(exists, None)
+
+    @inlineCallbacks
+    def test_delete_bad_version(self):
+        """
+        A delete with a stale version fails, and leaves the value intact.
+        """
+        yield self.store.create("/large", "a" * 35)
+        yield self.store.set("/large", "b" * 35)
+        yield self.failUnlessFailure(
+            self.store.delete("/large", version=0),
+            zookeeper.BadVersionException)
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, "b" * 35)
+
+        yield self.store.delete("/large", version=stat["version"])
+        exists = yield self.client.exists("/large")
+        self.assertEqual(exists, None)
+
+    @inlineCallbacks
+    def test_create_chunk_error(self):
+        """
+        A create failing to write a chunk removes the node and the chunks
+        written.
+        """
+        create = self.client.create
+
+        def failing_create(path, data="", acls=None, flags=0):
+            if path.endswith("-0000000002"):
+                return fail(zookeeper.ConnectionLossException())
+            return create(path, data, acls, flags)
+
+        self.client.create = failing_create
+        yield self.failUnlessFailure(
+            self.store.create("/large", "a" * 35),
+            zookeeper.ConnectionLossException)
+        exists = yield self.client.exists("/large")
+        self.assertEqual(exists, None)
+
+    @inlineCallbacks
+    def test_get_stream_consumer_error(self):
+        """
+        An error of the consumer fails the retrieval.
+        """
+        yield self.store.create("/large", "a" * 35)
+
+        class Consumer(object):
+
+            def write(self, data):
+                raise ValueError("disk full")
+
+        yield self.failUnlessFailure(
+            self.store.get_stream("/large", Consumer()), ValueError)
+
+    def replace_while_reading(self, data):
+        """
+        Replace the value of /large as its third chunk is read.
+        """
+        get = self.client.get
+        replaced = []
+
+        def racing_get(path):
+            if path.endswith("-0000000002") and not replaced:
+                replaced.append(path)
+                d = self.store.set("/large", data)
+                d.addCallback(lambda stat: get(path))
+                return d
+            return get(path)
+
+        self.client.get = racing_get
+
+    @inlineCallbacks
+    def test_get_concurrent_set(self):
+        """
+        A value replaced while it's read is read again.
+        """
+        yield self.store.create("/large", "a" * 35)
+        self.replace_while_reading("b" * 45)
+        value, stat = yield self.store.get("/large")
+        self.assertEqual(value, "b" * 45)
+
+    @inlineCallbacks
+    def test_get_stream_concurrent_set(self):
+        """
+        A value replaced while it's streamed, after chunks were written to
+        the consumer, fails the retrieval.
+        """
+        yield self.store.create("/large", "a" * 35)
+        self.replace_while_reading("b" * 45)
+        written = []
+
+        class Consumer(object):
+            write = written.append
+
+        yield self.failUnlessFailure(
+            self.store.get_stream("/large", Consumer()), ChunkedValueError)
+        self.assertEqual(written, ["a" * 10, "a" * 10])
@@ -34,7 +34,7 @@ from mocker import ANY, MATCH, ARGS
 from txzookeeper.tests import ZookeeperTestCase, utils
 from txzookeeper.client import (
     ZookeeperClient, ZOO_OPEN_ACL_UNSAFE, ConnectionTimeoutException,
-    ConnectionException, NotConnectedException, ClientEvent)
+    ConnectionException, NotConnectedException, ClientEvent, Stat)
 
 PUBLIC_ACL = ZOO_OPEN_ACL_UNSAFE
 
@@ -289,6 +289,46 @@ class ClientTests(ZookeeperTestCase):
         d.addCallback(verify_contents)
         return d
 
+    def test_compact_stat(self):
+        """
+        A client may return node stats as compact C{Stat} instances, which
+        also support dictionary style access.
+        """
+        self.client = ZookeeperClient("127.0.0.1:2181", 3000,
+                                      compact_stat=True)
+        d = self.client.connect()
+
+        def create_node(client):
+            return self.client.create("/foobar", "rabbit")
+
+        def get_contents(path):
+            return self.client.get(path)
+
+        def verify_get((data, stat)):
+            self.assertTrue(isinstance(stat, Stat))
+            self.assertEqual(stat.version, 0)
+            self.assertEqual(stat["dataLength"], 6)
+            self.assertEqual(stat, stat.as_dict())
+            self.assertRaises(KeyError, stat.__getitem__, "size")
+            return self.client.set("/foobar", "mouse")
+
+        def verify_set(stat):
+            self.assertTrue(isinstance(stat, Stat))
+            self.assertEqual(stat["version"], 1)
+            return self.client.exists("/foobar")
+
+        def verify_exists(stat):
+            self.assertTrue(isinstance(stat, Stat))
+            self.assertEqual(stat.get("version"), 1)
+            self.assertEqual(len(stat), 11)
+
+        d.addCallback(create_node)
+        d.addCallback(get_contents)
+        d.addCallback(verify_get)
+        d.addCallback(verify_set)
+        d.addCallback(verify_exists)
+        return d
+
     def test_get_with_error(self):
         """
         On get error the deferred's errback is raised.
@@ -0,0 +1,205 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import json
+
+from twisted.internet.defer import inlineCallbacks
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.codec import (
+    RawCodec, JSONCodec, ZlibCodec, CodecError, DecodeCache, FrozenDict,
+    MAGIC, decode, freeze, get_value)
+from txzookeeper.node import ZNode
+from txzookeeper.tests import TestCase
+from txzookeeper.tests.utils import deleteTree
+
+
+def json_content(data):
+    return MAGIC + JSONCodec.header + data
+
+
+class CodecTest(TestCase):
+
+    def test_raw_codec(self):
+        codec = RawCodec()
+        self.assertEqual(codec.encode("abc"), MAGIC + "\x00abc")
+        self.assertEqual(codec.decode(MAGIC + "\x00abc"), "abc")
+        self.assertRaises(CodecError, codec.encode, 1)
+
+    def test_json_codec(self):
+        codec = JSONCodec()
+        data = codec.encode({"a": [1, 2]})
+        self.assertEqual(data, json_content('{"a":[1,2]}'))
+        self.assertEqual(codec.decode(data), {"a": [1, 2]})
+
+    def test_zlib_codec(self):
+        """
+        Encodings above the minimum size are compressed.
+        """
+        codec = ZlibCodec(min_size=20)
+        value = {"key": "value" * 100}
+        data = codec.encode(value)
+        self.assertTrue(data.startswith(MAGIC + "\x10"))
+        self.assertTrue(len(data) < 100)
+        self.assertEqual(codec.decode(data), value)
+
+        self.assertEqual(codec.encode([1]), json_content("[1]"))
+
+    def test_header_detection(self):
+        """
+        Content of any format can be decoded by any codec, content without
+        a known header is returned as is.
+        """
+        data = ZlibCodec(min_size=0).encode([1, 2])
+        self.assertEqual(RawCodec().decode(data), [1, 2])
+        self.assertEqual(decode("plain"), "plain")
+        self.assertEqual(decode(""), "")
+
+        # A header byte alone, without the magic prefix, isn't decoded.
+        self.assertEqual(decode("\x01[1]"), "\x01[1]")
+        self.assertEqual(decode(MAGIC), MAGIC)
+
+    def test_invalid_content(self):
+        self.assertRaises(CodecError, decode, json_content("{"))
+
+    def test_decode_node_cache(self):
+        """
+        Node content is decoded once per node modification.
+        """
+        codec = JSONCodec(cache=DecodeCache(max_size=2))
+        data = codec.encode({"a": 1})
+        value = codec.decode_node("/a", data, {"mzxid": 1})
+        self.assertIdentical(
+            codec.decode_node("/a", data, {"mzxid": 1}), value)
+        self.assertNotIdentical(
+            codec.decode_node("/a", data, {"mzxid": 2}), value)
+
+        # The least recently used value is evicted.
+        codec.decode_node("/b", data, {"mzxid": 3})
+        self.assertNotIdentical(
+            codec.decode_node("/a", data, {"mzxid": 1}), value)
+
+    def test_cache_size(self):
+        """
+        A codec given a cache size decodes node content through a cache of
+        its own.
+        """
+        codec = JSONCodec(cache_size=2)
+        self.assertEqual(codec.cache._max_size, 2)
+        data = codec.encode({"a": 1})
+        value = codec.decode_node("/a", data, {"mzxid": 1})
+        self.assertIdentical(
+            codec.decode_node("/a", data, {"mzxid": 1}), value)
+        self.assertIdentical(JSONCodec().cache, None)
+
+
+class DecodeCacheTest(TestCase):
+
+    def test_size_bounds(self):
+        """
+        The cache is bounded by the number and encoded size of its values.
+        """
+        max_bytes = len(json_content("[1]")) * 3 - 1
+        cache = DecodeCache(max_size=10, max_bytes=max_bytes)
+        cache.decode("/a", json_content("[1]"), {"mzxid": 1})
+        cache.decode("/b", json_content("[2]"), {"mzxid": 1})
+        self.assertEqual(len(cache), 2)
+        cache.decode("/c", json_content("[3]"), {"mzxid": 1})
+        self.assertEqual(len(cache), 2)
+
+    def test_oversized_value(self):
+        """
+        A value whose content is larger than the byte bound isn't cached,
+        and doesn't evict the cached values.
+        """
+        small, large = json_content("[1]"), json_content("[1,2,3,4,5]")
+        cache = DecodeCache(max_bytes=len(small))
+        cache.decode("/a", small, {"mzxid": 1})
+        self.assertEqual(
+            cache.decode("/b", large, {"mzxid": 1}), [1, 2, 3, 4, 5])
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache._bytes, len(small))
+        cache.decode("/b", large, {"mzxid": 1})
+        self.assertEqual((cache.hits, cache.misses), (0, 3))
+
+    def test_decoder_key(self):
+        """
+        Values decoded by different decoders are cached separately.
+        """
+        cache = DecodeCache()
+        stat = {"mzxid": 1}
+        self.assertEqual(cache.decode("/a", "[1]", stat, json.loads), [1])
+        self.assertEqual(cache.decode("/a", "[1]", stat), "[1]")
+        self.assertEqual((cache.hits, cache.misses), (0, 2))
+        cache.decode("/a", "[1]", stat, json.loads)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_freeze(self):
+        """
+        A freezing cache shares immutable values.
+        """
+        cache = DecodeCache(freeze=True)
+        value = cache.decode(
+            "/a", json_content('{"a":[1,{"b":2}]}'), {"mzxid": 1})
+        self.assertTrue(isinstance(value, FrozenDict))
+        self.assertEqual(value, {"a": (1, {"b": 2})})
+        self.assertRaises(TypeError, value.__setitem__, "a", 1)
+        self.assertRaises(TypeError, value["a"][1].update, {})
+        self.assertEqual(freeze(set([1])), frozenset([1]))
+
+
+class DecodedValueTest(TestCase):
+
+    def setUp(self):
+        super(DecodedValueTest, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        return self.client.connect()
+
+    def tearDown(self):
+        super(DecodedValueTest, self).tearDown()
+        deleteTree(handle=self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def test_shared_value(self):
+        """
+        Readers of an unchanged node share its decoded value, a modified
+        node is decoded again.
+        """
+        cache = DecodeCache(freeze=True)
+        self.client.codec = JSONCodec(cache=cache)
+        node = ZNode("/config", self.client)
+        yield node.create({"flag": True})
+
+        value, stat = yield get_value(self.client, "/config")
+        value2 = yield node.get_data()
+        self.assertIdentical(value, value2)
+
+        yield node.set_data({"flag": False})
+        value3 = yield ZNode("/config", self.client).get_data()
+        self.assertEqual(value3, {"flag": False})
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_get_value_requires_codec(self):
+        return self.failUnlessFailure(
+            get_value(self.client, "/config"), CodecError)
@@ -0,0 +1,139 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.codec import JSONCodec, ZlibCodec
+from txzookeeper.counter import DistributedCounter
+from txzookeeper.retry import sleep
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class DistributedCounterTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(DistributedCounterTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def test_increment(self):
+        """
+        Increments are spread over the shards, whose sum is the value.
+        """
+        counter = DistributedCounter(self.client, "/hits", shards=4)
+        self.assertEqual((yield counter.get_value()), 0)
+
+        yield gatherResults([counter.increment() for i in range(20)])
+        yield counter.increment(5)
+        yield counter.decrement(2)
+        self.assertEqual((yield counter.get_value()), 23)
+
+        children = yield self.client.get_children("/hits")
+        self.assertTrue(0 < len(children) <= 4)
+
+    @inlineCallbacks
+    def test_shared_counter(self):
+        """
+        Counter instances with affinity update their own shard, and see
+        each other's increments.
+        """
+        counters = [DistributedCounter(self.client, "/hits", 4, True)
+                    for i in range(3)]
+        yield gatherResults(
+            [counter.increment() for counter in counters for i in range(5)])
+        for counter in counters:
+            self.assertEqual((yield counter.get_value()), 15)
+
+    @inlineCallbacks
+    def test_watch(self):
+        """
+        A watched counter maintains a cached value.
+        """
+        counter = DistributedCounter(self.client, "/hits", shards=2)
+        self.assertEqual(counter.cached_value, None)
+        yield counter.increment(3)
+        self.assertEqual((yield counter.watch()), 3)
+
+        other = DistributedCounter(self.client, "/hits", shards=2)
+        for i in range(4):
+            yield other.increment()
+
+        # Wait for the watches to catch up.
+        for i in range(50):
+            if counter.cached_value == 7:
+                break
+            yield sleep(0.05)
+        self.assertEqual(counter.cached_value, 7)
+
+        counter.stop_watching()
+        self.assertEqual(counter.cached_value, None)
+
+    @inlineCallbacks
+    def test_rewatch(self):
+        """
+        Watching the counter again after stopping doesn't leave the previous
+        watches maintaining the value.
+        """
+        counter = DistributedCounter(self.client, "/hits", shards=1)
+        yield counter.watch()
+        counter.stop_watching()
+        yield counter.watch()
+
+        watches = []
+        exists_and_watch = self.client.exists_and_watch
+
+        def counting_exists_and_watch(path):
+            watches.append(path)
+            return exists_and_watch(path)
+        self.patch(self.client, "exists_and_watch", counting_exists_and_watch)
+
+        yield counter.increment()
+        for i in range(50):
+            if counter.cached_value == 1:
+                break
+            yield sleep(0.05)
+        yield sleep(0.1)
+        self.assertEqual(counter.cached_value, 1)
+        self.assertEqual(watches, ["/hits/shard-0000"])
+
+    @inlineCallbacks
+    def test_client_codec(self):
+        """
+        The shards are encoded with the client's codec.
+        """
+        self.client.codec = ZlibCodec(min_size=0)
+        counter = DistributedCounter(self.client, "/hits", shards=1)
+        yield counter.increment(2)
+        content, stat = yield self.client.get("/hits/shard-0000")
+        self.assertEqual(self.client.codec.decode(content), 2)
+        self.assertNotEqual(content, JSONCodec().encode(2))
+        self.assertEqual((yield counter.get_value()), 2)
+
+    def test_invalid_shards(self):
+        self.assertRaises(
+            ValueError, DistributedCounter, self.client, "/hits", 0)
@@ -0,0 +1,283 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.client import ClientEvent
+from txzookeeper import managed
+from txzookeeper.election import LeaderElection, ElectionError
+from txzookeeper.retry import sleep
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class LeaderElectionTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(LeaderElectionTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        self.clients = []
+        self.events = []
+        return self.client.connect()
+
+    def tearDown(self):
+        for client in self.clients:
+            if client.connected:
+                client.close()
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def open_client(self):
+        client = ZookeeperClient("127.0.0.1:2181")
+        self.clients.append(client)
+        yield client.connect()
+        returnValue(client)
+
+    def election(self, identifier, client=None):
+        elected = Deferred()
+
+        def on_elected(election):
+            self.events.append(("elected", identifier))
+            if not elected.called:
+                elected.callback(election)
+
+        def on_demoted(election):
+            self.events.append(("demoted", identifier))
+
+        election = LeaderElection(
+            client or self.client, "/election", identifier,
+            on_elected=on_elected, on_demoted=on_demoted)
+        election.elected = elected
+        return election
+
+    @inlineCallbacks
+    def test_single_participant(self):
+        """
+        A lone participant is elected on joining.
+        """
+        election = self.election("a")
+        yield election.join()
+        self.assertTrue(election.is_leader)
+        self.assertEqual(election.leader, "a")
+        self.assertEqual(self.events, [("elected", "a")])
+        leader = yield election.get_leader()
+        self.assertEqual(leader, "a")
+
+    @inlineCallbacks
+    def test_followers_know_leader(self):
+        """
+        Followers aren't elected, and cache the leader's identifier.
+        """
+        e1, e2, e3 = [self.election(name) for name in "abc"]
+        yield e1.join()
+        yield e2.join()
+        yield e3.join()
+        yield sleep(0.1)
+        self.assertFalse(e2.is_leader)
+        self.assertFalse(e3.is_leader)
+        self.assertEqual(e2.leader, "a")
+        self.assertEqual(e3.leader, "a")
+
+    @inlineCallbacks
+    def test_failover(self):
+        """
+        When the leader leaves, its successor is elected, the other
+        followers aren't notified but can retrieve the new leader.
+        """
+        e1, e2, e3 = [self.election(name) for name in "abc"]
+        yield e1.join()
+        yield e2.join()
+        yield e3.join()
+
+        yield e1.leave()
+        self.assertFalse(e1.is_leader)
+        yield e2.elected
+        self.assertEqual(e2.leader, "b")
+        yield sleep(0.1)
+        self.assertFalse(e3.is_leader)
+        leader = yield e3.get_leader()
+        self.assertEqual(leader, "b")
+        self.assertEqual(
+            self.events,
+            [("elected", "a"), ("demoted", "a"), ("elected", "b")])
+
+    @inlineCallbacks
+    def test_failover_herd_free(self):
+        """
+        The leader's departure is only checked by its successor.
+        """
+        elections = [self.election(name) for name in "abcd"]
+        for election in elections:
+            yield election.join()
+        yield sleep(0.1)
+
+        listings = []
+        get_children = self.client.get_children
+
+        def counting_get_children(path):
+            listings.append(path)
+            return get_children(path)
+
+        self.client.get_children = counting_get_children
+        yield elections[0].leave()
+        yield elections[1].elected
+        yield sleep(0.1)
+        self.assertEqual(listings, [elections[1].path])
+
+    @inlineCallbacks
+    def test_follower_leaves(self):
+        """
+        A follower leaving doesn't elect its successor.
+        """
+        e1, e2, e3 = [self.election(name) for name in "abc"]
+        yield e1.join()
+        yield e2.join()
+        yield e3.join()
+
+        yield e2.leave()
+        yield sleep(0.1)
+        self.assertTrue(e1.is_leader)
+        self.assertFalse(e3.is_leader)
+        self.assertEqual(e3.leader, "a")
+
+        # The remaining follower now watches the leader.
+        yield e1.leave()
+        yield e3.elected
+        self.assertEqual(e3.leader, "c")
+
+    @inlineCallbacks
+    def test_leader_session_closed(self):
+        """
+        When the leader's session ends, its successor is elected.
+        """
+        client = yield self.open_client()
+        e1 = self.election("a", client)
+        e2 = self.election("b")
+        yield e1.join()
+        yield e2.join()
+
+        yield client.close()
+        yield e2.elected
+        self.assertTrue(e2.is_leader)
+
+    @inlineCallbacks
+    def test_leader_session_expired(self):
+        """
+        A leader using a session client is demoted when its session
+        expires, and stands again as a candidate of its new session.
+        """
+        client = managed.ManagedClient("127.0.0.1:2181", 3000)
+        self.clients.append(client)
+        yield client.connect()
+        e1 = self.election("a", client)
+        e2 = self.election("b")
+        yield e1.join()
+        yield e2.join()
+        self.assertTrue(e1.is_leader)
+
+        # Expire the leader's session.
+        client2 = ZookeeperClient(client.servers)
+        yield client2.connect(client_id=client.client_id)
+        yield client2.close()
+
+        yield e2.elected
+        yield sleep(2)
+        self.assertFalse(e1.is_leader)
+        self.assertEqual(e1.leader, "b")
+        self.assertIn(("demoted", "a"), self.events)
+
+    def session_event(self, client, state):
+        client._notify_session_event(
+            ClientEvent(zookeeper.SESSION_EVENT, state, ""))
+
+    @inlineCallbacks
+    def test_leader_disconnected(self):
+        """
+        A leader is demoted as soon as its client is disconnected, and
+        reelected on reconnecting with the same session.
+        """
+        e1, e2 = self.election("a"), self.election("b")
+        yield e1.join()
+        yield e2.join()
+        self.assertTrue(e1.is_leader)
+
+        self.session_event(self.client, zookeeper.CONNECTING_STATE)
+        self.assertFalse(e1.is_leader)
+        self.assertEqual(e1.leader, None)
+        self.assertEqual(self.events, [("elected", "a"), ("demoted", "a")])
+
+        self.session_event(self.client, zookeeper.CONNECTED_STATE)
+        self.session_event(self.client, zookeeper.CONNECTED_STATE)
+        yield sleep(0.1)
+        self.assertTrue(e1.is_leader)
+        self.assertEqual(e1.leader, "a")
+        self.assertEqual(self.events, [
+            ("elected", "a"), ("demoted", "a"), ("elected", "a")])
+
+    @inlineCallbacks
+    def test_leader_demoted_on_expiry_event(self):
+        """
+        A leader is demoted on its session's expiry, before a new session
+        is established.
+        """
+        client = managed.ManagedClient("127.0.0.1:2181", 3000)
+        self.clients.append(client)
+        yield client.connect()
+        election = self.election("a", client)
+        yield election.join()
+        self.assertTrue(election.is_leader)
+
+        self.session_event(client, zookeeper.EXPIRED_SESSION_STATE)
+        self.assertFalse(election.is_leader)
+        self.assertIn(("demoted", "a"), self.events)
+
+        # The election left doesn't follow the client's session anymore.
+        yield election.leave()
+        self.assertEqual(client._session_listeners, [])
+
+    @inlineCallbacks
+    def test_rejoin(self):
+        """
+        A participant can leave and join again, as a new candidate.
+        """
+        e1, e2 = self.election("a"), self.election("b")
+        yield e1.join()
+        yield e2.join()
+        yield e1.leave()
+        yield e2.elected
+
+        yield e1.join()
+        self.assertFalse(e1.is_leader)
+        self.assertEqual(e1.leader, "b")
+
+    @inlineCallbacks
+    def test_join_leave_errors(self):
+        """
+        Joining twice, or leaving without joining, is an error.
+        """
+        election = self.election("a")
+        yield self.failUnlessFailure(election.leave(), ElectionError)
+        yield election.join()
+        yield self.failUnlessFailure(election.join(), ElectionError)
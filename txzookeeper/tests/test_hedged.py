@@ -0,0 +1,151 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import zookeeper
+
+from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.task import Clock
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.hedged import HedgedClient
+from txzookeeper.metrics import Metrics
+from txzookeeper.retry import RetryBudget
+from txzookeeper.tests import TestCase, ZookeeperTestCase, utils
+
+
+class FakeClient(object):
+    """A client whose reads complete when the test fires them."""
+
+    connected = True
+
+    def __init__(self):
+        self.reads = []
+
+    def get(self, path):
+        d = Deferred()
+        self.reads.append((path, d))
+        return d
+
+
+class HedgedReadTest(TestCase):
+
+    def setUp(self):
+        super(HedgedReadTest, self).setUp()
+        self.clock = Clock()
+        self.metrics = Metrics()
+        self.primary, self.secondary = FakeClient(), FakeClient()
+        self.client = HedgedClient(
+            [self.primary, self.secondary], initial_delay=0.1,
+            metrics=self.metrics, clock=self.clock)
+
+    def test_fast_read_not_hedged(self):
+        """A read completing within the hedge delay isn't hedged."""
+        results = []
+        self.client.get("/zoo").addCallback(results.append)
+        self.primary.reads[0][1].callback(("abc", {}))
+        self.assertEqual(results, [("abc", {})])
+        self.clock.advance(1)
+        self.assertEqual(self.secondary.reads, [])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_slow_read_hedged(self):
+        """A slow read is issued on a second session, and the first reply
+        is used."""
+        results = []
+        self.client.get("/zoo").addCallback(results.append)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.secondary.reads), 1)
+
+        self.secondary.reads[0][1].callback(("hedged", {}))
+        self.assertEqual(results, [("hedged", {})])
+        self.primary.reads[0][1].callback(("primary", {}))
+        self.assertEqual(results, [("hedged", {})])
+        self.assertEqual(self.metrics.counter("hedge.issued", op="get"), 1)
+        self.assertEqual(self.metrics.counter("hedge.won", op="get"), 1)
+
+    def test_connection_error_waits_for_other_read(self):
+        """A connection error on one session defers to the other read."""
+        results = []
+        self.client.get("/zoo").addBoth(results.append)
+        self.clock.advance(0.1)
+        self.primary.reads[0][1].errback(
+            zookeeper.ConnectionLossException())
+        self.assertEqual(results, [])
+        self.secondary.reads[0][1].callback(("hedged", {}))
+        self.assertEqual(results, [("hedged", {})])
+
+    def test_hedge_rate_capped(self):
+        """Hedges are capped to a ratio of reads."""
+        self.client.budget = RetryBudget(
+            ratio=0.5, min_per_second=0, max_tokens=1)
+        self.client.budget.withdraw()
+
+        self.client.get("/a")
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.secondary.reads), 0)
+        self.assertEqual(self.metrics.counter("hedge.capped", op="get"), 1)
+
+        self.client.get("/b")
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.secondary.reads), 1)
+
+    def test_hedge_delay_from_latency_percentile(self):
+        """The hedge delay follows the latency percentile of reads."""
+        for i in range(100):
+            self.client.get("/zoo")
+            self.clock.advance((i + 1) / 1000.0)
+            self.primary.reads[-1][1].callback(("abc", {}))
+        self.assertAlmostEqual(self.client.hedge_delay, 0.095)
+        histogram = self.metrics.histogram("hedge.read_latency")
+        self.assertEqual(histogram.count, 100)
+
+    def test_no_connected_sessions(self):
+        """Reads aren't hedged without another connected session."""
+        self.secondary.connected = False
+        self.client.get("/zoo")
+        self.clock.advance(0.1)
+        self.assertEqual(self.secondary.reads, [])
+
+
+class HedgedClientTest(ZookeeperTestCase):
+
+    def setUp(self):
+        super(HedgedClientTest, self).setUp()
+        self.client = HedgedClient(
+            [ZookeeperClient("127.0.0.1:2181"),
+             ZookeeperClient("127.0.0.1:2181")])
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.primary.handle)
+        return self.client.close()
+
+    @inlineCallbacks
+    def test_pooled_reads(self):
+        """Reads and writes are served by the pool's sessions."""
+        yield self.client.create("/zoo", "abc")
+        data, stat = yield self.client.get("/zoo")
+        self.assertEqual(data, "abc")
+        stat = yield self.client.exists("/zoo")
+        self.assertEqual(stat["version"], 0)
+        children = yield self.client.get_children("/")
+        self.assertIn("zoo", children)
@@ -0,0 +1,121 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.idgenerator import IdGenerator
+from txzookeeper.metrics import Metrics
+from txzookeeper.retry import Backoff, sleep
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class IdGeneratorTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(IdGeneratorTests, self).setUp()
+        self.metrics = Metrics()
+        self.client = ZookeeperClient("127.0.0.1:2181", metrics=self.metrics)
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def test_ids_from_block(self):
+        """
+        Ids are handed out from a reserved block, with a single update of
+        the counter node.
+        """
+        generator = IdGenerator(self.client, "/ids", block_size=10)
+        ids = yield gatherResults([generator.next_id() for i in range(5)])
+        self.assertEqual(ids, range(5))
+        self.assertEqual(generator.remaining, 5)
+        content, stat = yield self.client.get("/ids")
+        self.assertEqual(content, "10")
+        self.assertEqual(
+            self.metrics.counter("idgenerator.blocks", path="/ids"), 1)
+
+    @inlineCallbacks
+    def test_prefetch(self):
+        """
+        The next block is reserved before the current one is exhausted.
+        """
+        generator = IdGenerator(
+            self.client, "/ids", block_size=10, prefetch=0.3)
+        for i in range(7):
+            yield generator.next_id()
+        yield sleep(0.1)
+        content, stat = yield self.client.get("/ids")
+        self.assertEqual(content, "20")
+        self.assertEqual(generator.remaining, 13)
+
+        ids = []
+        for i in range(3):
+            id = generator.next_id()
+            self.assertTrue(id.called)
+            ids.append((yield id))
+        id = generator.next_id()
+        self.assertTrue(id.called)
+        ids.append((yield id))
+        self.assertEqual(ids, [7, 8, 9, 10])
+
+    @inlineCallbacks
+    def test_waiters_exhausting_block(self):
+        """
+        Requests beyond the ids of a block wait for further blocks.
+        """
+        generator = IdGenerator(self.client, "/ids", block_size=3)
+        ids = yield gatherResults([generator.next_id() for i in range(8)])
+        self.assertEqual(ids, range(8))
+
+    @inlineCallbacks
+    def test_unique_across_generators(self):
+        """
+        Concurrent generators hand out disjoint ids.
+        """
+        client2 = ZookeeperClient("127.0.0.1:2181")
+        yield client2.connect()
+        self.addCleanup(client2.close)
+        generators = [
+            IdGenerator(client, "/ids", block_size=5,
+                        backoff=Backoff(base=0.001))
+            for client in (self.client, client2, self.client, client2)]
+        ids = yield gatherResults(
+            [g.next_id() for i in range(12) for g in generators])
+        self.assertEqual(len(set(ids)), 48)
+
+    @inlineCallbacks
+    def test_missing_parent(self):
+        """
+        The counter node's parent isn't created, its absence is an error
+        rather than a conflict.
+        """
+        generator = IdGenerator(self.client, "/missing/ids")
+        yield self.failUnlessFailure(
+            generator.next_id(), zookeeper.NoNodeException)
+        self.assertEqual(
+            self.metrics.counter("idgenerator.conflicts", path="/missing/ids"),
+            0)
@@ -22,12 +22,15 @@
 
 
 from twisted.internet.defer import (
-    inlineCallbacks, returnValue, Deferred, succeed)
+    inlineCallbacks, returnValue, Deferred, succeed, CancelledError)
 
 from zookeeper import NoNodeException
 
 from txzookeeper import ZookeeperClient
-from txzookeeper.lock import Lock, LockError
+from txzookeeper.lock import (
+    Lock, LockError, LockTimeout, ReadWriteLock)
+from txzookeeper.metrics import Metrics
+from txzookeeper.retry import sleep
 
 from mocker import ANY
 from txzookeeper.tests import ZookeeperTestCase, utils
@@ -48,12 +51,12 @@ class LockTests(ZookeeperTestCase):
             client.close()
 
     @inlineCallbacks
-    def open_client(self, credentials=None):
+    def open_client(self, credentials=None, metrics=None):
         """
         Open a zookeeper client, optionally authenticating with the
         credentials if given.
         """
-        client = ZookeeperClient("127.0.0.1:2181")
+        client = ZookeeperClient("127.0.0.1:2181", metrics=metrics)
         self.clients.append(client)
         yield client.connect()
         if credentials:
@@ -153,8 +156,7 @@ class LockTests(ZookeeperTestCase):
         def attempt_acquire():
             # make sure lock was previously attempted acquired without
             # error (disregarding that it was rigged to *fail*)
-            from twisted.python.failure import Failure
-            self.assertFalse(isinstance(d.result, Failure))
+            self.assertFalse(d.called)
 
             # acquire lock and expect to fail
             self.failUnlessFailure(lock.acquire(), LockError)
@@ -229,3 +231,231 @@ class LockTests(ZookeeperTestCase):
         yield lock2_acquire
         self.assertTrue(lock2.acquired)
         self.assertFalse(lock.acquired)
+
+
+    @inlineCallbacks
+    def test_concurrent_readers(self):
+        """
+        Readers hold the lock concurrently.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/rw-lock")
+        locks = [ReadWriteLock(path, client) for i in range(3)]
+        for lock in locks:
+            yield lock.read_lock.acquire()
+            self.assertTrue(lock.read_lock.acquired)
+        for lock in locks:
+            yield lock.read_lock.release()
+
+    @inlineCallbacks
+    def test_writer_excludes_readers(self):
+        """
+        A writer waits for the readers ahead of it, and readers behind it
+        wait for the writer.
+        """
+        client = yield self.open_client()
+        client2 = yield self.open_client()
+        path = yield client.create("/rw-lock")
+        reader = ReadWriteLock(path, client)
+        writer = ReadWriteLock(path, client2)
+        reader2 = ReadWriteLock(path, client)
+
+        yield reader.read_lock.acquire()
+        write_d = writer.write_lock.acquire()
+        read_d = reader2.read_lock.acquire()
+        self.assertFalse(write_d.called)
+        self.assertFalse(read_d.called)
+
+        # Each waiter watches a single node, the writer the reader ahead
+        # of it and the second reader the writer.
+        children = yield client.get_children(path)
+        self.assertEqual(len(children), 3)
+
+        yield reader.read_lock.release()
+        yield write_d
+        self.assertTrue(writer.write_lock.acquired)
+        self.assertFalse(read_d.called)
+
+        yield writer.write_lock.release()
+        yield read_d
+        self.assertTrue(reader2.read_lock.acquired)
+
+    @inlineCallbacks
+    def test_writers_exclusive(self):
+        """
+        Writers hold the lock exclusively.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/rw-lock")
+        lock = ReadWriteLock(path, client)
+        lock2 = ReadWriteLock(path, client)
+
+        yield lock.write_lock.acquire()
+        write_d = lock2.write_lock.acquire()
+        self.assertFalse(write_d.called)
+        yield lock.write_lock.release()
+        yield write_d
+        self.assertTrue(lock2.write_lock.acquired)
+
+    @inlineCallbacks
+    def test_acquire_timeout(self):
+        """
+        An acquisition which times out fails with a LockTimeout, and its
+        candidate node is removed.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+        yield lock.acquire()
+
+        yield self.failUnlessFailure(lock2.acquire(timeout=0.1), LockTimeout)
+        self.assertFalse(lock2.acquired)
+        self.assertEqual(lock2.stats.timeouts, 1)
+        children = yield client.get_children(path)
+        self.assertEqual(len(children), 1)
+
+        # The lock can be acquired again after a timeout.
+        yield lock.release()
+        yield lock2.acquire(timeout=1)
+        self.assertTrue(lock2.acquired)
+
+    @inlineCallbacks
+    def test_stale_attempt_watch(self):
+        """
+        The predecessor watch of a timed out acquisition is ignored by a
+        later acquisition of the same lock.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+        yield lock.acquire()
+
+        yield self.failUnlessFailure(lock2.acquire(timeout=0.1), LockTimeout)
+        d = lock2.acquire()
+        yield sleep(0.1)
+
+        listings = []
+        get_children = client.get_children
+
+        def counting_get_children(path):
+            listings.append(path)
+            return get_children(path)
+
+        client.get_children = counting_get_children
+        yield lock.release()
+        yield d
+        yield sleep(0.1)
+        self.assertTrue(lock2.acquired)
+        self.assertEqual(len(listings), 1)
+        children = yield get_children(path)
+        self.assertEqual(len(children), 1)
+
+    @inlineCallbacks
+    def test_acquire_not_blocking(self):
+        """
+        A non blocking acquisition of a held lock fails immediately with a
+        LockTimeout, and succeeds if the lock is available.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+
+        yield lock.acquire(blocking=False)
+        self.assertTrue(lock.acquired)
+        yield self.failUnlessFailure(
+            lock2.acquire(blocking=False), LockTimeout)
+        children = yield client.get_children(path)
+        self.assertEqual(len(children), 1)
+
+    @inlineCallbacks
+    def test_acquire_cancel(self):
+        """
+        Cancelling an acquisition removes its candidate node, and doesn't
+        affect the other waiters.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+        lock3 = Lock(path, client)
+        yield lock.acquire()
+
+        d = lock2.acquire()
+        d3 = lock3.acquire()
+        yield sleep(0.1)
+        d.cancel()
+        yield self.failUnlessFailure(d, CancelledError)
+        self.assertEqual(lock2.stats.cancellations, 1)
+
+        yield lock.release()
+        yield d3
+        self.assertTrue(lock3.acquired)
+        self.assertFalse(lock2.acquired)
+        children = yield client.get_children(path)
+        self.assertEqual(len(children), 1)
+
+    @inlineCallbacks
+    def test_acquire_stats(self):
+        """
+        The wait time of each acquisition is recorded.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+
+        yield lock.acquire()
+        self.assertEqual(lock.stats.acquisitions, 1)
+
+        d = lock2.acquire()
+        yield sleep(0.1)
+        yield lock.release()
+        yield d
+        self.assertEqual(lock2.stats.acquisitions, 1)
+        self.assertTrue(lock2.stats.last_wait >= 0.1)
+        self.assertEqual(lock2.stats.max_wait, lock2.stats.last_wait)
+        self.assertEqual(lock2.stats.mean_wait, lock2.stats.last_wait)
+
+    @inlineCallbacks
+    def test_metrics(self):
+        """
+        Wait and hold times, queue positions and contention are reported
+        to the client's metrics hook, tagged by the lock's path.
+        """
+        metrics = Metrics()
+        client = yield self.open_client(metrics=metrics)
+        path = yield client.create("/lock-test")
+        lock = Lock(path, client)
+        lock2 = Lock(path, client)
+        lock3 = Lock(path, client)
+
+        yield lock.acquire()
+        self.assertEqual(lock.position, 0)
+        d2 = lock2.acquire()
+        d3 = lock3.acquire()
+        yield sleep(0.1)
+        self.assertEqual(lock2.position, 1)
+        self.assertEqual(lock3.position, 2)
+        self.assertEqual(
+            metrics.histogram("lock.position", path=path).max, 2)
+
+        yield lock.release()
+        self.assertEqual(lock.position, None)
+        yield d2
+        self.assertEqual(lock2.position, 0)
+        hold = metrics.histogram("lock.hold", path=path)
+        self.assertEqual(hold.count, 1)
+        self.assertTrue(hold.min >= 0.1)
+
+        yield self.failUnlessFailure(
+            lock.acquire(blocking=False), LockTimeout)
+        yield lock2.release()
+        yield d3
+
+        wait = metrics.histogram("lock.wait", path=path)
+        self.assertEqual(wait.count, 3)
+        self.assertTrue(wait.max >= 0.1)
+        self.assertEqual(metrics.counter("lock.contended", path=path), 3)
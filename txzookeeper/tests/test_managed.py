@@ -26,6 +26,7 @@ from twisted.internet.defer import inlineCallbacks, Deferred, DeferredList
 
 from txzookeeper.client import ZookeeperClient, ClientEvent
 from txzookeeper import managed
+from txzookeeper.metrics import Metrics, get_metrics
 from txzookeeper.tests import ZookeeperTestCase, utils
 from txzookeeper.tests import test_client
 
@@ -141,6 +142,20 @@ class SessionClientTests(test_client.ClientTests):
         return True
 
 
+class ManagedClientTests(ZookeeperTestCase):
+
+    def test_metrics(self):
+        """
+        The metrics hook given to a managed client is used by its retries,
+        and attached to its session client.
+        """
+        metrics = Metrics()
+        client = managed.ManagedClient("127.0.0.1:2181", metrics=metrics)
+        self.assertIdentical(client.metrics, metrics)
+        self.assertIdentical(get_metrics(client.client), metrics)
+        self.assertIdentical(managed.SessionClient().metrics, None)
+
+
 class SessionClientExpireTests(ZookeeperTestCase):
     """Verify expiration behavior."""
 
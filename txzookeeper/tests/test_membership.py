@@ -0,0 +1,209 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from twisted.internet.defer import inlineCallbacks
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.membership import GroupMembership
+from txzookeeper.retry import sleep
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class GroupMembershipTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(GroupMembershipTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        self.changes = []
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    def observer(self):
+        group = GroupMembership(self.client, "/group")
+        group.subscribe(
+            lambda change, name, data: self.changes.append(
+                (change, name, data)))
+        return group
+
+    @inlineCallbacks
+    def test_join_leave(self):
+        """
+        Members register ephemeral nodes holding their data.
+        """
+        group = GroupMembership(self.client, "/group")
+        path = yield group.join("web-1", "10.0.0.1")
+        self.assertEqual(path, "/group/web-1")
+        data, stat = yield self.client.get(path)
+        self.assertEqual(data, "10.0.0.1")
+        self.assertTrue(stat["ephemeralOwner"])
+
+        yield group.leave("web-1")
+        exists = yield self.client.exists(path)
+        self.assertFalse(exists)
+
+    @inlineCallbacks
+    def test_watch_membership(self):
+        """
+        The view of the membership tracks members joining and leaving,
+        and subscribers are notified of each change.
+        """
+        group = GroupMembership(self.client, "/group")
+        yield group.join("web-1", "10.0.0.1")
+
+        observer = self.observer()
+        members = yield observer.watch()
+        self.assertEqual(members, {"web-1": "10.0.0.1"})
+
+        yield group.join("web-2", "10.0.0.2")
+        yield sleep(0.1)
+        self.assertEqual(
+            observer.members, {"web-1": "10.0.0.1", "web-2": "10.0.0.2"})
+
+        yield group.leave("web-1")
+        yield sleep(0.1)
+        self.assertEqual(observer.members, {"web-2": "10.0.0.2"})
+        self.assertEqual(
+            self.changes,
+            [(observer.JOINED, "web-1", "10.0.0.1"),
+             (observer.JOINED, "web-2", "10.0.0.2"),
+             (observer.LEFT, "web-1", "10.0.0.1")])
+
+    @inlineCallbacks
+    def test_snapshot(self):
+        """
+        The membership is replaced on changes, a retrieved snapshot isn't
+        modified.
+        """
+        group = GroupMembership(self.client, "/group")
+        observer = self.observer()
+        snapshot = yield observer.watch()
+        yield group.join("web-1")
+        yield sleep(0.1)
+        self.assertEqual(snapshot, {})
+        self.assertEqual(observer.members, {"web-1": ""})
+
+    @inlineCallbacks
+    def test_only_new_members_retrieved(self):
+        """
+        On a membership change, only the data of new members is
+        retrieved.
+        """
+        group = GroupMembership(self.client, "/group")
+        for i in range(5):
+            yield group.join("web-%d" % i)
+        observer = self.observer()
+        yield observer.watch()
+
+        retrieved = []
+        get = self.client.get
+
+        def counting_get(path):
+            retrieved.append(path)
+            return get(path)
+
+        self.client.get = counting_get
+        yield group.join("web-5")
+        yield sleep(0.1)
+        self.assertEqual(retrieved, ["/group/web-5"])
+        self.assertEqual(len(observer.members), 6)
+
+    @inlineCallbacks
+    def test_session_close_leaves(self):
+        """
+        Members of a closed session leave the group.
+        """
+        client = ZookeeperClient("127.0.0.1:2181")
+        yield client.connect()
+        yield GroupMembership(client, "/group").join("web-1")
+
+        observer = self.observer()
+        members = yield observer.watch()
+        self.assertEqual(members.keys(), ["web-1"])
+        yield client.close()
+        yield sleep(0.2)
+        self.assertEqual(observer.members, {})
+
+    @inlineCallbacks
+    def test_stop_watching(self):
+        """
+        Once stopped, the view is cleared and no longer maintained.
+        """
+        group = GroupMembership(self.client, "/group")
+        observer = self.observer()
+        yield observer.watch()
+        observer.stop_watching()
+        yield group.join("web-1")
+        yield sleep(0.1)
+        self.assertEqual(observer.members, {})
+        self.assertEqual(self.changes, [])
+
+    @inlineCallbacks
+    def test_rewatch(self):
+        """
+        Watching again after stopping maintains the view with a single
+        watch, the watch set before stopping is ignored.
+        """
+        group = GroupMembership(self.client, "/group")
+        observer = self.observer()
+        yield observer.watch()
+        observer.stop_watching()
+        yield observer.watch()
+
+        listings = []
+        get_children_and_watch = self.client.get_children_and_watch
+
+        def counting_get_children_and_watch(path):
+            listings.append(path)
+            return get_children_and_watch(path)
+
+        self.client.get_children_and_watch = counting_get_children_and_watch
+        yield group.join("web-1")
+        yield sleep(0.1)
+        self.assertEqual(listings, ["/group"])
+        self.assertEqual(observer.members, {"web-1": ""})
+        self.assertEqual(self.changes, [(observer.JOINED, "web-1", "")])
+
+    @inlineCallbacks
+    def test_subscriber_error(self):
+        """
+        A failing subscriber doesn't prevent the others from being
+        notified, nor the view from being maintained.
+        """
+        group = GroupMembership(self.client, "/group")
+        observer = GroupMembership(self.client, "/group")
+        observer.subscribe(lambda change, name, data: 1 / 0)
+        observer.subscribe(
+            lambda change, name, data: self.changes.append(
+                (change, name, data)))
+        yield observer.watch()
+
+        yield group.join("web-1")
+        yield sleep(0.1)
+        yield group.join("web-2")
+        yield sleep(0.1)
+        self.assertEqual(
+            self.changes,
+            [(observer.JOINED, "web-1", ""), (observer.JOINED, "web-2", "")])
+        self.assertEqual(observer.members, {"web-1": "", "web-2": ""})
@@ -0,0 +1,64 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from txzookeeper.metrics import Metrics, get_metrics
+from txzookeeper.tests import TestCase
+
+
+class MetricsTest(TestCase):
+
+    def test_counters(self):
+        """Counters are kept per name and tags."""
+        metrics = Metrics()
+        metrics.increment("retries", op="get")
+        metrics.increment("retries", 2, op="get")
+        metrics.increment("retries", op="set")
+        self.assertEqual(metrics.counter("retries", op="get"), 3)
+        self.assertEqual(metrics.counter("retries", op="set"), 1)
+        self.assertEqual(metrics.counter("retries"), 0)
+
+        metrics.clear()
+        self.assertEqual(metrics.counter("retries", op="get"), 0)
+
+    def test_histograms(self):
+        """Observed values are summarized in histograms."""
+        metrics = Metrics()
+        self.assertEqual(metrics.histogram("wait", path="/lock"), None)
+        for value in (0.002, 0.2, 2):
+            metrics.observe("wait", value, path="/lock")
+
+        histogram = metrics.histogram("wait", path="/lock")
+        self.assertEqual(histogram.count, 3)
+        self.assertEqual(histogram.min, 0.002)
+        self.assertEqual(histogram.max, 2)
+        self.assertAlmostEqual(histogram.mean, 0.734)
+        self.assertEqual(sum(histogram.counts), 3)
+        self.assertEqual(histogram.counts[1], 1)
+
+    def test_get_metrics(self):
+        """The metrics hook of a client is retrieved if present."""
+
+        class Client(object):
+            metrics = Metrics()
+
+        self.assertIdentical(get_metrics(Client()), Client.metrics)
+        self.assertEqual(get_metrics(object()), None)
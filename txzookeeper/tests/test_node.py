@@ -26,10 +26,11 @@ import hashlib
 
 import zookeeper
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.python.failure import Failure
 
-from txzookeeper.node import ZNode
+from txzookeeper.codec import JSONCodec, MAGIC
+from txzookeeper.node import ZNode, CachedZNode
 from txzookeeper.node import NodeEvent
 from txzookeeper.tests import TestCase
 from txzookeeper.tests.utils import deleteTree
@@ -72,6 +73,34 @@ class NodeTest(TestCase):
         self.assertEqual(node.name, "rabbit")
         self.assertEqual(node.path, "/zoo/rabbit")
 
+    @inlineCallbacks
+    def test_node_codec(self):
+        """
+        A node's data is encoded and decoded with its codec.
+        """
+        node = ZNode("/zoo/config", self.client, JSONCodec())
+        yield node.create({"animals": ["rabbit"]})
+        data = yield node.get_data()
+        self.assertEqual(data, {"animals": ["rabbit"]})
+
+        yield node.set_data({"animals": []})
+        data = yield node.get_data()
+        self.assertEqual(data, {"animals": []})
+
+        content, stat = yield self.client.get("/zoo/config")
+        self.assertEqual(content, MAGIC + '\x01{"animals":[]}')
+
+    @inlineCallbacks
+    def test_node_client_codec(self):
+        """
+        A node uses the codec of its client by default.
+        """
+        self.client.codec = JSONCodec()
+        node = ZNode("/zoo/config", self.client)
+        yield node.create([1])
+        data = yield node.get_data()
+        self.assertEqual(data, [1])
+
     def test_node_event_repr(self):
         """
         Node events have a human-readable representation.
@@ -291,6 +320,85 @@ class NodeTest(TestCase):
         self.assertEqual(children[0].path, node_path_a)
         self.assertEqual(len(children), 1)
 
+    @inlineCallbacks
+    def test_node_children_interned(self):
+        """
+        Child nodes are interned per client, a path is represented by the
+        same node instance, retaining its last read stat.
+        """
+        node = ZNode("/zoo", self.client)
+        yield self.client.create("/zoo/lion")
+        children = yield node.get_children()
+        lion = children[0]
+        yield lion.exists()
+        self.assertEqual(lion.stat["version"], 0)
+
+        children = yield node.get_children()
+        self.assertIdentical(children[0], lion)
+        self.assertEqual(children[0].stat["version"], 0)
+        self.assertIdentical(
+            ZNode.intern("/zoo/lion", self.client), lion)
+
+    @inlineCallbacks
+    def collect_walk(self, walker):
+        results = []
+        while True:
+            result = yield walker.next()
+            if result is None:
+                break
+            results.append(result)
+        returnValue(results)
+
+    @inlineCallbacks
+    def test_node_walk(self):
+        """
+        A node's subtree can be walked, parents are returned before their
+        children.
+        """
+        yield self.client.create("/zoo/cats", "felines")
+        yield self.client.create("/zoo/cats/lion", "roar")
+        yield self.client.create("/zoo/cats/tiger")
+        yield self.client.create("/zoo/cats/lion/cub")
+        yield self.client.create("/zoo/birds")
+
+        node = ZNode("/zoo", self.client)
+        results = yield self.collect_walk(node.walk(concurrency=2))
+        paths = [path for path, data, stat in results]
+        self.assertEqual(sorted(paths), [
+            "/zoo", "/zoo/birds", "/zoo/cats", "/zoo/cats/lion",
+            "/zoo/cats/lion/cub", "/zoo/cats/tiger"])
+        for path in paths:
+            parent = path.rsplit("/", 1)[0]
+            if parent:
+                self.assertTrue(paths.index(parent) < paths.index(path))
+
+        data = dict((path, data) for path, data, stat in results)
+        self.assertEqual(data["/zoo/cats/lion"], "roar")
+        stats = dict((path, stat) for path, data, stat in results)
+        self.assertEqual(stats["/zoo/cats"]["numChildren"], 2)
+
+    @inlineCallbacks
+    def test_node_walk_depth_without_data(self):
+        """
+        A walk can be limited in depth, and retrieve only node stats.
+        """
+        yield self.client.create("/zoo/cats", "felines")
+        yield self.client.create("/zoo/cats/lion", "roar")
+
+        node = ZNode("/zoo", self.client)
+        results = yield self.collect_walk(
+            node.walk(max_depth=1, include_data=False))
+        self.assertEqual(
+            [(path, data) for path, data, stat in results],
+            [("/zoo", None), ("/zoo/cats", None)])
+
+    def test_node_slots(self):
+        """
+        Nodes don't have a per instance dictionary.
+        """
+        node = ZNode("/zoo/rabbit", self.client)
+        self.assertFalse(hasattr(node, "__dict__"))
+
     @inlineCallbacks
     def test_node_get_children_with_watch_create(self):
         """
@@ -346,3 +454,154 @@ class NodeTest(TestCase):
         yield node.set_data("zebra")
         data = yield node.get_data()
         self.assertEqual(data, "zebra")
+
+
+class CachedNodeTest(TestCase):
+
+    def setUp(self):
+        super(CachedNodeTest, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181", 2000)
+        return self.client.connect()
+
+    def tearDown(self):
+        super(CachedNodeTest, self).tearDown()
+        deleteTree(handle=self.client.handle)
+        if self.client.connected:
+            self.client.close()
+
+    def sleep(self, delay):
+        from twisted.internet import reactor
+        d = Deferred()
+        reactor.callLater(delay, d.callback, None)
+        return d
+
+    @inlineCallbacks
+    def wait_for_data(self, node, data):
+        for i in range(20):
+            if node.data == data and not node.stale:
+                break
+            yield self.sleep(0.05)
+        self.assertEqual(node.data, data)
+
+    @inlineCallbacks
+    def test_cached_data(self):
+        """
+        A cached node serves its data from memory, and refreshes it when
+        the node changes.
+        """
+        yield self.client.create("/flags", "on")
+        node = CachedZNode("/flags", self.client)
+        data = yield node.start()
+        self.assertEqual(data, "on")
+        self.assertEqual(node.data, "on")
+        self.assertFalse(node.stale)
+
+        yield self.client.set("/flags", "off")
+        yield self.wait_for_data(node, "off")
+
+        def unexpected_get(path):
+            raise AssertionError("unexpected get %s" % path)
+        real_get = self.client.get
+        self.client.get = unexpected_get
+        try:
+            data = yield node.get_data()
+        finally:
+            self.client.get = real_get
+        self.assertEqual(data, "off")
+
+    @inlineCallbacks
+    def test_cached_node_created_deleted(self):
+        """
+        A cached node tracks the node's deletion and creation.
+        """
+        node = CachedZNode("/flags", self.client)
+        data = yield node.start()
+        self.assertEqual(data, None)
+        self.assertTrue(node.loaded)
+
+        yield self.client.create("/flags", "on")
+        yield self.wait_for_data(node, "on")
+
+        yield self.client.delete("/flags")
+        yield self.wait_for_data(node, None)
+
+    @inlineCallbacks
+    def test_staleness_bound(self):
+        """
+        Data that may be outdated is served only within the staleness
+        bound, reads past it wait for a refresh.
+        """
+        yield self.client.create("/flags", "on")
+        node = CachedZNode("/flags", self.client, max_staleness=0.05)
+        yield node.start()
+        node.stop()
+
+        yield self.client.set("/flags", "off")
+        for i in range(20):
+            if node.stale:
+                break
+            yield self.sleep(0.05)
+        self.assertTrue(node.stale)
+        self.assertEqual(node.data, "on")
+
+        yield self.sleep(0.1)
+        data = yield node.get_data()
+        self.assertEqual(data, "off")
+        self.assertFalse(node.stale)
+
+    @inlineCallbacks
+    def test_read_after_stop(self):
+        """
+        A read of a stopped node which changed serves the last known data,
+        refreshes it and restarts the watch.
+        """
+        yield self.client.create("/flags", "on")
+        node = CachedZNode("/flags", self.client)
+        yield node.start()
+        node.stop()
+
+        yield self.client.set("/flags", "off")
+        for i in range(20):
+            if node.stale:
+                break
+            yield self.sleep(0.05)
+        data = yield node.get_data()
+        self.assertEqual(data, "on")
+        yield self.wait_for_data(node, "off")
+
+        # The node is refreshed on changes again.
+        yield self.client.set("/flags", "on")
+        yield self.wait_for_data(node, "on")
+
+    @inlineCallbacks
+    def test_watch_lost(self):
+        """
+        A cached node whose watch was lost sets it again on its next read,
+        refreshing its data.
+        """
+        yield self.client.create("/flags", "on")
+        watches = []
+        real_get_and_watch = self.client.get_and_watch
+
+        def get_and_watch(path):
+            d, w = real_get_and_watch(path)
+            watches.append(Deferred())
+            return d, watches[-1]
+        self.client.get_and_watch = get_and_watch
+
+        node = CachedZNode("/flags", self.client)
+        yield node.start()
+        watches[0].errback(zookeeper.SessionExpiredException())
+        self.assertTrue(node.stale)
+
+        yield self.client.set("/flags", "off")
+        data = yield node.get_data()
+        self.assertEqual(data, "on")
+        yield self.wait_for_data(node, "off")
+        self.assertEqual(len(watches), 2)
+
+        # The watch set again keeps the data current.
+        del self.client.get_and_watch
+        yield self.client.set("/flags", "on")
+        watches[1].callback(None)
+        yield self.wait_for_data(node, "on")
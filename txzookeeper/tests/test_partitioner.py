@@ -0,0 +1,245 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks, Deferred
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.client import ClientEvent, NotConnectedException
+from txzookeeper.partitioner import Partitioner, assign_partitions
+from txzookeeper.retry import sleep
+from txzookeeper.tests import TestCase, ZookeeperTestCase, utils
+
+
+class AssignPartitionsTest(TestCase):
+
+    members = ["worker-%d" % i for i in range(4)]
+
+    def test_assignment(self):
+        """
+        All partitions are assigned, deterministically, and spread among
+        the members.
+        """
+        assignment = assign_partitions(self.members, 100)
+        self.assertEqual(sorted(assignment), range(100))
+        self.assertEqual(
+            assignment, assign_partitions(reversed(self.members), 100))
+        for member in self.members:
+            self.assertTrue(assignment.values().count(member) > 10)
+
+    def test_no_members(self):
+        self.assertEqual(assign_partitions([], 10), {})
+
+    def test_member_joins(self):
+        """
+        A joining member only takes partitions from the others.
+        """
+        before = assign_partitions(self.members, 100)
+        after = assign_partitions(self.members + ["worker-4"], 100)
+        moved = [p for p in range(100) if before[p] != after[p]]
+        self.assertTrue(0 < len(moved) < 40)
+        for partition in moved:
+            self.assertEqual(after[partition], "worker-4")
+
+    def test_member_leaves(self):
+        """
+        Only the partitions of a leaving member move.
+        """
+        before = assign_partitions(self.members, 100)
+        after = assign_partitions(self.members[1:], 100)
+        for partition in range(100):
+            if before[partition] != "worker-0":
+                self.assertEqual(before[partition], after[partition])
+
+
+class PartitionerTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(PartitionerTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        self.owners = {}
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    def partitioner(self, identifier, release_d=None):
+
+        def on_acquired(partition):
+            self.assertNotIn(partition, self.owners)
+            self.owners[partition] = identifier
+
+        def on_released(partition):
+            self.assertEqual(self.owners.pop(partition), identifier)
+            return release_d
+
+        return Partitioner(
+            self.client, "/partitions", 16, identifier,
+            on_acquired=on_acquired, on_released=on_released)
+
+    @inlineCallbacks
+    def test_single_member(self):
+        """
+        A lone member owns all the partitions.
+        """
+        p1 = self.partitioner("a")
+        yield p1.join()
+        yield sleep(0.1)
+        self.assertEqual(p1.owned, frozenset(range(16)))
+        owner, stat = yield self.client.get("/partitions/owners/3")
+        self.assertEqual(owner, "a")
+
+    @inlineCallbacks
+    def test_rebalance(self):
+        """
+        Partitions move to a joining member once released by their
+        previous owner, and back when it leaves.
+        """
+        p1 = self.partitioner("a")
+        yield p1.join()
+        yield sleep(0.1)
+
+        p2 = self.partitioner("b")
+        yield p2.join()
+        yield sleep(0.2)
+        expected = assign_partitions(["a", "b"], 16)
+        self.assertEqual(self.owners, expected)
+        self.assertEqual(p1.owned | p2.owned, frozenset(range(16)))
+        self.assertFalse(p1.owned & p2.owned)
+
+        yield p2.leave()
+        yield sleep(0.2)
+        self.assertEqual(p1.owned, frozenset(range(16)))
+        self.assertEqual(p2.owned, frozenset())
+
+    @inlineCallbacks
+    def test_hand_off_waits_for_release(self):
+        """
+        A partition isn't acquired till its previous owner completed its
+        release.
+        """
+        release_d = Deferred()
+        p1 = self.partitioner("a", release_d)
+        yield p1.join()
+        yield sleep(0.1)
+
+        p2 = self.partitioner("b")
+        yield p2.join()
+        yield sleep(0.2)
+        self.assertEqual(p2.owned, frozenset())
+        self.assertTrue(p2.assigned)
+
+        release_d.callback(None)
+        yield sleep(0.2)
+        self.assertEqual(p2.owned, p2.assigned)
+
+    @inlineCallbacks
+    def test_reassigned_while_releasing(self):
+        """
+        A partition assigned back to its owner while being released is
+        acquired again once the release completed.
+        """
+        release_d = Deferred()
+        p1 = self.partitioner("a", release_d)
+        yield p1.join()
+        yield sleep(0.1)
+
+        p2 = self.partitioner("b")
+        yield p2.join()
+        yield sleep(0.2)
+        self.assertNotEqual(p1.owned, frozenset(range(16)))
+        yield p2.leave()
+        yield sleep(0.2)
+        self.assertEqual(p1.assigned, frozenset(range(16)))
+        self.assertNotEqual(p1.owned, frozenset(range(16)))
+
+        release_d.callback(None)
+        yield sleep(0.2)
+        self.assertEqual(p1.owned, frozenset(range(16)))
+        for partition in range(16):
+            owner, stat = yield self.client.get(
+                "/partitions/owners/%d" % partition)
+            self.assertEqual(owner, "a")
+
+    def test_default_identifier_requires_connection(self):
+        """
+        The default identifier is the client's session id, so it can't be
+        built with a client that isn't connected.
+        """
+        client = ZookeeperClient("127.0.0.1:2181")
+        self.assertRaises(
+            NotConnectedException, Partitioner, client, "/partitions", 16)
+
+    def session_event(self, state):
+        self.client._notify_session_event(
+            ClientEvent(zookeeper.SESSION_EVENT, state, ""))
+
+    @inlineCallbacks
+    def test_disconnected(self):
+        """
+        A member releases its partitions as soon as its client is
+        disconnected, and acquires them again once reconnected.
+        """
+        p1 = self.partitioner("a")
+        yield p1.join()
+        yield sleep(0.1)
+        self.assertEqual(len(self.owners), 16)
+
+        self.session_event(zookeeper.CONNECTING_STATE)
+        self.assertEqual(p1.owned, frozenset())
+        self.assertEqual(self.owners, {})
+
+        self.session_event(zookeeper.CONNECTED_STATE)
+        self.session_event(zookeeper.CONNECTED_STATE)
+        yield sleep(0.2)
+        self.assertEqual(p1.owned, frozenset(range(16)))
+        self.assertEqual(len(self.owners), 16)
+        owner, stat = yield self.client.get("/partitions/owners/3")
+        self.assertEqual(owner, "a")
+        self.assertEqual(stat["ephemeralOwner"], self.client.client_id[0])
+
+    @inlineCallbacks
+    def test_owner_node_of_previous_session(self):
+        """
+        An owner node holding our identifier, but of another session,
+        isn't taken as ours, the partition is acquired once it's gone.
+        """
+        client = ZookeeperClient("127.0.0.1:2181")
+        yield client.connect()
+        yield client.create("/partitions")
+        yield client.create("/partitions/owners")
+        yield client.create(
+            "/partitions/owners/3", "a", flags=zookeeper.EPHEMERAL)
+
+        p1 = self.partitioner("a")
+        yield p1.join()
+        yield sleep(0.1)
+        self.assertNotIn(3, p1.owned)
+        self.assertEqual(len(p1.owned), 15)
+
+        yield client.close()
+        yield sleep(0.2)
+        self.assertEqual(p1.owned, frozenset(range(16)))
+        owner, stat = yield self.client.get("/partitions/owners/3")
+        self.assertEqual(stat["ephemeralOwner"], self.client.client_id[0])
@@ -27,13 +27,18 @@ from twisted.internet.defer import (
 
 from txzookeeper import ZookeeperClient
 from txzookeeper.client import NotConnectedException
-from txzookeeper.queue import Queue, ReliableQueue, SerializedQueue, QueueItem
+from txzookeeper.codec import JSONCodec
+from txzookeeper.metrics import Metrics
+from txzookeeper.queue import (
+    Queue, ReliableQueue, SerializedQueue, QueueItem, QueueStats,
+    get_stats_many)
 from txzookeeper.tests import ZookeeperTestCase, utils
 
 
 class QueueTests(ZookeeperTestCase):
 
     queue_factory = Queue
+    consume_concurrency = 2
 
     def setUp(self):
         super(QueueTests, self).setUp()
@@ -56,6 +61,11 @@ class QueueTests(ZookeeperTestCase):
         else:
             self.assertEqual(data, item)
 
+    def item_data(self, item):
+        if isinstance(item, QueueItem):
+            return item.data
+        return item
+
     def consume_item(self, item):
         if isinstance(item, QueueItem):
             return item.delete(), item.data
@@ -134,6 +144,196 @@ class QueueTests(ZookeeperTestCase):
         size = yield queue.qsize()
         self.assertTrue(size, 1)
 
+    @inlineCallbacks
+    def test_get_stats(self):
+        """
+        The queue stats count the items in the queue.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-stats")
+        queue = self.queue_factory(path, client)
+
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(0, 0, 0))
+
+        yield queue.put("abc")
+        yield queue.put("bcd")
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(2, 0, 2))
+
+    @inlineCallbacks
+    def test_watch_stats(self):
+        """
+        Watched queue stats are maintained locally, and served without
+        contacting zookeeper.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-watch-stats")
+        queue = self.queue_factory(path, client)
+
+        stats = yield queue.watch_stats()
+        self.assertEqual(stats.total, 0)
+
+        yield queue.put("abc")
+        for i in range(20):
+            stats = yield queue.get_stats()
+            if stats.total:
+                break
+            yield self.sleep(0.05)
+        self.assertEqual(stats, QueueStats(1, 0, 1))
+
+        def unexpected_fetch(path):
+            raise AssertionError("unexpected fetch %s" % path)
+        self.patch(client, "get_children", unexpected_fetch)
+
+        size = yield queue.qsize()
+        self.assertEqual(size, 1)
+
+        queue.unwatch_stats()
+        self.assertRaises(AssertionError, queue.get_stats)
+
+    @inlineCallbacks
+    def test_rewatch_stats(self):
+        """
+        Watching the stats again after unwatching them doesn't leave the
+        previous watch refreshing them.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-rewatch-stats")
+        queue = self.queue_factory(path, client)
+        fetches = []
+        get_children_and_watch = client.get_children_and_watch
+
+        def counting_get_children_and_watch(child_path):
+            if child_path == path:
+                fetches.append(child_path)
+            return get_children_and_watch(child_path)
+        self.patch(
+            client, "get_children_and_watch", counting_get_children_and_watch)
+
+        yield queue.watch_stats()
+        queue.unwatch_stats()
+        yield queue.watch_stats()
+        self.assertEqual(len(fetches), 2)
+
+        yield queue.put("abc")
+        for i in range(20):
+            stats = yield queue.get_stats()
+            if stats.total:
+                break
+            yield self.sleep(0.05)
+        yield self.sleep(0.1)
+        self.assertEqual(stats.total, 1)
+        self.assertEqual(len(fetches), 3)
+
+    @inlineCallbacks
+    def test_get_stats_many(self):
+        """
+        The stats of several queues can be retrieved at once.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-stats-a")
+        path2 = yield client.create("/test-stats-b")
+        queue = self.queue_factory(path, client)
+        queue2 = self.queue_factory(path2, client)
+        yield queue2.put("abc")
+
+        stats = yield get_stats_many([queue, queue2])
+        self.assertEqual(stats, [QueueStats(0, 0, 0), QueueStats(1, 0, 1)])
+
+    @inlineCallbacks
+    def test_consume(self):
+        """
+        A queue can be consumed continuously by a handler, with a bounded
+        number of items in flight.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-consume")
+        queue = self.queue_factory(path, client)
+        for i in range(5):
+            yield queue.put(str(i))
+
+        results = []
+        all_handled = Deferred()
+        concurrency = []
+
+        def handler(item):
+            concurrency.append(consumer.in_flight)
+            results.append(self.item_data(item))
+            if len(results) == 5:
+                all_handled.callback(None)
+            return self.sleep(0.01)
+
+        consumer = queue.consume(handler, self.consume_concurrency)
+        yield all_handled
+        consumer.stopProducing()
+        yield consumer.finished
+
+        self.assertEqual(sorted(results), ["0", "1", "2", "3", "4"])
+        self.assertTrue(max(concurrency) <= self.consume_concurrency)
+        size = yield queue.qsize()
+        self.assertEqual(size, 0)
+
+    @inlineCallbacks
+    def test_consume_pause_resume(self):
+        """
+        A paused consumer doesn't retrieve items until its resumed.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-consume-pause")
+        queue = self.queue_factory(path, client)
+        results = []
+
+        consumer = queue.consume(results.append, self.consume_concurrency)
+        consumer.pauseProducing()
+        yield queue.put("abc")
+        yield self.sleep(0.1)
+        self.assertEqual(results, [])
+
+        consumer.resumeProducing()
+        yield self.wait_for_results(results, 1)
+        self.assertEqual(len(results), 1)
+        self.compare_data("abc", results[0])
+
+        consumer.stopProducing()
+        yield consumer.finished
+
+    @inlineCallbacks
+    def wait_for_results(self, results, count):
+        for i in range(20):
+            if len(results) >= count:
+                break
+            yield self.sleep(0.05)
+
+    @inlineCallbacks
+    def test_consume_handler_error(self):
+        """
+        An error in the handler stops the consumer, and is passed to its
+        finished deferred.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-consume-error")
+        queue = self.queue_factory(path, client)
+        yield queue.put("abc")
+
+        def handler(item):
+            raise SyntaxError("x")
+
+        consumer = queue.consume(handler)
+        yield self.failUnlessFailure(consumer.finished, SyntaxError)
+
+    @inlineCallbacks
+    def test_codec_items(self):
+        """
+        A queue with a codec accepts any value supported by the codec.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/test-codec")
+        queue = self.queue_factory(path, client, codec=JSONCodec())
+        yield queue.put({"job": 1})
+        item = yield queue.get()
+        self.compare_data({"job": 1}, item)
+
     @inlineCallbacks
     def test_invalid_put_item(self):
         """
@@ -370,10 +570,132 @@ class ReliableQueueTests(QueueTests):
         children = [c for c in children if c.startswith(queue.prefix)]
         self.assertFalse(bool(children))
 
+    @inlineCallbacks
+    def test_consume_handler_error_releases_item(self):
+        """
+        An item whose handler failed is released back to the queue, for
+        reliable queues by removing its processing node, for serialized
+        queues by releasing the queue lock.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/reliable-queue-release")
+        queue = self.queue_factory(path, client)
+        yield queue.put("abc")
+
+        def handler(item):
+            raise SyntaxError("x")
+
+        consumer = queue.consume(handler)
+        yield self.failUnlessFailure(consumer.finished, SyntaxError)
+
+        client2 = yield self.open_client()
+        item = yield self.queue_factory(path, client2).get()
+        self.compare_data("abc", item)
+        yield item.delete()
+
+    @inlineCallbacks
+    def test_stats_in_flight(self):
+        """
+        Items reserved by a consumer are counted as in flight, and are
+        excluded from the queue size.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/reliable-queue-stats")
+        queue = self.queue_factory(path, client)
+        yield queue.put("abc")
+        yield queue.put("bcd")
+
+        item = yield queue.get()
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(1, 1, 2))
+        size = yield queue.qsize()
+        self.assertEqual(size, 1)
+
+        yield item.delete()
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(1, 0, 1))
+
 
 class SerializedQueueTests(ReliableQueueTests):
 
     queue_factory = SerializedQueue
+    consume_concurrency = 1
+
+    @inlineCallbacks
+    def test_consume_concurrency(self):
+        """
+        A serialized queue can only be consumed one item at a time.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/serialized-consume")
+        queue = self.queue_factory(path, client)
+        self.assertRaises(ValueError, queue.consume, lambda item: None, 2)
+
+    @inlineCallbacks
+    def test_consume_pause_resume(self):
+        """
+        Pausing the consumer abandons its retrieval, whether waiting on the
+        queue lock or on the queue, no items are retrieved till its resumed.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/serialized-consume-pause")
+        queue = self.queue_factory(path, client)
+        results = []
+
+        consumer = queue.consume(results.append)
+        consumer.pauseProducing()
+        yield queue.put("abc")
+        yield queue.put("bcd")
+        yield self.sleep(0.1)
+        self.assertEqual(results, [])
+
+        consumer.resumeProducing()
+        yield self.wait_for_results(results, 2)
+        self.assertEqual([item.data for item in results], ["abc", "bcd"])
+
+        consumer.stopProducing()
+        yield consumer.finished
+
+    @inlineCallbacks
+    def test_stats_in_flight(self):
+        """
+        The lock directory of a serialized queue is not counted as an item,
+        the item being processed under the queue's lock is reported as in
+        flight.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/serialized-queue-stats")
+        queue = self.queue_factory(path, client)
+        yield queue.put("abc")
+        yield queue.put("bcd")
+
+        item = yield queue.get()
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(1, 1, 2))
+
+        yield item.delete()
+        stats = yield queue.get_stats()
+        self.assertEqual(stats, QueueStats(1, 0, 1))
+
+    @inlineCallbacks
+    def test_lock_metrics(self):
+        """
+        The queue's lock reports its wait and hold times to the metrics
+        hook, tagged by the lock's path.
+        """
+        client = yield self.open_client()
+        path = yield client.create("/serialized-queue-metrics")
+        metrics = Metrics()
+        queue = self.queue_factory(path, client, metrics=metrics)
+        yield queue.put("abc")
+
+        item = yield queue.get()
+        yield item.delete()
+        lock_path = "%s/_lock" % path
+        self.assertEqual(
+            metrics.histogram("lock.wait", path=lock_path).count, 1)
+        self.assertEqual(
+            metrics.histogram("lock.hold", path=lock_path).count, 1)
 
     @inlineCallbacks
     def test_serialized_behavior(self):
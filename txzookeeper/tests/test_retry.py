@@ -25,15 +25,19 @@ import time
 import zookeeper
 
 from twisted.internet.defer import inlineCallbacks, fail, succeed, Deferred
+from twisted.internet.task import Clock
 
-from txzookeeper.client import ZookeeperClient
+from txzookeeper.client import ZookeeperClient, ClientEvent
 from txzookeeper.retry import (
     RetryClient, retry, retry_watch,
-    check_retryable, is_retryable, get_delay, sleep)
+    check_retryable, is_retryable, get_delay, sleep, Backoff, RetryBudget,
+    ReconnectGate, CircuitBreaker, CircuitOpenException, FULL_JITTER,
+    DECORRELATED_JITTER)
 
 from txzookeeper import retry as retry_module
 
 
+from txzookeeper.metrics import Metrics
 from txzookeeper.utils import retry_change
 
 from txzookeeper.tests import ZookeeperTestCase, utils
@@ -153,6 +157,300 @@ class RetryCoreTests(ZookeeperTestCase):
         # Verify normal calculation
         self.assertEqual(get_delay(600, 10, 30), 0.02)
 
+    def test_backoff_exponential(self):
+        backoff = Backoff(base=0.1, max_delay=1, jitter=None)
+        self.assertEqual(
+            [backoff.get_delay(i) for i in range(5)],
+            [0.1, 0.2, 0.4, 0.8, 1])
+        self.assertEqual(backoff.get_delay(1000), 1)
+
+    def test_backoff_full_jitter(self):
+        """Delays are chosen between zero and the exponential delay."""
+        backoff = Backoff(base=0.1, max_delay=1, jitter=FULL_JITTER,
+                          random=lambda: 0.5)
+        self.assertEqual(
+            [backoff.get_delay(i) for i in range(3)], [0.05, 0.1, 0.2])
+        self.assertEqual(backoff.get_delay(10), 1)
+
+    def test_backoff_decorrelated_jitter(self):
+        """Delays are chosen between the base and thrice the previous."""
+        backoff = Backoff(base=0.1, max_delay=1, jitter=DECORRELATED_JITTER,
+                          random=lambda: 1.0)
+        delay = backoff.get_delay(0)
+        self.assertAlmostEqual(delay, 0.3)
+        delay = backoff.get_delay(1, 0.2)
+        self.assertAlmostEqual(delay, 0.6)
+        self.assertEqual(backoff.get_delay(2, delay), 1)
+        self.assertRaises(ValueError, Backoff, jitter="partial")
+
+    def test_retry_budget(self):
+        """A budget allows retries in proportion to operations."""
+        now = [0]
+        budget = RetryBudget(ratio=0.5, min_per_second=1, max_tokens=2,
+                             clock=lambda: now[0])
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        budget.deposit()
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+        # Tokens are replenished over time, up to the capacity.
+        now[0] = 10
+        self.assertEqual(budget.tokens, 2)
+
+    @inlineCallbacks
+    def test_retry_client_metrics(self):
+        """Retries are counted by operation."""
+        self.setup_always_retryable()
+        metrics = Metrics()
+        client = RetryClient(
+            ZookeeperClient(), backoff=Backoff(base=0.01), metrics=metrics)
+
+        results = [fail(zookeeper.ConnectionLossException()),
+                   fail(zookeeper.ConnectionLossException()),
+                   succeed(21)]
+
+        def original():
+            return results.pop(0)
+
+        result = yield client._retry(original)
+        self.assertEqual(result, 21)
+        self.assertEqual(metrics.counter("retry.retries", op="original"), 2)
+
+    @inlineCallbacks
+    def test_retry_client_budget_exhausted(self):
+        """Once the budget is exhausted, errors are raised to the caller."""
+        self.setup_always_retryable()
+        metrics = Metrics()
+        budget = RetryBudget(ratio=0, min_per_second=0, max_tokens=1)
+        client = RetryClient(
+            ZookeeperClient(), backoff=Backoff(base=0.01), budget=budget,
+            metrics=metrics)
+
+        def original():
+            return fail(zookeeper.ConnectionLossException())
+
+        yield self.assertFailure(
+            client._retry(original), zookeeper.ConnectionLossException)
+        self.assertEqual(metrics.counter("retry.retries", op="original"), 1)
+        self.assertEqual(
+            metrics.counter("retry.budget_exhausted", op="original"), 1)
+
+        value_d, watch_d = client._retry_watch(
+            lambda: (fail(zookeeper.ConnectionLossException()), Deferred()))
+        yield self.assertFailure(value_d, zookeeper.ConnectionLossException)
+
+
+    def session_event(self, state):
+        return ClientEvent(zookeeper.SESSION_EVENT, state, "")
+
+    def test_reconnect_gate_drain(self):
+        """Parked operations are released in batches on reconnect."""
+        clock = Clock()
+        gate = ReconnectGate(batch_size=2, interval=0.5, clock=clock)
+        results = []
+        for i in range(5):
+            gate.wait(10).addCallback(results.append)
+        self.assertEqual(len(gate), 5)
+
+        gate.session_event(self.session_event(zookeeper.CONNECTING_STATE))
+        self.assertEqual(results, [])
+
+        gate.session_event(self.session_event(zookeeper.CONNECTED_STATE))
+        self.assertEqual(results, [True, True])
+        clock.advance(0.5)
+        self.assertEqual(len(results), 4)
+
+        # Draining stops if the connection is lost again.
+        gate.session_event(self.session_event(zookeeper.CONNECTING_STATE))
+        clock.advance(0.5)
+        self.assertEqual(len(results), 4)
+
+        gate.session_event(self.session_event(zookeeper.CONNECTED_STATE))
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_reconnect_gate_session_lost(self):
+        """Parked operations fail on timeout or if the session is lost."""
+        clock = Clock()
+        gate = ReconnectGate(clock=clock)
+        results = []
+        gate.wait(1).addCallback(results.append)
+        gate.wait(10).addCallback(results.append)
+
+        clock.advance(1)
+        self.assertEqual(results, [False])
+        gate.session_event(
+            self.session_event(zookeeper.EXPIRED_SESSION_STATE))
+        self.assertEqual(results, [False, False])
+        self.assertEqual(len(gate), 0)
+
+    @inlineCallbacks
+    def test_retry_client_parks_while_connecting(self):
+        """Operations failing while the client reconnects are retried
+        once it's connected, without polling."""
+        self.setup_always_retryable()
+
+        class _Conn(ZookeeperClient):
+            session_timeout = 10000
+            state = zookeeper.CONNECTING_STATE
+
+        conn = _Conn()
+        metrics = Metrics()
+        client = RetryClient(conn, metrics=metrics, gate=ReconnectGate())
+        results = [fail(zookeeper.ConnectionLossException()), succeed(21)]
+        value_d = client._retry(lambda: results.pop(0))
+        self.assertEqual(len(client.gate), 1)
+        self.assertFalse(value_d.called)
+
+        # The session callback is left to the application, and is invoked
+        # once the gate released the parked operations.
+        session_events = []
+
+        def session_callback(conn, event):
+            session_events.append((event, value_d.called))
+        conn.set_session_callback(session_callback)
+        conn.state = zookeeper.CONNECTED_STATE
+        event = self.session_event(zookeeper.CONNECTED_STATE)
+        conn._notify_session_event(event)
+        self.assertEqual(session_events, [(event, True)])
+        self.assertEqual((yield value_d), 21)
+        self.assertEqual(metrics.counter("retry.parked", op="<lambda>"), 1)
+        self.assertEqual(metrics.counter("retry.retries", op="<lambda>"), 1)
+
+    def test_retry_client_parks_within_session_timeout(self):
+        """Operations are parked for at most 1.5 times the session timeout,
+        given in milliseconds."""
+        self.setup_always_retryable()
+
+        class _Conn(ZookeeperClient):
+            session_timeout = 2000
+            state = zookeeper.CONNECTING_STATE
+
+        timeouts = []
+
+        class _Gate(ReconnectGate):
+
+            def wait(self, timeout):
+                timeouts.append(timeout)
+                return succeed(False)
+
+        client = RetryClient(_Conn(), gate=_Gate())
+        value_d = client._retry(
+            lambda: fail(zookeeper.ConnectionLossException()))
+        self.assertFailure(value_d, zookeeper.ConnectionLossException)
+        value_d, watch_d = client._retry_watch(
+            lambda: (fail(zookeeper.ConnectionLossException()), Deferred()))
+        self.assertFailure(value_d, zookeeper.ConnectionLossException)
+        self.assertEqual(len(timeouts), 2)
+        for timeout in timeouts:
+            self.assertTrue(2.9 < timeout <= 3)
+
+
+    def test_circuit_breaker(self):
+        """A breaker opens after consecutive connection errors, and closes
+        once a probe succeeds."""
+        now = [0]
+        breaker = CircuitBreaker(
+            threshold=2, reset_timeout=5, clock=lambda: now[0])
+        transitions = []
+        breaker.subscribe(lambda *states: transitions.append(states))
+
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+        # A single probe is allowed once the reset timeout passes.
+        now[0] = 5
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(transitions, [
+            ("closed", "open"), ("open", "half-open"), ("half-open", "open"),
+            ("open", "half-open"), ("half-open", "closed")])
+
+    def test_circuit_breaker_lost_probe(self):
+        """A probe which doesn't complete within the reset timeout is
+        presumed lost, and another probe is allowed."""
+        now = [0]
+        breaker = CircuitBreaker(
+            threshold=1, reset_timeout=5, clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] = 5
+        self.assertTrue(breaker.allow())
+        now[0] = 9
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+
+    @inlineCallbacks
+    def test_retry_client_circuit_open(self):
+        """While the breaker is open operations fail fast, and reads are
+        served from the read cache if available."""
+        metrics = Metrics()
+        breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+        read_cache = {}
+        client = RetryClient(
+            ZookeeperClient(), metrics=metrics, breaker=breaker,
+            read_cache=read_cache)
+        results = [succeed(("abc", {"version": 1})),
+                   fail(zookeeper.ConnectionLossException())]
+
+        def get(path):
+            return results.pop(0)
+        client.client.get = get
+
+        result = yield client.get("/zoo")
+        self.assertEqual(read_cache, {"/zoo": result})
+        yield self.assertFailure(
+            client.get("/zoo"), zookeeper.ConnectionLossException)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        self.assertEqual((yield client.get("/zoo")), result)
+        self.assertEqual((yield client.get(path="/zoo")), result)
+        yield self.assertFailure(
+            client.get("/cage"), CircuitOpenException)
+        yield self.assertFailure(
+            client.exists("/zoo"), CircuitOpenException)
+        value_d, watch_d = client.exists_and_watch("/zoo")
+        yield self.assertFailure(value_d, CircuitOpenException)
+
+        # Reads with a watch are served from the cache too.
+        client.client.get_and_watch = lambda path: (get(path), Deferred())
+        value_d, watch_d = client.get_and_watch("/zoo")
+        self.assertEqual((yield value_d), result)
+        self.assertFalse(watch_d.called)
+
+        self.assertEqual(
+            metrics.counter("circuit.rejected", op="get"), 3)
+        self.assertEqual(
+            metrics.counter("circuit.rejected", op="<lambda>"), 1)
+        self.assertEqual(metrics.counter("circuit.rejected", op="exists"), 1)
+        self.assertEqual(
+            metrics.counter("circuit.transitions", state="open"), 1)
+
+        # The breaker is closed once the client reconnects.
+        client._cb_session_event(
+            client.client, self.session_event(zookeeper.CONNECTED_STATE))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
 
 class RetryClientTests(test_client.ClientTests):
     """Run the full client test suite against the retry facade.
@@ -0,0 +1,152 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from twisted.internet.defer import inlineCallbacks, gatherResults
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.lock import LockError, LockTimeout
+from txzookeeper.retry import sleep
+from txzookeeper.semaphore import Semaphore
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+
+class SemaphoreTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(SemaphoreTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        d = self.client.connect()
+        d.addCallback(lambda client: client.create("/leases"))
+        return d
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    def semaphores(self, count, max_leases=2):
+        return [Semaphore(self.client, "/leases", max_leases)
+                for i in range(count)]
+
+    @inlineCallbacks
+    def test_bounded_leases(self):
+        """
+        Up to max_leases holders acquire a lease, the others wait.
+        """
+        s1, s2, s3 = self.semaphores(3)
+        yield s1.acquire()
+        yield s2.acquire()
+        d = s3.acquire()
+        self.assertFalse(d.called)
+        self.assertEqual(s2.lease_count, 2)
+
+        yield s1.release()
+        yield d
+        self.assertTrue(s3.acquired)
+        self.assertEqual(s3.lease_count, 2)
+        self.assertEqual(s3.waiting_count, 0)
+
+    @inlineCallbacks
+    def test_out_of_order_release(self):
+        """
+        A waiter acquires a lease released by a holder other than its
+        predecessor.
+        """
+        s1, s2, s3, s4 = self.semaphores(4)
+        yield s1.acquire()
+        yield s2.acquire()
+        d3 = s3.acquire()
+        d4 = s4.acquire()
+
+        # The second holder's release wakes the first waiter directly.
+        yield s2.release()
+        yield d3
+        self.assertFalse(d4.called)
+
+        # The first holder's release is signalled by its successor.
+        yield s1.release()
+        yield d4
+        self.assertTrue(s4.acquired)
+
+    @inlineCallbacks
+    def test_concurrent_release(self):
+        """
+        All the waiters entitled to leases released at once acquire them.
+        """
+        s1, s2, s3, s4, s5 = self.semaphores(5, max_leases=3)
+        for s in (s1, s2, s3):
+            yield s.acquire()
+        d4 = s4.acquire()
+        d5 = s5.acquire()
+        yield sleep(0.1)
+
+        yield gatherResults([s1.release(), s2.release()])
+        yield gatherResults([d4, d5])
+        self.assertTrue(s4.acquired)
+        self.assertTrue(s5.acquired)
+
+    @inlineCallbacks
+    def test_watch_counts(self):
+        """
+        Once watched, the counts follow the acquisitions of other
+        instances.
+        """
+        observer, s1, s2, s3 = self.semaphores(4)
+        yield observer.watch_counts()
+        self.assertEqual(observer.lease_count, 0)
+
+        yield s1.acquire()
+        yield s2.acquire()
+        s3.acquire()
+        yield sleep(0.1)
+        self.assertEqual(observer.lease_count, 2)
+        self.assertEqual(observer.waiting_count, 1)
+
+        observer.unwatch_counts()
+        yield s1.release()
+        yield sleep(0.1)
+        self.assertEqual(observer.waiting_count, 1)
+
+    @inlineCallbacks
+    def test_acquire_timeout(self):
+        """
+        An acquisition times out, and its candidate node is removed.
+        """
+        s1, s2 = self.semaphores(2, max_leases=1)
+        yield s1.acquire()
+        yield self.assertFailure(s2.acquire(timeout=0.1), LockTimeout)
+        self.assertFalse(s2.acquired)
+        children = yield self.client.get_children("/leases")
+        self.assertEqual(len(children), 1)
+
+        # The semaphore can be acquired again.
+        d = s2.acquire()
+        yield s1.release()
+        yield d
+        self.assertTrue(s2.acquired)
+
+    @inlineCallbacks
+    def test_usage_errors(self):
+        s1, = self.semaphores(1)
+        yield self.assertFailure(s1.release(), LockError)
+        yield s1.acquire()
+        yield self.assertFailure(s1.acquire(), LockError)
+        self.assertRaises(ValueError, Semaphore, self.client, "/leases", 0)
@@ -0,0 +1,144 @@
+#
+#  Copyright (C) 2012 Canonical Ltd. All Rights Reserved
+#
+#  This file is part of txzookeeper.
+#
+#  Authors:
+#   Kapil Thangavelu
+#
+#  txzookeeper is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  txzookeeper is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with txzookeeper.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from cStringIO import StringIO
+
+import zookeeper
+
+from twisted.internet.defer import inlineCallbacks
+
+from txzookeeper import ZookeeperClient
+from txzookeeper.snapshot import (
+    export_tree, import_tree, read_snapshot, SnapshotError)
+from txzookeeper.tests import ZookeeperTestCase, utils
+
+READ_ACL = {"perms": zookeeper.PERM_READ | zookeeper.PERM_WRITE,
+            "scheme": "world", "id": "anyone"}
+
+
+class SnapshotTests(ZookeeperTestCase):
+
+    def setUp(self):
+        super(SnapshotTests, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    @inlineCallbacks
+    def create_tree(self):
+        yield self.client.create("/zoo", "animals")
+        yield self.client.create("/zoo/cats", "\x00\xffbinary")
+        yield self.client.create("/zoo/cats/lion", "roar", [READ_ACL])
+        yield self.client.create("/zoo/birds")
+        yield self.client.create(
+            "/zoo/keeper", "bob", flags=zookeeper.EPHEMERAL)
+
+    @inlineCallbacks
+    def assert_round_trip(self, binary):
+        yield self.create_tree()
+        output = StringIO()
+        count = yield export_tree(
+            self.client, "/zoo", output, binary=binary, concurrency=2)
+        self.assertEqual(count, 5)
+
+        yield self.client.create("/copy")
+        count = yield import_tree(
+            self.client, StringIO(output.getvalue()), "/copy/zoo",
+            concurrency=2)
+        self.assertEqual(count, 4)
+
+        children = yield self.client.get_children("/copy/zoo")
+        self.assertEqual(sorted(children), ["birds", "cats"])
+        data, stat = yield self.client.get("/copy/zoo")
+        self.assertEqual(data, "animals")
+        data, stat = yield self.client.get("/copy/zoo/cats")
+        self.assertEqual(data, "\x00\xffbinary")
+        data, stat = yield self.client.get("/copy/zoo/cats/lion")
+        self.assertEqual(data, "roar")
+        acls, stat = yield self.client.get_acl("/copy/zoo/cats/lion")
+        self.assertEqual(acls, [READ_ACL])
+
+    def test_json_lines_round_trip(self):
+        """
+        A subtree exported as JSON lines can be imported elsewhere, with
+        its data and ACLs. Ephemeral nodes are skipped by default.
+        """
+        return self.assert_round_trip(False)
+
+    def test_binary_round_trip(self):
+        """
+        A subtree exported in the binary format can be imported elsewhere.
+        """
+        return self.assert_round_trip(True)
+
+    @inlineCallbacks
+    def test_ephemeral_owner_recorded(self):
+        """
+        The ephemeral owner of nodes is recorded, and ephemerals can be
+        recreated by the importing session.
+        """
+        yield self.create_tree()
+        output = StringIO()
+        yield export_tree(self.client, "/zoo", output, include_acls=False)
+
+        records = dict((record.path, record) for record in
+                       read_snapshot(StringIO(output.getvalue())))
+        self.assertEqual(
+            records["/keeper"].ephemeral_owner, self.client.client_id[0])
+        self.assertEqual(records["/cats"].ephemeral_owner, 0)
+        self.assertEqual(records[""].acls, None)
+
+        yield self.client.create("/copy")
+        yield import_tree(self.client, StringIO(output.getvalue()),
+                          "/copy", restore_ephemerals=True)
+        data, stat = yield self.client.get("/copy/keeper")
+        self.assertEqual(data, "bob")
+        self.assertEqual(stat["ephemeralOwner"], self.client.client_id[0])
+
+    @inlineCallbacks
+    def test_export_root(self):
+        """
+        Exporting the root excludes the zookeeper system subtree, and
+        importing onto an existing node replaces its data.
+        """
+        yield self.client.create("/zoo", "animals")
+        output = StringIO()
+        count = yield export_tree(self.client, "/", output, binary=True)
+        self.assertEqual(count, 2)
+        paths = [record.path for record in
+                 read_snapshot(StringIO(output.getvalue()))]
+        self.assertEqual(paths, ["", "/zoo"])
+
+        yield self.client.set("/zoo", "empty")
+        yield import_tree(self.client, StringIO(output.getvalue()), "/")
+        data, stat = yield self.client.get("/zoo")
+        self.assertEqual(data, "animals")
+
+    def test_unknown_format(self):
+        """
+        Reading content that isn't a snapshot raises an error.
+        """
+        self.assertRaises(
+            SnapshotError, read_snapshot, StringIO("not a snapshot\n"))
@@ -22,10 +22,14 @@
 
 import zookeeper
 
-from twisted.internet.defer import inlineCallbacks, fail, succeed
+from twisted.internet.defer import (
+    inlineCallbacks, fail, succeed, gatherResults)
 
 from txzookeeper import ZookeeperClient
-from txzookeeper.utils import retry_change
+from txzookeeper.codec import DecodeCache, JSONCodec
+from txzookeeper.metrics import Metrics
+from txzookeeper.retry import Backoff
+from txzookeeper.utils import retry_change, ChangeBatcher
 from txzookeeper.tests.mocker import MATCH
 from txzookeeper.tests import ZookeeperTestCase, utils
 
@@ -85,6 +89,42 @@ class RetryChangeTest(ZookeeperTestCase):
         self.assertEqual(content, "hello")
         self.assertEqual(stat["version"], 1)
 
+    @inlineCallbacks
+    def test_codec(self):
+        """
+        With a codec, the change function receives and returns decoded
+        values.
+        """
+        codec = JSONCodec()
+
+        def increment(content, stat):
+            if content is None:
+                return {"count": 0}
+            return {"count": content["count"] + 1}
+
+        yield retry_change(self.client, "/counter", increment, codec)
+        yield retry_change(self.client, "/counter", increment, codec)
+        content, stat = yield self.client.get("/counter")
+        self.assertEqual(codec.decode(content), {"count": 1})
+
+    @inlineCallbacks
+    def test_codec_cache(self):
+        """
+        Node content is decoded through the codec's cache, as for nodes.
+        """
+        cache = DecodeCache()
+        codec = JSONCodec(cache=cache)
+        yield self.client.create("/counter", codec.encode({"count": 0}))
+        content, stat = yield self.client.get("/counter")
+        value = codec.decode_node("/counter", content, stat)
+
+        def check(content, stat):
+            self.assertIdentical(content, value)
+            return content
+
+        yield retry_change(self.client, "/counter", check, codec)
+        self.assertEqual(cache.hits, 1)
+
     def test_error_in_change_function_propogates(self):
         """
         an error in the change function propogates to the caller.
@@ -187,3 +227,88 @@ class RetryChangeTest(ZookeeperTestCase):
         content, stat = self.client.get("/animals")
         self.assertEqual(content, "hello")
         self.assertEqual(stat["version"], 0)
+
+
+class ChangeBatcherTest(ZookeeperTestCase):
+
+    def setUp(self):
+        super(ChangeBatcherTest, self).setUp()
+        self.client = ZookeeperClient("127.0.0.1:2181")
+        self.metrics = Metrics()
+        self.batcher = ChangeBatcher(
+            self.client, backoff=Backoff(base=0.01), metrics=self.metrics)
+        return self.client.connect()
+
+    def tearDown(self):
+        utils.deleteTree("/", self.client.handle)
+        self.client.close()
+
+    def append(self, value):
+        def change(content, stat):
+            return (content or "") + value
+        return change
+
+    @inlineCallbacks
+    def test_concurrent_changes_coalesced(self):
+        """
+        Changes requested while an update is in flight are applied in
+        order by a single write.
+        """
+        yield gatherResults([
+            self.batcher.change("/letters", self.append(c))
+            for c in "abcde"])
+        content, stat = yield self.client.get("/letters")
+        self.assertEqual(content, "abcde")
+        # The first change creates the node, the others are batched.
+        self.assertEqual(stat["version"], 1)
+        self.assertEqual(
+            self.metrics.counter("change.writes", path="/letters"), 2)
+        self.assertEqual(
+            self.metrics.histogram("change.batch_size").max, 4)
+
+    @inlineCallbacks
+    def test_conflict_retried(self):
+        """
+        On a version conflict the batch is reapplied to the node's new
+        content, and the conflict is counted.
+        """
+        yield self.client.create("/letters", "x")
+        real_get = self.client.get
+        content, stat = yield real_get("/letters")
+        yield self.client.set("/letters", "y")
+
+        p_client = self.mocker.proxy(self.client)
+        p_client.get("/letters")
+        self.mocker.result(succeed((content, stat)))
+        p_client.get("/letters")
+        self.mocker.call(real_get)
+        p_client.set("/letters", MATCH(lambda x: True), version=0)
+        self.mocker.passthrough()
+        p_client.set("/letters", "ya", version=1)
+        self.mocker.passthrough()
+        self.mocker.replay()
+
+        batcher = ChangeBatcher(
+            p_client, backoff=Backoff(base=0.01), metrics=self.metrics)
+        yield batcher.change("/letters", self.append("a"))
+        content, stat = yield real_get("/letters")
+        self.assertEqual(content, "ya")
+        self.assertEqual(
+            self.metrics.counter("change.conflicts", path="/letters"), 1)
+
+    @inlineCallbacks
+    def test_change_function_error(self):
+        """
+        An error in a change function fails its change only.
+        """
+        def error(content, stat):
+            raise SyntaxError()
+
+        d1 = self.batcher.change("/letters", self.append("a"))
+        d2 = self.batcher.change("/letters", error)
+        d3 = self.batcher.change("/letters", self.append("b"))
+        yield d1
+        yield self.assertFailure(d2, SyntaxError)
+        yield d3
+        content, stat = yield self.client.get("/letters")
+        self.assertEqual(content, "ab")
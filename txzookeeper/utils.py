@@ -22,11 +22,16 @@
 
 
 import zookeeper
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.python.failure import Failure
+
+from txzookeeper.codec import get_codec
+from txzookeeper.metrics import get_metrics
+from txzookeeper.retry import Backoff, sleep
 
 
 @inlineCallbacks
-def retry_change(client, path, change_function):
+def retry_change(client, path, change_function, codec=None):
     """
     A utility function to execute a node change function, repeatedly
     in the face of transient errors. The node at 'path's content will
@@ -44,7 +49,14 @@ def retry_change(client, path, change_function):
            the node_content and the current node stat, and will return the
            new node content. The function must not have side-effects as
            it will be called again in the event of various error conditions.
+
+    @param codec An optional codec, the change function then receives and
+           returns decoded values. Defaults to the client's codec. If the
+           codec has a cache, the value received may be shared and must not
+           be modified in place.
     """
+    if codec is None:
+        codec = get_codec(client)
 
     while True:
         create_mode = False
@@ -55,10 +67,16 @@ def retry_change(client, path, change_function):
             create_mode = True
             content, stat = None, None
 
+        if codec is not None and content is not None:
+            content = codec.decode_node(path, content, stat)
+
         new_content = yield change_function(content, stat)
         if new_content == content:
             break
 
+        if codec is not None:
+            new_content = codec.encode(new_content)
+
         try:
             if create_mode:
                 yield client.create(path, new_content)
@@ -69,3 +87,160 @@ def retry_change(client, path, change_function):
                 zookeeper.NoNodeException,
                 zookeeper.BadVersionException):
             pass
+
+
+class ChangeBatcher(object):
+    """
+    Coalesces concurrent local changes of a node into a single update.
+
+    Changes of a node requested while an update of it is in flight are
+    queued, and applied in order by the next read-modify-write of the
+    node, so local contention results in a single write rather than many
+    competing ones. On a version conflict the update is retried, with any
+    changes queued meanwhile, after a backoff delay.
+
+    The metrics hook counts writes and version conflicts per path, as
+    `change.writes` and `change.conflicts`, and observes the number of
+    changes per write as `change.batch_size`.
+    """
+
+    def __init__(self, client, codec=None, backoff=None, metrics=None):
+        """
+        @param client A connected txzookeeper client
+
+        @param codec An optional codec, the change functions then receive
+               and return decoded values. Defaults to the client's codec.
+
+        @param backoff The Backoff policy for delaying retries on version
+               conflicts.
+
+        @param metrics The metrics hook, defaults to the client's.
+        """
+        if codec is None:
+            codec = get_codec(client)
+        if backoff is None:
+            backoff = Backoff(base=0.01, max_delay=1)
+        if metrics is None:
+            metrics = get_metrics(client)
+        self._client = client
+        self._codec = codec
+        self._backoff = backoff
+        self._metrics = metrics
+        self._pending = {}
+
+    def change(self, path, change_function):
+        """
+        Change a node's content, with the same semantics as `retry_change`.
+
+        @param path A path to a node that will be modified
+
+        @param change_function A python function that will receive two
+               parameters the node_content and the current node stat, and
+               will return the new node content. It receives the content
+               resulting from the changes queued before it. It must not have
+               side-effects as it will be called again on version conflicts.
+
+        @return A deferred firing once the change is applied. An error in
+                the change function fails its deferred only, the other
+                changes of the batch are applied.
+        """
+        d = Deferred()
+        if path in self._pending:
+            self._pending[path].append((change_function, d))
+        else:
+            self._pending[path] = [(change_function, d)]
+            self._update(path)
+        return d
+
+    def _increment(self, name, path):
+        if self._metrics is not None:
+            self._metrics.increment(name, path=path)
+
+    @inlineCallbacks
+    def _update(self, path):
+        batch = []
+        attempt = 0
+        delay = None
+        while True:
+            # Coalesce the changes queued so far, and claim the path's
+            # queue for changes arriving during this update.
+            batch.extend(self._pending[path])
+            self._pending[path] = []
+
+            try:
+                applied, conflict = yield self._apply(path, batch)
+            except Exception:
+                failure = Failure()
+                for function, d in batch:
+                    d.errback(failure)
+                applied, conflict = [], False
+
+            if conflict:
+                self._increment("change.conflicts", path)
+                delay = self._backoff.get_delay(attempt, delay)
+                attempt += 1
+                yield sleep(delay)
+                continue
+
+            for d, result in applied:
+                if isinstance(result, Failure):
+                    d.errback(result)
+                else:
+                    d.callback(None)
+
+            batch = []
+            attempt = 0
+            delay = None
+            if not self._pending[path]:
+                del self._pending[path]
+                break
+
+    @inlineCallbacks
+    def _apply(self, path, batch):
+        """
+        Apply a batch of changes with a single read-modify-write. Returns
+        the outcome of each change, and whether a conflict occurred.
+        """
+        codec = self._codec
+        create_mode = False
+
+        try:
+            content, stat = yield self._client.get(path)
+        except zookeeper.NoNodeException:
+            create_mode = True
+            content, stat = None, None
+
+        if codec is not None and content is not None:
+            content = codec.decode_node(path, content, stat)
+
+        applied = []
+        new_content = content
+        for function, d in batch:
+            try:
+                changed = yield function(new_content, stat)
+            except Exception:
+                applied.append((d, Failure()))
+            else:
+                new_content = changed
+                applied.append((d, None))
+
+        if new_content == content:
+            returnValue((applied, False))
+
+        if codec is not None:
+            new_content = codec.encode(new_content)
+
+        if self._metrics is not None:
+            self._metrics.observe("change.batch_size", len(batch))
+        self._increment("change.writes", path)
+        try:
+            if create_mode:
+                yield self._client.create(path, new_content)
+            else:
+                yield self._client.set(
+                    path, new_content, version=stat["version"])
+        except (zookeeper.NodeExistsException,
+                zookeeper.NoNodeException,
+                zookeeper.BadVersionException):
+            returnValue((applied, True))
+        returnValue((applied, False))